@@ -242,7 +242,7 @@ create_base_image() {
 
   info "Using image type ${image_type}"
   get_disk_layout_path
-  info "Using disk layout ${DISK_LAYOUT_PATH}"
+  info "Using disk layout ${DISK_LAYOUT_SOURCE_PATH:-${DISK_LAYOUT_PATH}}"
   root_fs_dir="${BUILD_DIR}/rootfs"
   stateful_fs_dir="${BUILD_DIR}/stateful"
   esp_fs_dir="${BUILD_DIR}/esp"
@@ -25,20 +25,43 @@ This will grow the ROOT-A partition size by 500 mebibytes (1024 * 1024 * 500):
   --adjust_part ROOT-A:+500MiB
 This will shrink the ROOT-A partition size by 10 mebibytes (1024 * 1024 * 10):
   --adjust_part ROOT-A:-20MiB
+
+Adjusting a rootfs partition sets the size of its filesystem, and the partition
+is grown by a hashpad for the dm-verity hash tree.  By default the hashpad is
+15% of the filesystem; --hashpad=exact makes it the size of the hash tree
+(hashed with --verity_hash_alg, as build_kernel_image.sh does) rounded up to
+fs_align.  That leaves no room for the boot cache build_kernel_image.sh
+--enable_bootcache places after the hash tree.  The readhashpadsize command
+prints the hashpad of a partition and hashpadreport how much the exact mode
+saves.
+
+To see where the time of cgpt.py goes in a build, set CGPT_PROFILE to a file
+(or pass --profile): every command appends the wall time and calls of its
+phases to it as a JSON line.
 """
 
 from __future__ import division
 from __future__ import print_function
 
 import argparse
-import copy
-import inspect
+import collections
+import collections.abc
+import contextlib
+import functools
+import hashlib
+import io
 import json
 import math
 import os
 import re
+import shlex
+import stat
 import sys
 
+# concurrent.futures, gpt_image, socket, tempfile, time and traceback are only
+# imported by the functions using them: most commands never need them, and
+# every command pays for imports.
+
 
 class ConfigNotFound(Exception):
   """Config Not Found"""
@@ -82,8 +105,24 @@ class ExpandNandImpossible(Exception):
 class ExcessPartitionSize(Exception):
   """Partitions sum to more than the size of the whole device"""
 
+class CyclicLayoutParents(Exception):
+  """Layout files inherit from each other in a loop"""
+
+class InvalidHashAlgorithm(Exception):
+  """Unknown dm-verity hash algorithm"""
+
+class ServerError(Exception):
+  """The cgpt.py server could not be started or reached"""
+
 COMMON_LAYOUT = 'common'
 BASE_LAYOUT = 'base'
+# First key of a layout written by the compile command, and its format version.
+COMPILED_LAYOUT_KEY = 'cgpt_compiled_layout'
+COMPILED_LAYOUT_VERSION = 1
+# Seconds the server waits for a client to send its request.
+SERVER_TIMEOUT = 10
+# Prefix of the environment variables clients send with their requests.
+SERVER_ENVIRONMENT_PREFIX = 'CGPT_'
 # Blocks of the partition entry array.
 SIZE_OF_PARTITION_ENTRY_ARRAY_BYTES = 16 * 1024
 SIZE_OF_PMBR = 1
@@ -93,6 +132,18 @@ MAX_SECTOR_SIZE = 8 * 1024
 START_SECTOR = 4 * MAX_SECTOR_SIZE
 SECONDARY_GPT_BYTES = SIZE_OF_PARTITION_ENTRY_ARRAY_BYTES + \
   SIZE_OF_GPT_HEADER * MAX_SECTOR_SIZE
+# Block sizes the generated scripts have partitions placed in advance for.
+SPECIALIZED_BLOCK_SIZES = (512, 4096)
+# Largest acceptable probability of more bad erase blocks falling in a
+# partition than it reserves.
+MAX_BAD_BLOCK_PROBABILITY = 0.00001
+# Ways of sizing the hashpad after the filesystem of an adjusted rootfs
+# partition: 15% of the filesystem, or the dm-verity hash tree.
+HASHPAD_MODES = ('legacy', 'exact')
+# Block size and default hash algorithm of dm-verity, as build_kernel_image.sh
+# hashes the rootfs.
+VERITY_BLOCK_SIZE = 4096
+DEFAULT_VERITY_HASH_ALG = 'sha256'
 
 def ParseHumanNumber(operand):
   """Parse a human friendly number
@@ -187,6 +238,11 @@ def _ApplyLayoutOverrides(layout_to_override, layout):
 
   First add missing partition from layout to layout_to_override.
   Then, update partitions in layout_to_override with layout information.
+
+  Only the list |layout_to_override| is modified.  The partitions themselves
+  are copied on write: an overridden partition is replaced by an updated copy
+  and new partitions are inserted as is, so partitions may be shared by any
+  number of layouts as long as nobody modifies them in place.
   """
   # First check that all the partitions defined in both layouts are defined in
   # the same order in each layout. Otherwise, the order in which they end up
@@ -207,7 +263,18 @@ def _ApplyLayoutOverrides(layout_to_override, layout):
             [part.get('num') for part in layout]))
 
   # Merge layouts with the partitions in the same order they are in both
-  # layouts.
+  # layouts.  The merged list is built in a single pass instead of inserting
+  # into layout_to_override, which would be quadratic in the number of
+  # partitions.  |part_index| walks the partitions of layout_to_override not
+  # yet copied to |merged|, and |common_indexes| maps each shared num to where
+  # it first appears, so shared partitions are found without scanning.
+  common_indexes = {}
+  for index, part in enumerate(layout_to_override):
+    num = part.get('num')
+    if num in common_nums and num not in common_indexes:
+      common_indexes[num] = index
+
+  merged = []
   part_index = 0
   for part_to_apply in layout:
     num = part_to_apply.get('num')
@@ -215,59 +282,141 @@ def _ApplyLayoutOverrides(layout_to_override, layout):
     if part_index == len(layout_to_override):
       # The part_to_apply is past the list of partitions to override, this
       # means that is a new partition added at the end.
-      # Need of deepcopy, in case we change layout later.
-      layout_to_override.append(copy.deepcopy(part_to_apply))
+      merged.append(part_to_apply)
     elif layout_to_override[part_index].get('num') is None and num is None:
       # Allow modifying gaps after a partition.
       # TODO(deymo): Drop support for "gap" partitions and use alignment
       # instead.
-      layout_to_override[part_index].update(part_to_apply)
+      merged.append(dict(layout_to_override[part_index], **part_to_apply))
+      part_index += 1
     elif num in common_nums:
-      while layout_to_override[part_index].get('num') != num:
-        part_index += 1
-      layout_to_override[part_index].update(part_to_apply)
+      match_index = common_indexes[num]
+      if match_index < part_index:
+        # The num is listed more than once; find its next occurrence.
+        match_index = part_index
+        while layout_to_override[match_index].get('num') != num:
+          match_index += 1
+      merged.extend(layout_to_override[part_index:match_index])
+      merged.append(dict(layout_to_override[match_index], **part_to_apply))
+      part_index = match_index + 1
     else:
-      # Need of deepcopy, in case we change layout later.
-      layout_to_override.insert(part_index, copy.deepcopy(part_to_apply))
-    part_index += 1
+      merged.append(part_to_apply)
+
+  merged.extend(layout_to_override[part_index:])
+  layout_to_override[:] = merged
 
 
 def LoadJSONWithComments(filename):
-  """Loads a JSON file ignoring lines with comments.
+  """Loads a JSON file ignoring comments.
 
   RFC 7159 doesn't allow comments on the file JSON format. This functions loads
-  a JSON file removing all the comment lines. A comment line is any line
-  starting with # and optionally indented with whitespaces. Note that inline
-  comments are not supported.
+  a JSON file removing all the comments. A comment starts with a # outside of a
+  string and runs to the end of the line, so it can take a whole line or follow
+  a value on it.
 
   Args:
     filename: The input filename.
 
   Returns:
     The parsed JSON object.
+
+  Raises:
+    json.JSONDecodeError (a ValueError) with the line and column of the error
+    in |filename|.
   """
-  regex = re.compile(r'^\s*#.*')
   with open(filename) as f:
-    source = ''.join(regex.sub('', line) for line in f)
-  return json.loads(source)
+    return _ParseJSONWithComments(f.read())
 
 
-def _LoadStackedPartitionConfig(filename):
-  """Loads a partition table and its possible parent tables.
+# Matches an escape sequence in a JSON string, e.g. \" or \\.
+_JSON_ESCAPE_RE = re.compile(r'\\.')
 
-  This does very little validation.  It's just enough to walk all of the parent
-  files and merges them with the current config.  Overall validation is left to
-  the caller.
+
+def _StripJSONComments(source):
+  """Removes the comments from JSON text.
+
+  |source| is scanned once, jumping from one # to the next.  A # starts a
+  comment unless it is in a string literal, i.e. follows an odd number of
+  unescaped quotes on its line: JSON strings can't span lines.  The comment
+  runs to the end of the line, which is kept, so the line and column of every
+  other character are unchanged.
 
   Args:
-    filename: Filename to load into object.
+    source: The JSON text.
 
   Returns:
-    Object containing disk layout configuration
+    |source| without its comments.
+  """
+  pieces = []
+  start = 0
+  pos = source.find('#')
+  while pos >= 0:
+    prefix = source[source.rfind('\n', 0, pos) + 1:pos]
+    if '\\' in prefix:
+      prefix = _JSON_ESCAPE_RE.sub('', prefix)
+    if prefix.count('"') % 2:
+      pos = source.find('#', pos + 1)
+      continue
+    pieces.append(source[start:pos])
+    start = source.find('\n', pos)
+    if start < 0:
+      start = len(source)
+    pos = source.find('#', start)
+  pieces.append(source[start:])
+  return ''.join(pieces)
+
+
+def _ParseJSONWithComments(source):
+  """Parses JSON text the same way as LoadJSONWithComments.
+
+  Args:
+    source: The JSON text.
+
+  Returns:
+    The parsed JSON object.
+  """
+  try:
+    return json.loads(_StripJSONComments(source))
+  except json.JSONDecodeError as e:
+    # Report the offset in |source| rather than in the stripped text.
+    lines = source.split('\n', e.lineno - 1)[:-1]
+    pos = sum(len(x) + 1 for x in lines)
+    raise json.JSONDecodeError(e.msg, source, pos + e.colno - 1)
+
+
+# Per-process memo of parsed layout files, keyed on the absolute filename.
+# Values are (content digest, config) tuples; see _ReadLayoutFile.
+_PARSED_LAYOUT_FILES = {}
+
+# Per-process memo of fully stacked configs, keyed on the absolute filename.
+# Values are (parent chain digest, config) tuples; see
+# _LoadStackedPartitionConfig.
+_STACKED_CONFIGS = {}
+
+
+def _ReadLayoutFile(filename):
+  """Parses a single layout file and applies its common layout to the others.
+
+  The result only depends on the contents of |filename|, so it is memoized for
+  the life of the process and shared by every layout that inherits from it.
+
+  Args:
+    filename: Filename to load.
+
+  Returns:
+    A (digest, config) tuple.  The config is shared and must not be modified.
   """
   if not os.path.exists(filename):
     raise ConfigNotFound('Partition config %s was not found!' % filename)
-  config = LoadJSONWithComments(filename)
+  path = os.path.abspath(filename)
+  with open(path, 'rb') as f:
+    data = f.read()
+  digest = hashlib.sha1(data).hexdigest()
+  cached = _PARSED_LAYOUT_FILES.get(path)
+  if cached is not None and cached[0] == digest:
+    return cached
+
+  config = _ParseJSONWithComments(data.decode('utf-8'))
 
   # Let's first apply our new configs onto base.
   common_layout = config['layouts'].setdefault(COMMON_LAYOUT, [])
@@ -276,20 +425,121 @@ def _LoadStackedPartitionConfig(filename):
     if layout_name == COMMON_LAYOUT or layout_name == '_comment':
       continue
 
-    # Need to copy a list of dicts so make a deep copy.
-    working_layout = copy.deepcopy(common_layout)
+    working_layout = list(common_layout)
     _ApplyLayoutOverrides(working_layout, layout)
     config['layouts'][layout_name] = working_layout
 
-  dirname = os.path.dirname(filename)
+  _PARSED_LAYOUT_FILES[path] = (digest, config)
+  return digest, config
+
+
+def _GetParentFilename(dirname, parent, missing=None):
+  """Returns the path of |parent| as referenced from a file in |dirname|.
+
+  Args:
+    dirname: Directory of the file referencing |parent|.
+    parent: Filename of the parent as written in the file.
+    missing: If not None, a list the absolute path of the file next to the
+      child is appended to when it does not exist.  Creating that file later
+      changes which parent is used.
+  """
+  parent_filename = os.path.join(dirname, parent)
+  if not os.path.exists(parent_filename):
+    if missing is not None:
+      missing.append(os.path.abspath(parent_filename))
+    # Try loading the parent file from the cgpt.py directory (global config).
+    parent_filename = os.path.join(os.path.dirname(__file__), parent)
+  return parent_filename
+
+
+def _GetParentGraph(filename, missing=None):
+  """Walks |filename| and all of its ancestors as a dependency graph.
+
+  Every file is read once no matter how many paths through the graph reach
+  it.
+
+  Args:
+    filename: Filename of the layout at the bottom of the graph.
+    missing: If not None, a list the absolute path of every parent looked
+      for next to its child and not found there is appended to.
+
+  Returns:
+    A list of (path, digest, config, parent_paths) tuples, one per file, in
+    dependency order: every file comes after all of its parents.
+  """
+  graph = []
+  visited = set()
+  visiting = []
+
+  def _Visit(node_filename):
+    path = os.path.abspath(node_filename)
+    if path in visited:
+      return path
+    if path in visiting:
+      cycle = visiting[visiting.index(path):] + [path]
+      raise CyclicLayoutParents('Layout parents form a cycle: %s' %
+                                ' -> '.join(cycle))
+    visiting.append(path)
+    digest, config = _ReadLayoutFile(node_filename)
+    dirname = os.path.dirname(node_filename)
+    parents = [_Visit(_GetParentFilename(dirname, parent, missing))
+               for parent in config.get('parent', '').split()]
+    visiting.pop()
+    visited.add(path)
+    graph.append((path, digest, config, parents))
+    return path
+
+  _Visit(filename)
+  return graph
+
+
+def _CopyConfig(config, copy_partitions=False):
+  """Copies the containers of |config| that the loaders modify in place.
+
+  The config itself, its metadata, its layouts and every layout list are
+  copied.  Partitions are shared unless |copy_partitions| is set, in which
+  case each one is copied too, but never any deeper: nothing modifies the
+  values of a partition in place.
+
+  Args:
+    config: Partition configuration object to copy.
+    copy_partitions: Whether to also copy each partition.
+
+  Returns:
+    The copied config.
+  """
+  config = dict(config)
+  if 'metadata' in config:
+    config['metadata'] = dict(config['metadata'])
+  layouts = {}
+  for layout_name, layout in config.get('layouts', {}).items():
+    if layout_name == '_comment':
+      layouts[layout_name] = layout
+    elif copy_partitions:
+      layouts[layout_name] = [dict(part) for part in layout]
+    else:
+      layouts[layout_name] = list(layout)
+  config['layouts'] = layouts
+  return config
+
+
+def _MergeParentConfigs(config, parent_configs):
+  """Stacks |config| on top of its already resolved parents.
+
+  Parents are applied in order, so earlier parents take precedence over later
+  ones.  None of the arguments are modified.
+
+  Args:
+    config: The config of a single file, as returned by _ReadLayoutFile.
+    parent_configs: The fully resolved configs of each of its parents.
+
+  Returns:
+    The merged config.
+  """
+  config = _CopyConfig(config)
   # Now let's inherit the values from all our parents.
-  for parent in config.get('parent', '').split():
-    parent_filename = os.path.join(dirname, parent)
-    if not os.path.exists(parent_filename):
-      # Try loading the parent file from the cgpt.py directory (global config).
-      parent_filename = os.path.join(os.path.join(os.path.dirname(__file__),
-                                                  parent))
-    parent_config = _LoadStackedPartitionConfig(parent_filename)
+  for parent_config in parent_configs:
+    parent_config = _CopyConfig(parent_config)
 
     # First if the parent is missing any fields the new config has, fill them
     # in.
@@ -320,7 +570,7 @@ def _LoadStackedPartitionConfig(filename):
     # Actually add the copy. Use a copy such that each is unique.
     parent_cmn_layout = parent_config['layouts'].setdefault(COMMON_LAYOUT, [])
     for layout_name in new_layouts:
-      parent_config['layouts'][layout_name] = copy.deepcopy(parent_cmn_layout)
+      parent_config['layouts'][layout_name] = list(parent_cmn_layout)
 
     # Iterate through each layout in the parent config and apply the new layout.
     common_layout = config['layouts'].setdefault(COMMON_LAYOUT, [])
@@ -340,16 +590,223 @@ def _LoadStackedPartitionConfig(filename):
   return config
 
 
-def LoadPartitionConfig(filename):
+def _LoadStackedPartitionConfig(filename, loaded_files=None):
+  """Loads a partition table and its possible parent tables.
+
+  This does very little validation.  It's just enough to walk all of the parent
+  files and merges them with the current config.  Overall validation is left to
+  the caller.
+
+  The parent files form a graph which is resolved bottom up: each file is
+  parsed and stacked on its parents once, and the result is reused by every
+  file inheriting from it, within this call and by later calls in the same
+  process as long as none of the files in its chain change.
+
+  Args:
+    filename: Filename to load into object.
+    loaded_files: If not None, a list the absolute path of every file the
+      config depends on is appended to: the parents looked for next to their
+      child that did not exist, followed by every file read.
+
+  Returns:
+    Object containing disk layout configuration.  It is a private copy the
+    caller may modify.
+  """
+  missing = []
+  graph = _GetParentGraph(filename, missing)
+  resolved = {}
+  for path, digest, config, parents in graph:
+    chain_digest = hashlib.sha1(
+        ' '.join([digest] + [resolved[x][0] for x in parents]).encode('utf-8')
+    ).hexdigest()
+    cached = _STACKED_CONFIGS.get(path)
+    if cached is None or cached[0] != chain_digest:
+      cached = (chain_digest, _MergeParentConfigs(
+          config, [resolved[x][1] for x in parents]))
+      _STACKED_CONFIGS[path] = cached
+    resolved[path] = cached
+
+  if loaded_files is not None:
+    for path in missing:
+      if path not in loaded_files:
+        loaded_files.append(path)
+    loaded_files.extend(x[0] for x in graph)
+  return _CopyConfig(resolved[graph[-1][0]][1], copy_partitions=True)
+
+
+def _GetConfigCacheKey(filenames):
+  """Returns the cache key for a config built from |filenames|.
+
+  The key covers the contents of every file in the parent chain as well as
+  this script, so editing any layout or cgpt.py invalidates cached entries.
+  Files that do not exist are part of the key too: creating a parent next to
+  a child that used to fall back to the global one invalidates it as well.
+
+  Args:
+    filenames: Absolute paths of every file the config depends on.
+
+  Returns:
+    A hex digest string.
+  """
+  digest = hashlib.sha256()
+  for filename in [os.path.realpath(__file__)] + filenames:
+    digest.update(filename.encode('utf-8') + b'\0')
+    try:
+      with open(filename, 'rb') as f:
+        digest.update(b'+' + hashlib.sha256(f.read()).digest())
+    except FileNotFoundError:
+      digest.update(b'-')
+  return digest.hexdigest()
+
+
+def _GetConfigCachePath(cache_dir, filename):
+  """Returns the path of the cache entry for the layout |filename|."""
+  name = hashlib.sha256(os.path.abspath(filename).encode('utf-8')).hexdigest()
+  return os.path.join(cache_dir, name + '.json')
+
+
+def _ReadConfigCache(cache_dir, filename):
+  """Reads the cached resolved config for |filename|.
+
+  Args:
+    cache_dir: Directory holding the cache entries.
+    filename: Layout filename as passed to LoadPartitionConfig.
+
+  Returns:
+    A (loaded_files, key, config) tuple, or None on a miss.
+  """
+  try:
+    with open(_GetConfigCachePath(cache_dir, filename)) as f:
+      entry = json.load(f)
+    key = _GetConfigCacheKey(entry['files'])
+    if entry['key'] != key:
+      return None
+    return entry['files'], key, entry['config']
+  except (OSError, ValueError, KeyError, TypeError):
+    return None
+
+
+def _WriteConfigCache(cache_dir, filename, loaded_files, key, config):
+  """Stores a resolved config for |filename| in the cache.
+
+  The entry is written to a temporary file and renamed into place so that
+  concurrent readers never see a partial entry.  Failures are ignored; the
+  cache is only an optimization.
+
+  Args:
+    cache_dir: Directory holding the cache entries.
+    filename: Layout filename as passed to LoadPartitionConfig.
+    loaded_files: Absolute paths of every file the config depends on.
+    key: The cache key of |loaded_files|; see _GetConfigCacheKey.
+    config: The resolved and validated config.
+  """
+  import tempfile
+
+  try:
+    os.makedirs(cache_dir, exist_ok=True)
+    entry = {
+        'files': loaded_files,
+        'key': key,
+        'config': config,
+    }
+    with tempfile.NamedTemporaryFile('w', dir=cache_dir, suffix='.tmp',
+                                     delete=False) as f:
+      json.dump(entry, f)
+    os.replace(f.name, _GetConfigCachePath(cache_dir, filename))
+  except OSError:
+    pass
+
+
+def ClearConfigCache(options):
+  """Removes every cached resolved layout.
+
+  Args:
+    options: Flags passed to the script
+  """
+  cache_dir = options.cache_dir
+  if not cache_dir or not os.path.isdir(cache_dir):
+    return
+  for name in os.listdir(cache_dir):
+    if name.endswith('.json') or name.endswith('.tmp'):
+      os.unlink(os.path.join(cache_dir, name))
+
+
+def _LoadCompiledLayout(filename):
+  """Loads |filename| if it was written by the compile command.
+
+  Only the start of the file is read to tell compiled layouts apart from
+  regular ones.
+
+  Args:
+    filename: Layout filename as passed to LoadPartitionConfig.
+
+  Returns:
+    The resolved config, or None if |filename| is not a compiled layout.
+  """
+  try:
+    with open(filename) as f:
+      head = f.read(64)
+      if not re.match(r'\s*{\s*"%s"\s*:' % COMPILED_LAYOUT_KEY, head):
+        return None
+      compiled = json.loads(head + f.read())
+  except (IOError, UnicodeDecodeError):
+    return None
+
+  if compiled[COMPILED_LAYOUT_KEY] != COMPILED_LAYOUT_VERSION:
+    raise InvalidLayout('%s was compiled by an incompatible cgpt.py '
+                        '(format %s, expected %s); compile it again' %
+                        (filename, compiled[COMPILED_LAYOUT_KEY],
+                         COMPILED_LAYOUT_VERSION))
+  return compiled['config']
+
+
+# Per-process memo of loaded configs, keyed on the absolute filename.  Values
+# are (loaded_files, key, config) tuples; see LoadPartitionConfig.
+_LOADED_CONFIGS = {}
+
+
+def LoadPartitionConfig(filename, cache_dir=None, loaded_files=None):
   """Loads a partition tables configuration file into a Python object.
 
+  |filename| may also be a layout written by the compile command, which is
+  used as is: it has already been resolved and validated.
+
+  Loaded configs are kept for the life of the process, and reused for as
+  long as the contents of every file they were built from stay the same, and
+  no parent appears next to a child that fell back to the global one.
+
   Args:
     filename: Filename to load into object
+    cache_dir: If set, directory of a persistent cache of resolved configs.
+      A hit skips JSON parsing, merging and validation entirely.
+    loaded_files: If not None, a list the absolute path of every file the
+      config depends on is appended to; see _LoadStackedPartitionConfig.
 
   Returns:
     Object containing disk layout configuration
   """
+  path = os.path.abspath(filename)
+  loaded = _LOADED_CONFIGS.get(path)
+  if loaded is not None:
+    try:
+      if _GetConfigCacheKey(loaded[0]) != loaded[1]:
+        loaded = None
+    except OSError:
+      loaded = None
+  if loaded is None:
+    loaded = _LoadPartitionConfig(filename, cache_dir)
+    _LOADED_CONFIGS[path] = loaded
+  if loaded_files is not None:
+    loaded_files.extend(loaded[0])
+  return _CopyConfig(loaded[2], copy_partitions=True)
 
+
+def _ValidateConfig(config):
+  """Validates a stacked layout config and parses its sizes in place.
+
+  Args:
+    config: Config as returned by _LoadStackedPartitionConfig
+  """
   valid_keys = set(('_comment', 'metadata', 'layouts', 'parent'))
   valid_layout_keys = set((
       '_comment', 'num', 'fs_blocks', 'fs_block_size', 'fs_align', 'bytes',
@@ -359,7 +816,6 @@ def LoadPartitionConfig(filename):
       'page_size', 'size_min', 'fs_size_min'))
   valid_features = set(('expand', 'last_partition'))
 
-  config = _LoadStackedPartitionConfig(filename)
   try:
     metadata = config['metadata']
     metadata['fs_block_size'] = ParseHumanNumber(metadata['fs_block_size'])
@@ -471,7 +927,57 @@ def LoadPartitionConfig(filename):
   except KeyError as e:
     raise InvalidLayout('Layout is missing required entries: %s' % e)
 
-  return config
+
+def _LoadPartitionConfig(filename, cache_dir):
+  """Loads and validates a partition tables configuration file.
+
+  Args:
+    filename: Filename to load into object
+    cache_dir: If set, directory of a persistent cache of resolved configs.
+
+  Returns:
+    A (loaded_files, key, config) tuple: the absolute path of every file the
+    config depends on, their cache key and the config itself.
+  """
+  config = _LoadCompiledLayout(filename)
+  if config is not None:
+    loaded_files = [os.path.abspath(filename)]
+    return loaded_files, _GetConfigCacheKey(loaded_files), config
+
+  if cache_dir:
+    loaded = _ReadConfigCache(cache_dir, filename)
+    if loaded is not None:
+      return loaded
+
+  loaded_files = []
+  config = _LoadStackedPartitionConfig(filename, loaded_files)
+  _ValidateConfig(config)
+
+  key = _GetConfigCacheKey(loaded_files)
+  if cache_dir:
+    _WriteConfigCache(cache_dir, filename, loaded_files, key, config)
+  return loaded_files, key, config
+
+
+def CompileLayout(options, layout_filename, output_filename):
+  """Writes a layout with all its parents resolved and its sizes validated.
+
+  Every command taking a layout file also takes the output, and skips
+  resolving and validating the layout again.  Changes to the source layout
+  or its parents are not picked up until it is compiled again.
+
+  Args:
+    options: Flags passed to the script
+    layout_filename: Path to partition configuration file
+    output_filename: Path to write the compiled layout to
+  """
+  config = LoadPartitionConfig(layout_filename, cache_dir=options.cache_dir)
+  compiled = {
+      COMPILED_LAYOUT_KEY: COMPILED_LAYOUT_VERSION,
+      'source': os.path.abspath(layout_filename),
+      'config': config,
+  }
+  _WriteFileAtomically(output_filename, json.dumps(compiled))
 
 
 def _GetPrimaryEntryArrayPaddingBytes(config):
@@ -587,6 +1093,121 @@ def GetTableTotals(config, partitions):
   return ret
 
 
+class Partition(collections.abc.MutableMapping):
+  """A partition of a layout, with changes kept apart from the layout.
+
+  Reads fall through to the partition of the layout while writes only go to
+  a private dict created on the first write, so the partition in the layout
+  is never modified and unchanged partitions cost two slots.  GetPartitionTable
+  only writes to partitions it adjusts or whose fs_options depend on their
+  fs_format.
+  """
+
+  __slots__ = ('_base', '_changes')
+
+  def __init__(self, base):
+    self._base = base
+    self._changes = None
+
+  def __getitem__(self, key):
+    if self._changes is not None and key in self._changes:
+      return self._changes[key]
+    return self._base[key]
+
+  def get(self, key, default=None):
+    if self._changes is not None and key in self._changes:
+      return self._changes[key]
+    return self._base.get(key, default)
+
+  def __contains__(self, key):
+    return key in self._base or (self._changes is not None and
+                                 key in self._changes)
+
+  def __setitem__(self, key, value):
+    if self._changes is None:
+      self._changes = {}
+    self._changes[key] = value
+
+  def __delitem__(self, key):
+    # Deleting is rare enough to simply stop sharing the partition.
+    partition = dict(self)
+    del partition[key]
+    self._base = partition
+    self._changes = None
+
+  def __iter__(self):
+    if self._changes is None:
+      return iter(self._base)
+    return iter(dict(self._base, **self._changes))
+
+  def __len__(self):
+    if self._changes is None:
+      return len(self._base)
+    return len(self._base.keys() | self._changes.keys())
+
+  def __repr__(self):
+    return repr(dict(self))
+
+
+class PartitionTable(tuple):
+  """A list of partitions indexed by num, label and type.
+
+  The first partition with a given num or label wins, like the linear
+  searches this replaces.  The indexes are built once, so the nums, labels
+  and types of the partitions must not change afterwards.
+  """
+
+  def __new__(cls, partitions):
+    self = super(PartitionTable, cls).__new__(cls, partitions)
+    self._by_num = {}
+    self._by_label = {}
+    self._by_type = collections.defaultdict(list)
+    self._metadata = None
+    for partition in self:
+      num = partition.get('num')
+      if num == 'metadata':
+        if self._metadata is None:
+          self._metadata = partition
+      elif num is not None:
+        self._by_num.setdefault(num, partition)
+      if 'label' in partition:
+        self._by_label.setdefault(partition['label'], partition)
+      self._by_type[partition.get('type')].append(partition)
+    return self
+
+  @classmethod
+  def Wrap(cls, partitions):
+    """Returns |partitions| as a PartitionTable, indexing it if needed."""
+    if isinstance(partitions, cls):
+      return partitions
+    return cls(partitions)
+
+  def GetByNumber(self, num):
+    """Returns the partition numbered |num|; see GetPartitionByNumber."""
+    partition = self._by_num.get(int(num))
+    if partition is None:
+      raise PartitionNotFound('Partition %s not found' % num)
+    return partition
+
+  def GetByLabel(self, label):
+    """Returns the partition labeled |label|; see GetPartitionByLabel."""
+    partition = self._by_label.get(label)
+    if partition is None:
+      raise PartitionNotFound('Partition "%s" not found' % label)
+    return partition
+
+  def GetByType(self, typename):
+    """Returns the partitions of a type; see GetPartitionsByType."""
+    return sorted(self._by_type.get(typename, ()),
+                  key=lambda partition: partition.get('num'))
+
+  def GetMetadata(self):
+    """Returns the metadata partition; see GetMetadataPartition."""
+    if self._metadata is None:
+      return {}
+    return self._metadata
+
+
 def GetPartitionTable(options, config, image_type):
   """Generates requested image_type layout from a layout configuration.
 
@@ -599,23 +1220,26 @@ def GetPartitionTable(options, config, image_type):
     image_type: Type of image eg base/test/dev/factory_install
 
   Returns:
-    Object representing a selected partition table
+    A PartitionTable representing the selected partition table
   """
 
-  # We make a deep copy so that changes to the dictionaries in this list do not
-  # persist across calls.
+  # Each partition is wrapped so that changes to it do not persist across
+  # calls, without copying the whole layout for every call.
   try:
-    partitions = copy.deepcopy(config['layouts'][image_type])
+    partitions = PartitionTable(Partition(partition)
+                                for partition in config['layouts'][image_type])
   except KeyError:
     raise InvalidLayout('Unknown layout: %s' % image_type)
   metadata = config['metadata']
 
-  # Convert fs_options to a string.
+  # Convert fs_options to a string.  Partitions without any are left alone
+  # so they keep sharing the partition of the layout; readers default to ''.
   for partition in partitions:
     fs_options = partition.get('fs_options', '')
     if isinstance(fs_options, dict):
       fs_format = partition.get('fs_format')
       fs_options = fs_options.get(fs_format, '')
+      partition['fs_options'] = fs_options
     elif not isinstance(fs_options, str):
       raise InvalidLayout('Partition number %s: fs_format must be a string or '
                           'dict, not %s' % (partition.get('num'),
@@ -623,7 +1247,6 @@ def GetPartitionTable(options, config, image_type):
     if '"' in fs_options or "'" in fs_options:
       raise InvalidLayout('Partition number %s: fs_format cannot have quotes' %
                           partition.get('num'))
-    partition['fs_options'] = fs_options
 
   for adjustment_str in options.adjust_part.split():
     adjustment = adjustment_str.split(':')
@@ -633,12 +1256,67 @@ def GetPartitionTable(options, config, image_type):
     label = adjustment[0]
     operator = adjustment[1][0]
     operand = adjustment[1][1:]
-    ApplyPartitionAdjustment(partitions, metadata, label, operator, operand)
+    ApplyPartitionAdjustment(partitions, metadata, label, operator, operand,
+                             hashpad=options.hashpad,
+                             hash_alg=options.verity_hash_alg)
 
   return partitions
 
 
-def ApplyPartitionAdjustment(partitions, metadata, label, operator, operand):
+def GetVerityHashTreeSize(fs_bytes, hash_alg=DEFAULT_VERITY_HASH_ALG):
+  """Returns the size of the dm-verity hash tree of a filesystem.
+
+  This is the size of the hash tree the verity tool of build_kernel_image.sh
+  writes after the filesystem: every block of the tree holds the digests of
+  as many blocks of the level below as a power of two allows, down to the
+  4 KiB blocks of the filesystem, and the root block is stored too.
+
+  Args:
+    fs_bytes: Size of the filesystem in bytes
+    hash_alg: The hash algorithm, e.g. sha256 or sha1
+
+  Returns:
+    Size of the hash tree in bytes
+  """
+  try:
+    digest_size = hashlib.new(hash_alg).digest_size
+  except ValueError:
+    raise InvalidHashAlgorithm('Unknown verity hash algorithm %s' % hash_alg)
+  # Digests per hash block, rounded down to a power of two.
+  shift = (VERITY_BLOCK_SIZE // digest_size).bit_length() - 1
+  last_block = max(1, -(-fs_bytes // VERITY_BLOCK_SIZE)) - 1
+  depth = max(1, -(-last_block.bit_length() // shift))
+  hash_blocks = sum((last_block >> (level * shift)) + 1
+                    for level in range(1, depth + 1))
+  return hash_blocks * VERITY_BLOCK_SIZE
+
+
+def GetHashpadBytes(fs_bytes, metadata, hashpad='legacy',
+                    hash_alg=DEFAULT_VERITY_HASH_ALG):
+  """Returns the room an adjusted rootfs partition keeps after its filesystem.
+
+  Args:
+    fs_bytes: Size of the filesystem in bytes
+    metadata: Partition table metadata
+    hashpad: One of HASHPAD_MODES: legacy pads the filesystem by 15%, exact
+      by its dm-verity hash tree rounded up to fs_align
+    hash_alg: The dm-verity hash algorithm, for the exact mode
+
+  Returns:
+    Size of the hashpad in bytes
+  """
+  if hashpad == 'legacy':
+    return int(fs_bytes * 1.15) - fs_bytes
+  if hashpad != 'exact':
+    raise InvalidAdjustment('Unknown hashpad mode %s' % hashpad)
+  tree_bytes = GetVerityHashTreeSize(fs_bytes, hash_alg)
+  fs_align = metadata['fs_align']
+  return -(-tree_bytes // fs_align) * fs_align
+
+
+def ApplyPartitionAdjustment(partitions, metadata, label, operator, operand,
+                             hashpad='legacy',
+                             hash_alg=DEFAULT_VERITY_HASH_ALG):
   """Applies an adjustment to a partition specified by label
 
   Args:
@@ -647,6 +1325,9 @@ def ApplyPartitionAdjustment(partitions, metadata, label, operator, operand):
     label: The label of the partition to adjust
     operator: Type of adjustment (+/-/=)
     operand: How much to adjust by
+    hashpad: How to size the hashpad of a rootfs partition, see
+      GetHashpadBytes
+    hash_alg: The dm-verity hash algorithm, see GetHashpadBytes
   """
 
   partition = GetPartitionByLabel(partitions, label)
@@ -668,7 +1349,17 @@ def ApplyPartitionAdjustment(partitions, metadata, label, operator, operand):
     # the hashpad.
     partition['fs_bytes'] = partition['bytes']
     partition['fs_blocks'] = partition['fs_bytes'] // metadata['fs_block_size']
-    partition['bytes'] = int(partition['bytes'] * 1.15)
+    partition['bytes'] += GetHashpadBytes(partition['fs_bytes'], metadata,
+                                          hashpad, hash_alg)
+
+def _GetAdjustOptions(options):
+  """Returns the flags in |options| which GetPartitionTable depends on.
+
+  They are passed to worker processes as a dict of picklable values.
+  """
+  return {'adjust_part': options.adjust_part, 'hashpad': options.hashpad,
+          'verity_hash_alg': options.verity_hash_alg}
+
 
 def GetPartitionTableFromConfig(options, layout_filename, image_type):
   """Loads a partition table and returns a given partition table type
@@ -679,12 +1370,17 @@ def GetPartitionTableFromConfig(options, layout_filename, image_type):
     image_type: The type of partition table to return
   """
 
-  config = LoadPartitionConfig(layout_filename)
+  config = LoadPartitionConfig(layout_filename, cache_dir=options.cache_dir)
   partitions = GetPartitionTable(options, config, image_type)
 
   return partitions
 
 
+def _GetScriptShellPath():
+  """Returns the path of the skeleton script for our output script."""
+  return os.path.join(os.path.dirname(__file__), 'cgpt_shell.sh')
+
+
 def GetScriptShell():
   """Loads and returns the skeleton script for our output script.
 
@@ -692,7 +1388,7 @@ def GetScriptShell():
     A string containing the skeleton script
   """
 
-  script_shell_path = os.path.join(os.path.dirname(__file__), 'cgpt_shell.sh')
+  script_shell_path = _GetScriptShellPath()
   with open(script_shell_path, 'r') as f:
     script_shell = ''.join(f.readlines())
 
@@ -741,6 +1437,88 @@ def GetFullPartitionSize(partition, metadata):
   return size
 
 
+def _GetKernelAttributes(partitions, func):
+  """Returns the (num, tries, priority) to set on every kernel partition.
+
+  Args:
+    partitions: Partition table as returned by GetPartitionTable
+    func: function of the layout, see WriteLayoutFunction
+  """
+  attributes = []
+  tries = 15
+  prio = 15
+  # The order of partition numbers in this loop matters.
+  # Make sure partition #2 is the first one, since it will be marked as
+  # default bootable partition.
+  for partition in GetPartitionsByType(partitions, 'kernel'):
+    attributes.append((partition['num'], tries, prio))
+    prio = 0
+    # When not writing 'base' function, make sure the other partitions are
+    # marked as non-bootable (retry count == 0), since the USB layout
+    # doesn't have any valid data in slots B & C. But with base function,
+    # called by chromeos-install script, the KERNEL A partition is replicated
+    # into both slots A & B, so we should leave both bootable for error
+    # recovery in this case.
+    if func != 'base':
+      tries = 0
+  return attributes
+
+
+def _GetSpecializedLayoutLines(config, partitions, block_size,
+                               kernel_attributes, efi_num):
+  """Returns the shell lines adding every partition for one block size.
+
+  The lines do what the generic lines of WriteLayoutFunction do once the
+  block size is known: partitions get literal start blocks and sizes, but for
+  the expanding partition and the one after it, and their attributes are set
+  by the same cgpt call adding them.
+
+  Args:
+    config: Partition configuration file object
+    partitions: Partition table as returned by GetPartitionTable
+    block_size: Logical block size of the disk in bytes
+    kernel_attributes: As returned by _GetKernelAttributes
+    efi_num: Number of the partition the PMBR boots, or None
+
+  Returns:
+    A list of lines, or None when the generic lines have to be used.
+  """
+  try:
+    placement = _PlacePartitions(config, partitions, block_size)
+  except InvalidLayout:
+    return None
+  if any(x['size'] is None and 'expand' not in x for x in placement):
+    return None
+
+  flags = {num: ' -S 0 -T %i -P %i' % (tries, prio)
+           for num, tries, prio in kernel_attributes}
+  if efi_num is not None:
+    flags[efi_num] = flags.get(efi_num, '') + ' -B 1'
+
+  gpt_add = '${GPT} add -i %d -b %s -s %s -t %s -l "%s"%s ${target}'
+  lines = []
+  for part in placement:
+    start = part['start']
+    size = part['size']
+    if part.get('expand'):
+      lines += ['blocks=$(( numsecs - %d ))' % part['reserved_blocks']]
+      size = '${blocks}'
+      expand_start = start
+    elif part.get('after_expand'):
+      start = '$(( %d + blocks ))' % (expand_start + start)
+    lines += [gpt_add % (part['num'], start, size, part['type'], part['label'],
+                         flags.pop(part['num'], ''))]
+  # Attributes of partitions not added here are set like in the generic lines.
+  for num, extra in sorted(flags.items()):
+    lines += ['${GPT} add -i %s%s ${target}' % (num, extra)]
+
+  if efi_num is not None:
+    lines += ['${GPT} boot -p -b $2 -i %d ${target}' % efi_num]
+  else:
+    lines += ['${GPT} boot -p -b $2 ${target}']
+  return lines
+
+
 def WriteLayoutFunction(options, sfile, func, image_type, config):
   """Writes a shell script function to write out a given partition table.
 
@@ -811,6 +1589,7 @@ def WriteLayoutFunction(options, sfile, func, image_type, config):
       _GetPrimaryEntryArrayPaddingBytes(config),
   ]
 
+  generic_start = len(lines)
   metadata = GetMetadataPartition(partitions)
   stateful = None
   last_part = None
@@ -877,25 +1656,11 @@ def WriteLayoutFunction(options, sfile, func, image_type, config):
     ]
 
   # Set default priorities and retry counter on kernel partitions.
-  tries = 15
-  prio = 15
-  # The order of partition numbers in this loop matters.
-  # Make sure partition #2 is the first one, since it will be marked as
-  # default bootable partition.
-  for partition in GetPartitionsByType(partitions, 'kernel'):
+  kernel_attributes = _GetKernelAttributes(partitions, func)
+  for num, tries, prio in kernel_attributes:
     lines += [
-        '${GPT} add -i %s -S 0 -T %i -P %i ${target}' %
-        (partition['num'], tries, prio)
+        '${GPT} add -i %s -S 0 -T %i -P %i ${target}' % (num, tries, prio)
     ]
-    prio = 0
-    # When not writing 'base' function, make sure the other partitions are
-    # marked as non-bootable (retry count == 0), since the USB layout
-    # doesn't have any valid data in slots B & C. But with base function,
-    # called by chromeos-install script, the KERNEL A partition is replicated
-    # into both slots A & B, so we should leave both bootable for error
-    # recovery in this case.
-    if func != 'base':
-      tries = 0
 
   efi_partitions = GetPartitionsByType(partitions, 'efi')
   if efi_partitions:
@@ -910,6 +1675,23 @@ def WriteLayoutFunction(options, sfile, func, image_type, config):
         '${GPT} boot -p -b $2 ${target}',
     ]
 
+  # For the usual block sizes, add a branch with the partitions placed in
+  # advance, leaving the arithmetic above for other block sizes.
+  generic = lines[generic_start:]
+  del lines[generic_start:]
+  specialized = []
+  for block_size in SPECIALIZED_BLOCK_SIZES:
+    branch = _GetSpecializedLayoutLines(
+        config, partitions, block_size, kernel_attributes,
+        efi_partitions[0]['num'] if efi_partitions else None)
+    if branch is not None:
+      specialized += ['%d)' % block_size] + ['  ' + x for x in branch + [';;']]
+  if specialized:
+    lines += ['case ${block_size} in'] + specialized + ['*)']
+    lines += ['  ' + x for x in generic + [';;']] + ['esac']
+  else:
+    lines += generic
+
   if metadata.get('hybrid_mbr'):
     lines += ['install_hybrid_mbr ${target}']
   lines += ['${GPT} show ${target}']
@@ -920,29 +1702,160 @@ def WriteLayoutFunction(options, sfile, func, image_type, config):
   sfile.write('%s\n}\n' % '\n  '.join(lines))
 
 
-def WritePartitionSizesFunction(options, sfile, func, image_type, config):
-  """Writes out the partition size variable that can be extracted by a caller.
+def _PlacePartitions(config, partitions, block_size):
+  """Places partitions like the generated write_*_table function does.
+
+  Everything but the expanding partition is placed the same way on any disk.
+  The expanding partition gets the blocks left on the disk minus its
+  'reserved_blocks', and a last partition placed after it has its 'start'
+  relative to the end of the expanding partition.
 
   Args:
-    options: Flags passed to the script
-    sfile: File handle we're writing to
-    func: function of the layout:
-       for removable storage device: 'partition',
-       for the fixed storage device: 'base'
-    image_type: Type of image eg base/test/dev/factory_install
     config: Partition configuration file object
+    partitions: Partition table as returned by GetPartitionTable
+    block_size: Logical block size of the disk in bytes
+
+  Returns:
+    A list of dicts with the num, label, type, start block and size in
+    blocks of every partition added to the GPT, in the order they are added.
+    The expanding partition has a size of None and is marked with 'expand',
+    and the partition after it with 'after_expand'.
   """
-  func_name = 'load_%s_vars' % func
-  lines = [
-      '%s() {' % func_name,
-      'DEFAULT_ROOTDEV="%s"' % config['metadata'].get('rootdev_%s' % func, ''),
-  ]
+  if block_size <= 0 or block_size & (block_size - 1):
+    raise InvalidSize('Block size %d is not a power of 2' % block_size)
+  if block_size > MAX_SECTOR_SIZE:
+    raise InvalidSize('Block size %d is larger than %d' %
+                      (block_size, MAX_SECTOR_SIZE))
+  if _GetPrimaryEntryArrayPaddingBytes(config) & (block_size - 1):
+    raise InvalidLayout('Primary Entry Array padding is not block aligned.')
+
+  fs_align = config['metadata']['fs_align']
+  def _AlignFs(curr):
+    if curr % fs_align:
+      curr += fs_align - curr % fs_align
+    return curr
+
+  def _Place(partition, curr, blocks, **kwargs):
+    placed = {
+        'num': partition['num'],
+        'label': partition['label'],
+        'type': partition['type'],
+        'start': curr // block_size,
+        'size': blocks,
+    }
+    placed.update(kwargs)
+    return placed
+
+  metadata = GetMetadataPartition(partitions)
+  curr = _GetPartitionStartByteOffset(config, partitions)
+  blocks = None
+  stateful = None
+  last_part = None
+  placement = []
 
-  partitions = GetPartitionTable(options, config, image_type)
   for partition in partitions:
     if partition.get('num') == 'metadata':
       continue
-    for key in ('label', 'num'):
+
+    size = GetFullPartitionSize(partition, metadata)
+    if 'expand' in partition['features']:
+      stateful = partition
+      continue
+    if 'last_partition' in partition['features']:
+      last_part = partition
+      continue
+
+    if partition.get('type') in ['data', 'rootfs'] and partition['bytes'] > 1:
+      curr = _AlignFs(curr)
+    # A partition of size 0 keeps the size of the one before it.
+    if size != 0:
+      blocks = (size + block_size - 1) // block_size
+    if partition['type'] != 'blank':
+      placement.append(_Place(partition, curr, blocks))
+    if size != 0:
+      curr += blocks * block_size
+
+  if last_part is not None:
+    reserved_blocks = ((GetFullPartitionSize(last_part, metadata) +
+                        block_size - 1) // block_size)
+
+  if stateful is not None:
+    curr = _AlignFs(curr)
+    reserved = (curr + SECONDARY_GPT_BYTES) // block_size
+    if last_part is not None:
+      reserved += reserved_blocks
+    placement.append(_Place(stateful, curr, None, expand=True,
+                            reserved_blocks=reserved))
+    if last_part is not None:
+      placement.append(_Place(last_part, 0, reserved_blocks,
+                              after_expand=True))
+  elif last_part is not None:
+    placement.append(_Place(last_part, curr, reserved_blocks))
+
+  return placement
+
+
+def PlanPartitionTable(config, partitions, disk_size, block_size):
+  """Computes where the function from WriteLayoutFunction places partitions.
+
+  This repeats the shell arithmetic of the generated write_*_table function
+  for a disk of |disk_size| bytes with |block_size| byte blocks, so offsets
+  are known without writing an image.  That includes its quirks: a partition
+  of size 0 is added with the size of the partition before it.
+
+  Args:
+    config: Partition configuration file object
+    partitions: Partition table as returned by GetPartitionTable
+    disk_size: Size of the disk in bytes
+    block_size: Logical block size of the disk in bytes
+
+  Returns:
+    A list of dicts with the num, label, type, start and end LBA (inclusive)
+    and size in blocks of every partition added to the GPT, in the order
+    they are added.
+  """
+  numsecs = disk_size // block_size
+  expand_end = None
+  plan = []
+  for part in _PlacePartitions(config, partitions, block_size):
+    part = dict(part)
+    if part.pop('expand', False):
+      part['size'] = numsecs - part.pop('reserved_blocks')
+      if part['size'] <= 0:
+        raise InvalidSize('Disk of %d bytes leaves no space for partition %s'
+                          % (disk_size, part['num']))
+      expand_end = part['start'] + part['size']
+    if part.pop('after_expand', False):
+      part['start'] += expand_end
+    part['end'] = None if part['size'] is None else (part['start'] +
+                                                     part['size'] - 1)
+    plan.append(part)
+  return plan
+
+
+def WritePartitionSizesFunction(options, sfile, func, image_type, config):
+  """Writes out the partition size variable that can be extracted by a caller.
+
+  Args:
+    options: Flags passed to the script
+    sfile: File handle we're writing to
+    func: function of the layout:
+       for removable storage device: 'partition',
+       for the fixed storage device: 'base'
+    image_type: Type of image eg base/test/dev/factory_install
+    config: Partition configuration file object
+  """
+  func_name = 'load_%s_vars' % func
+  lines = [
+      '%s() {' % func_name,
+      'DEFAULT_ROOTDEV="%s"' % config['metadata'].get('rootdev_%s' % func, ''),
+  ]
+
+  partitions = GetPartitionTable(options, config, image_type)
+  for partition in partitions:
+    if partition.get('num') == 'metadata':
+      continue
+    for key in ('label', 'num'):
       if key in partition:
         shell_label = str(partition[key]).replace('-', '_').upper()
         part_bytes = partition['bytes']
@@ -975,11 +1888,7 @@ def GetPartitionByNumber(partitions, num):
   Returns:
     An object for the selected partition
   """
-  for partition in partitions:
-    if partition.get('num') == int(num):
-      return partition
-
-  raise PartitionNotFound('Partition %s not found' % num)
+  return PartitionTable.Wrap(partitions).GetByNumber(num)
 
 
 def GetPartitionsByType(partitions, typename):
@@ -994,11 +1903,7 @@ def GetPartitionsByType(partitions, typename):
   Returns:
     A list of partitions of the type
   """
-  out = []
-  for partition in partitions:
-    if partition.get('type') == typename:
-      out.append(partition)
-  return sorted(out, key=lambda partition: partition.get('num'))
+  return PartitionTable.Wrap(partitions).GetByType(typename)
 
 
 def GetMetadataPartition(partitions):
@@ -1010,11 +1915,7 @@ def GetMetadataPartition(partitions):
   Returns:
     An object for the metadata partition
   """
-  for partition in partitions:
-    if partition.get('num') == 'metadata':
-      return partition
-
-  return {}
+  return PartitionTable.Wrap(partitions).GetMetadata()
 
 
 def GetPartitionByLabel(partitions, label):
@@ -1027,13 +1928,103 @@ def GetPartitionByLabel(partitions, label):
   Returns:
     An object for the selected partition
   """
-  for partition in partitions:
-    if 'label' not in partition:
-      continue
-    if partition['label'] == label:
-      return partition
+  return PartitionTable.Wrap(partitions).GetByLabel(label)
 
-  raise PartitionNotFound('Partition "%s" not found' % label)
+
+def _GetLayoutFunctions(options, func, image_type, config):
+  """Returns the shell functions the write command writes for one layout.
+
+  Args:
+    options: Flags passed to the script
+    func: function of the layout, see WriteLayoutFunction
+    image_type: Type of image eg base/test/dev/factory_install
+    config: Partition configuration file object
+  """
+  sfile = io.StringIO()
+  WriteLayoutFunction(options, sfile, func, image_type, config)
+  WritePartitionSizesFunction(options, sfile, func, image_type, config)
+  return sfile.getvalue()
+
+
+def _GetRootfsSizeLine(options, config):
+  """Returns the ROOTFS_PARTITION_SIZE line ending partition scripts."""
+  # TODO: Backwards compat.  Should be killed off once we update
+  #       cros_generate_update_payload to use the new code.
+  partitions = GetPartitionTable(options, config, BASE_LAYOUT)
+  partition = GetPartitionByLabel(partitions, 'ROOT-A')
+  return 'ROOTFS_PARTITION_SIZE=%s\n' % (partition['bytes'],)
+
+
+def _GetScriptFingerprint(options, image_type, loaded_files):
+  """Returns the fingerprint of everything a partition script is built from.
+
+  Args:
+    options: Flags passed to the script
+    image_type: Type of image the script is for
+    loaded_files: Absolute paths of every file the layout depends on; see
+      _LoadStackedPartitionConfig
+
+  Returns:
+    A hex digest string.
+  """
+  key = _GetConfigCacheKey([os.path.abspath(_GetScriptShellPath())] +
+                           loaded_files)
+  return hashlib.sha256(json.dumps(
+      [key, image_type, _GetAdjustOptions(options)]).encode('utf-8')
+  ).hexdigest()
+
+
+def _GetScriptFingerprintLines(options, image_type, loaded_files):
+  """Returns the comments recording the inputs of a partition script."""
+  return '# Layout files: %s\n# Fingerprint: %s\n\n' % (
+      json.dumps(loaded_files),
+      _GetScriptFingerprint(options, image_type, loaded_files))
+
+
+def _IsScriptUpToDate(options, image_type, layout_filename, sfilename):
+  """Checks whether |sfilename| was written from the current inputs.
+
+  Only the files recorded in the script are read: the layout isn't loaded.
+  Any change to the parent chain changes the contents of one of them, or
+  creates one of the parents recorded as missing next to their child.
+
+  Args:
+    options: Flags passed to the script
+    image_type: Type of image the script is for
+    layout_filename: Path to partition configuration file
+    sfilename: Filename of a script written by the write command
+
+  Returns:
+    True if writing the script again would not change it.
+  """
+  recorded = {}
+  try:
+    with open(sfilename) as f:
+      for line in f:
+        m = re.match(r'# (Layout files|Fingerprint): (.*)$', line)
+        if m:
+          recorded[m.group(1)] = m.group(2)
+          if len(recorded) == 2:
+            break
+    loaded_files = json.loads(recorded['Layout files'])
+    if loaded_files[-1] != os.path.abspath(layout_filename):
+      return False
+    return recorded['Fingerprint'] == _GetScriptFingerprint(
+        options, image_type, loaded_files)
+  except (OSError, ValueError, KeyError, IndexError, TypeError):
+    return False
+
+
+def _WriteFileAtomically(filename, data):
+  """Writes |data| to |filename| so readers never see a partial file."""
+  import tempfile
+
+  with tempfile.NamedTemporaryFile(
+      'w', dir=os.path.dirname(os.path.abspath(filename)),
+      prefix=os.path.basename(filename), suffix='.tmp', delete=False) as f:
+    f.write(data)
+  os.chmod(f.name, 0o644)
+  os.replace(f.name, filename)
 
 
 def WritePartitionScript(options, image_type, layout_filename, sfilename):
@@ -1043,26 +2034,208 @@ def WritePartitionScript(options, image_type, layout_filename, sfilename):
     options: Flags passed to the script
     image_type: Type of image eg base/test/dev/factory_install
     layout_filename: Path to partition configuration file
-    sfilename: Filename to write the finished script to
+    sfilename: Filename to write the finished script to.  With --if_changed
+      it is left alone when it was written from the same inputs.
   """
-  config = LoadPartitionConfig(layout_filename)
+  if options.if_changed and _IsScriptUpToDate(options, image_type,
+                                              layout_filename, sfilename):
+    return
+
+  loaded_files = []
+  config = LoadPartitionConfig(layout_filename, cache_dir=options.cache_dir,
+                               loaded_files=loaded_files)
 
   with open(sfilename, 'w') as f:
-    script_shell = GetScriptShell()
-    f.write(script_shell)
+    f.write(GetScriptShell())
+    f.write(_GetScriptFingerprintLines(options, image_type, loaded_files))
+    f.write(_GetLayoutFunctions(options, 'base', BASE_LAYOUT, config))
+    f.write(_GetLayoutFunctions(options, 'partition', image_type, config))
+    f.write(_GetRootfsSizeLine(options, config))
 
-    for func, layout in (('base', BASE_LAYOUT), ('partition', image_type)):
-      WriteLayoutFunction(options, f, func, layout, config)
-      WritePartitionSizesFunction(options, f, func, layout, config)
 
-    # TODO: Backwards compat.  Should be killed off once we update
-    #       cros_generate_update_payload to use the new code.
-    partitions = GetPartitionTable(options, config, BASE_LAYOUT)
-    partition = GetPartitionByLabel(partitions, 'ROOT-A')
-    f.write('ROOTFS_PARTITION_SIZE=%s\n' % (partition['bytes'],))
+def WritePartitionScripts(options, image_types, layout_filename, output_dir):
+  """Writes the script of the write command for many image types at once.
 
+  The layout is loaded and the base layout functions generated only once,
+  and each script is written to a temporary file renamed into place, so
+  builds running in parallel can read them at any time.
 
-def GetBlockSize(_options, layout_filename):
+  Args:
+    options: Flags passed to the script
+    image_types: Image types separated by commas or spaces, or ALL
+    layout_filename: Path to partition configuration file
+    output_dir: Directory to write write_gpt_<image_type>.sh scripts to.
+      With --if_changed scripts written from the same inputs are left alone.
+  """
+  loaded_files = []
+  config = None
+  if image_types == 'ALL':
+    config = LoadPartitionConfig(layout_filename, cache_dir=options.cache_dir,
+                                 loaded_files=loaded_files)
+    image_types = _ListImageTypes(config)
+  else:
+    image_types = image_types.replace(',', ' ').split()
+
+  paths = dict((x, os.path.join(output_dir, 'write_gpt_%s.sh' % x))
+               for x in image_types)
+  if options.if_changed:
+    image_types = [x for x in image_types if not _IsScriptUpToDate(
+        options, x, layout_filename, paths[x])]
+    if not image_types:
+      return
+  if config is None:
+    config = LoadPartitionConfig(layout_filename, cache_dir=options.cache_dir,
+                                 loaded_files=loaded_files)
+
+  shell = GetScriptShell()
+  base = _GetLayoutFunctions(options, 'base', BASE_LAYOUT, config)
+  tail = _GetRootfsSizeLine(options, config)
+  # Generate everything first so an invalid image type writes nothing.
+  scripts = [(image_type, shell +
+              _GetScriptFingerprintLines(options, image_type, loaded_files) +
+              base +
+              _GetLayoutFunctions(options, 'partition', image_type, config) +
+              tail)
+             for image_type in image_types]
+
+  os.makedirs(output_dir, exist_ok=True)
+  for image_type, script in scripts:
+    _WriteFileAtomically(paths[image_type], script)
+
+
+def WriteGptImage(options, func, image_type, layout_filename, target,
+                  pmbr_code):
+  """Writes the partition table of a layout to an image without cgpt.
+
+  The result is the one of the write command's write_<func>_table function,
+  but the tables are built in Python and written once instead of being
+  rewritten by every cgpt call.  Like that function, a missing target file
+  is created with the minimum size of the layout (or --disk_size), and the
+  target of an external GPT is the GPT file read from flash.
+
+  Args:
+    options: Flags passed to the script
+    func: Function of the layout to write: partition or base
+    image_type: Type of image eg base/test/dev/factory_install
+    layout_filename: Path to partition configuration file
+    target: Image file, block device or external GPT file to write to
+    pmbr_code: Path to the boot code for the protective MBR
+  """
+  import gpt_image
+
+  if func not in ('base', 'partition'):
+    raise InvalidLayout('Unknown layout function %s; expected base or '
+                        'partition' % func)
+  config = LoadPartitionConfig(layout_filename, cache_dir=options.cache_dir)
+  partitions = GetPartitionTable(options, config, image_type)
+  metadata = GetMetadataPartition(partitions)
+  if metadata.get('hybrid_mbr'):
+    raise InvalidLayout('Hybrid MBRs are only supported by the write command')
+  block_size = ParseHumanNumber(options.block_size)
+
+  gpt_blocks = None
+  if _HasExternalGpt(partitions):
+    drive_size = metadata['bytes']
+    gpt_size = os.path.getsize(target)
+    gpt_blocks = gpt_size // block_size
+    # Start from a blank GPT file like the shell function does.
+    with open(target, 'r+b') as f:
+      f.write(b'\0' * gpt_size)
+  else:
+    if not os.path.exists(target):
+      if options.disk_size is None:
+        disk_size = GetTableTotals(config, partitions)['min_disk_size']
+      else:
+        disk_size = ParseHumanNumber(options.disk_size)
+      with open(target, 'wb') as f:
+        f.truncate((disk_size + 511) & ~511)
+    with open(target, 'rb') as f:
+      drive_size = f.seek(0, os.SEEK_END)
+
+  kernels = dict((num, (tries, prio)) for num, tries, prio in
+                 _GetKernelAttributes(partitions, func))
+  efi = [x['num'] for x in GetPartitionsByType(partitions, 'efi')][:1]
+  gpt_partitions = []
+  for part in PlanPartitionTable(config, partitions, drive_size, block_size):
+    if part['size'] is None:
+      raise InvalidLayout('Partition %s has no size' % part['num'])
+    tries, prio = kernels.get(part['num'], (0, 0))
+    gpt_partitions.append(gpt_image.Partition(
+        num=part['num'], type=part['type'], label=part['label'],
+        start=part['start'], end=part['end'], priority=prio, tries=tries,
+        legacy_boot=part['num'] in efi))
+
+  with open(pmbr_code, 'rb') as f:
+    bootcode = f.read(gpt_image.MBR_SIZE)
+  gpt_image.WriteGpt(
+      target, block_size, drive_size // block_size, gpt_partitions,
+      padding_blocks=_GetPrimaryEntryArrayPaddingBytes(config) // block_size,
+      gpt_blocks=gpt_blocks, bootcode=bootcode,
+      boot_num=efi[0] if efi else None)
+
+
+def ReadImage(options, image):
+  """Returns every partition in the GPT of an image.
+
+  The GPT is read once, instead of running cgpt show for every field of
+  every partition.  In shell mode each value is stored as
+  CGPT_IMAGE_<NUM>_<LABEL|TYPE|UUID|START|SIZE|ATTR>, with START and SIZE in
+  blocks and TYPE and UUID as GUIDs, and partition numbers are also
+  available by label as CGPT_IMAGE_NUM_<LABEL>.
+
+  Args:
+    options: Flags passed to the script
+    image: Image file or block device to read
+
+  Returns:
+    Shell-evaluable assignments, or JSON with --output_format=json.
+  """
+  import gpt_image
+
+  gpt = gpt_image.ReadGpt(image)
+  data = [{
+      'num': part.num,
+      'label': part.label,
+      'type': part.type,
+      'uuid': part.unique_guid,
+      'start': part.start,
+      'size': part.end - part.start + 1,
+      'attributes': gpt_image.GetAttributes(part),
+  } for part in gpt.partitions]
+
+  if options.output_format == 'json':
+    return json.dumps({'block_size': gpt.block_size,
+                       'disk_uuid': str(gpt.disk_guid).upper(),
+                       'partitions': data}, indent=2, sort_keys=True)
+
+  fields = (
+      ('LABEL', 'label'),
+      ('TYPE', 'type'),
+      ('UUID', 'uuid'),
+      ('START', 'start'),
+      ('SIZE', 'size'),
+  )
+  assignments = [
+      ('CGPT_IMAGE_BLOCK_SIZE', gpt.block_size),
+      ('CGPT_IMAGE_DISK_UUID', str(gpt.disk_guid).upper()),
+      ('CGPT_IMAGE_PARTITIONS', ' '.join(str(x['num']) for x in data)),
+  ]
+  for part in data:
+    for var, key in fields:
+      assignments.append((_ShellVarName('CGPT_IMAGE', part['num'], var),
+                          part[key]))
+    assignments.append((_ShellVarName('CGPT_IMAGE', part['num'], 'ATTR'),
+                        '0x%x' % part['attributes']))
+  labels = set()
+  for part in data:
+    if part['label'] not in labels:
+      labels.add(part['label'])
+      assignments.append((_ShellVarName('CGPT_IMAGE_NUM', part['label']),
+                          part['num']))
+  return _FormatShellAssignments(assignments)
+
+
+def GetBlockSize(options, layout_filename):
   """Returns the partition table block size.
 
   Args:
@@ -1073,11 +2246,11 @@ def GetBlockSize(_options, layout_filename):
     Block size of all partitions in the layout
   """
 
-  config = LoadPartitionConfig(layout_filename)
+  config = LoadPartitionConfig(layout_filename, cache_dir=options.cache_dir)
   return config['metadata']['block_size']
 
 
-def GetFilesystemBlockSize(_options, layout_filename):
+def GetFilesystemBlockSize(options, layout_filename):
   """Returns the filesystem block size.
 
   This is used for all partitions in the table that have filesystems.
@@ -1090,11 +2263,11 @@ def GetFilesystemBlockSize(_options, layout_filename):
     Block size of all filesystems in the layout
   """
 
-  config = LoadPartitionConfig(layout_filename)
+  config = LoadPartitionConfig(layout_filename, cache_dir=options.cache_dir)
   return config['metadata']['fs_block_size']
 
 
-def GetImageTypes(_options, layout_filename):
+def GetImageTypes(options, layout_filename):
   """Returns a list of all the image types in the layout.
 
   Args:
@@ -1105,10 +2278,15 @@ def GetImageTypes(_options, layout_filename):
     List of all image types
   """
 
-  config = LoadPartitionConfig(layout_filename)
+  config = LoadPartitionConfig(layout_filename, cache_dir=options.cache_dir)
   return ' '.join(config['layouts'].keys())
 
 
+def _ListImageTypes(config):
+  """Returns the image types of a loaded layout, but common and _comment."""
+  return [x for x in config['layouts'] if x not in (COMMON_LAYOUT, '_comment')]
+
+
 def GetType(options, image_type, layout_filename, num):
   """Returns the type of a given partition for a given layout.
 
@@ -1232,7 +2410,7 @@ def GetFilesystemOptions(options, image_type, layout_filename, num):
   partitions = GetPartitionTableFromConfig(options, layout_filename, image_type)
   partition = GetPartitionByNumber(partitions, num)
 
-  return partition.get('fs_options')
+  return partition.get('fs_options', '')
 
 
 def GetFilesystemSize(options, image_type, layout_filename, num):
@@ -1259,6 +2437,80 @@ def GetFilesystemSize(options, image_type, layout_filename, num):
     return partition['bytes']
 
 
+def GetHashpadSize(options, image_type, layout_filename, num):
+  """Returns the hashpad size --adjust_part gives a rootfs partition.
+
+  This is the room kept after the filesystem of the partition, were it
+  adjusted to its current filesystem size, for the --hashpad mode.
+
+  Args:
+    options: Flags passed to the script
+    image_type: Type of image eg base/test/dev/factory_install
+    layout_filename: Path to partition configuration file
+    num: Number of the partition you want to read from
+
+  Returns:
+    Size of the hashpad in bytes
+  """
+
+  config = LoadPartitionConfig(layout_filename, cache_dir=options.cache_dir)
+  partitions = GetPartitionTable(options, config, image_type)
+  partition = GetPartitionByNumber(partitions, num)
+  if partition['type'] != 'rootfs':
+    raise InvalidLayout('Partition %s is not a rootfs partition' % num)
+
+  return GetHashpadBytes(partition.get('fs_bytes', partition['bytes']),
+                         config['metadata'], options.hashpad,
+                         options.verity_hash_alg)
+
+
+def ReportHashpadSavings(options, layout_filename):
+  """Reports the bytes --hashpad=exact saves over legacy in each layout.
+
+  For every rootfs partition, both hashpads are sized for its current
+  filesystem size, as --adjust_part would pad it, and their difference is
+  summed over each image type.
+
+  Args:
+    options: Flags passed to the script
+    layout_filename: Path to partition configuration file
+
+  Returns:
+    Shell-evaluable assignments, or JSON with --output_format=json.
+  """
+  config = LoadPartitionConfig(layout_filename, cache_dir=options.cache_dir)
+  metadata = config['metadata']
+  report = []
+  for image_type in _ListImageTypes(config):
+    partitions = []
+    for partition in GetPartitionTable(options, config, image_type):
+      if partition.get('type') != 'rootfs':
+        continue
+      fs_bytes = partition.get('fs_bytes', partition['bytes'])
+      legacy = GetHashpadBytes(fs_bytes, metadata, 'legacy')
+      exact = GetHashpadBytes(fs_bytes, metadata, 'exact',
+                              options.verity_hash_alg)
+      partitions.append({'num': partition['num'],
+                         'label': partition['label'], 'fs_bytes': fs_bytes,
+                         'legacy': legacy, 'exact': exact,
+                         'saved': legacy - exact})
+    report.append({'image_type': image_type, 'partitions': partitions,
+                   'saved': sum(x['saved'] for x in partitions)})
+
+  if options.output_format == 'json':
+    return json.dumps({'layout': layout_filename, 'image_types': report})
+  assignments = []
+  for layout in report:
+    prefix = _ShellVarName('CGPT', layout['image_type'])
+    for part in layout['partitions']:
+      for key in ('legacy', 'exact'):
+        assignments.append((_ShellVarName(prefix, part['num'], key, 'HASHPAD'),
+                            part[key]))
+    assignments.append((_ShellVarName(prefix, 'HASHPAD_SAVED'),
+                        layout['saved']))
+  return _FormatShellAssignments(assignments)
+
+
 def GetLabel(options, image_type, layout_filename, num):
   """Returns the label for a given partition.
 
@@ -1319,6 +2571,213 @@ def GetReservedEraseBlocks(options, image_type, layout_filename, num):
     return 0
 
 
+def _ShellVarName(*parts):
+  """Builds a shell variable name from |parts|.
+
+  Every character that is not valid in a shell variable name is replaced with
+  an underscore, and the result is upper cased.  disk_layout_util.sh applies
+  the same transformation when it looks the variables up.
+  """
+  name = '_'.join(str(x) for x in parts)
+  return re.sub(r'[^A-Za-z0-9_]', '_', name).upper()
+
+
+def _FormatShellAssignments(assignments):
+  """Formats (name, value) pairs as shell-evaluable assignments.
+
+  Args:
+    assignments: A list of (name, value) tuples.  None values become ''.
+
+  Returns:
+    A string with one NAME=value line per assignment.
+  """
+  return '\n'.join(
+      '%s=%s' % (name, shlex.quote('' if value is None else str(value)))
+      for name, value in assignments)
+
+
+def _GetPartitionQueryData(partitions):
+  """Collects every per-partition attribute answered by the read* commands.
+
+  Args:
+    partitions: Partition table as returned by GetPartitionTable.
+
+  Returns:
+    A list of dicts, one per numbered partition, in on-disk order.
+  """
+  data = []
+  seen_nums = set()
+  for partition in partitions:
+    num = partition.get('num')
+    if num is None or num == 'metadata' or num in seen_nums:
+      continue
+    # GetPartitionByNumber returns the first match, so do the same here.
+    seen_nums.add(num)
+    data.append({
+        'num': num,
+        'label': partition.get('label', 'UNTITLED'),
+        'type': partition.get('type'),
+        'size': partition['bytes'],
+        'fs_size': partition.get('fs_bytes', partition['bytes']),
+        'format': partition.get('format'),
+        'fs_format': partition.get('fs_format'),
+        'fs_options': partition.get('fs_options', ''),
+        'uuid': partition.get('uuid', 'random'),
+        'reserved_erase_blocks': partition.get('reserved_erase_blocks', 0),
+    })
+  return data
+
+
+def GetPartitionQuery(options, image_type, layout_filename):
+  """Returns every partition attribute for a layout in one go.
+
+  The output answers all of the per-partition read* commands at once, so
+  callers can resolve the layout a single time instead of once per question.
+  In shell mode each value is stored as CGPT_<IMAGE_TYPE>_<NUM>_<FIELD>, and
+  partition numbers are also available by label as
+  CGPT_<IMAGE_TYPE>_NUM_<LABEL>.
+
+  Args:
+    options: Flags passed to the script
+    image_type: Type of image eg base/test/dev/factory_install
+    layout_filename: Path to partition configuration file
+
+  Returns:
+    Shell-evaluable assignments, or JSON with --output_format=json.
+  """
+  partitions = GetPartitionTableFromConfig(options, layout_filename, image_type)
+  data = _GetPartitionQueryData(partitions)
+
+  if options.output_format == 'json':
+    return json.dumps({'image_type': image_type, 'partitions': data},
+                      indent=2, sort_keys=True)
+
+  fields = (
+      ('LABEL', 'label'),
+      ('TYPE', 'type'),
+      ('SIZE', 'size'),
+      ('FS_SIZE', 'fs_size'),
+      ('FORMAT', 'format'),
+      ('FS_FORMAT', 'fs_format'),
+      ('FS_OPTIONS', 'fs_options'),
+      ('UUID', 'uuid'),
+      ('RESERVED_EBS', 'reserved_erase_blocks'),
+  )
+  prefix = _ShellVarName('CGPT', image_type)
+  assignments = [
+      (prefix + '_PARTITIONS', ' '.join(str(x['num']) for x in data)),
+  ]
+  for part in data:
+    for var, key in fields:
+      assignments.append((_ShellVarName(prefix, part['num'], var), part[key]))
+
+  # GetPartitionByLabel returns the first match, so do the same here.
+  labels = set()
+  for partition in partitions:
+    if 'label' in partition and partition['label'] not in labels:
+      labels.add(partition['label'])
+      assignments.append((_ShellVarName(prefix, 'NUM', partition['label']),
+                          partition.get('num')))
+  assignments.append((prefix + '_LOADED', 1))
+  return _FormatShellAssignments(assignments)
+
+
+def GetPartitionPlan(options, image_type, layout_filename):
+  """Returns the start, size and end of every partition on a disk.
+
+  The placement is the one the write command's script would make on a disk
+  of --disk_size bytes (default: the image it creates) with --block_size
+  byte blocks.  In shell mode each value is stored as
+  CGPT_<IMAGE_TYPE>_<NUM>_<START|BLOCKS|END>, in blocks.
+
+  Args:
+    options: Flags passed to the script
+    image_type: Type of image eg base/test/dev/factory_install
+    layout_filename: Path to partition configuration file
+
+  Returns:
+    Shell-evaluable assignments, or JSON with --output_format=json.
+  """
+  config = LoadPartitionConfig(layout_filename, cache_dir=options.cache_dir)
+  partitions = GetPartitionTable(options, config, image_type)
+  if options.disk_size is None:
+    # create_image makes images of the minimum size rounded up to 512 bytes.
+    disk_size = GetTableTotals(config, partitions)['min_disk_size']
+    disk_size = (disk_size + 511) & ~511
+  else:
+    disk_size = ParseHumanNumber(options.disk_size)
+  block_size = ParseHumanNumber(options.block_size)
+  plan = PlanPartitionTable(config, partitions, disk_size, block_size)
+  return _FormatPartitionPlan(options, image_type, disk_size, block_size, plan)
+
+
+def GetVmLayout(options, image_type, layout_filename, stateful_size):
+  """Returns the smallest disk, and its placement, for a given stateful size.
+
+  The disk is the smallest on which the write command's script gives the
+  expanding partition at least |stateful_size| bytes with --block_size byte
+  blocks; the script's placement on it is returned like the plan command's.
+  An image created at that size, e.g. by image_to_vm.sh, needs no room for
+  alignment losses, unlike the one the script creates.
+
+  Args:
+    options: Flags passed to the script
+    image_type: Type of image eg base/test/dev/factory_install
+    layout_filename: Path to partition configuration file
+    stateful_size: Size the expanding partition must have
+
+  Returns:
+    Shell-evaluable assignments, or JSON with --output_format=json.
+  """
+  config = LoadPartitionConfig(layout_filename, cache_dir=options.cache_dir)
+  partitions = GetPartitionTable(options, config, image_type)
+  block_size = ParseHumanNumber(options.block_size)
+  stateful_bytes = ParseHumanNumber(stateful_size)
+  if stateful_bytes <= 0:
+    raise InvalidSize('Stateful size "%s" must be positive' % stateful_size)
+
+  placement = _PlacePartitions(config, partitions, block_size)
+  expand = [x for x in placement if x.get('expand')]
+  if not expand:
+    raise InvalidLayout('Layout %s has no expanding partition' % image_type)
+  # The expanding partition gets the blocks of the disk it doesn't reserve,
+  # and create_image makes images of whole 512 byte sectors.
+  numsecs = expand[0]['reserved_blocks'] + -(-stateful_bytes // block_size)
+  disk_size = (numsecs * block_size + 511) & ~511
+  plan = PlanPartitionTable(config, partitions, disk_size, block_size)
+  return _FormatPartitionPlan(options, image_type, disk_size, block_size, plan)
+
+
+def _FormatPartitionPlan(options, image_type, disk_size, block_size, plan):
+  """Formats a plan from PlanPartitionTable for the plan and vmlayout commands.
+
+  Args:
+    options: Flags passed to the script
+    image_type: Type of image eg base/test/dev/factory_install
+    disk_size: Size of the disk in bytes
+    block_size: Logical block size of the disk in bytes
+    plan: The placement returned by PlanPartitionTable
+
+  Returns:
+    Shell-evaluable assignments, or JSON with --output_format=json.
+  """
+  if options.output_format == 'json':
+    return json.dumps({'image_type': image_type, 'disk_size': disk_size,
+                       'block_size': block_size, 'partitions': plan},
+                      indent=2, sort_keys=True)
+
+  prefix = _ShellVarName('CGPT', image_type)
+  assignments = [
+      (prefix + '_DISK_SIZE', disk_size),
+      (prefix + '_BLOCK_SIZE', block_size),
+      (prefix + '_PARTITIONS', ' '.join(str(x['num']) for x in plan)),
+  ]
+  for part in plan:
+    for var, key in (('START', 'start'), ('BLOCKS', 'size'), ('END', 'end')):
+      assignments.append((_ShellVarName(prefix, part['num'], var), part[key]))
+  return _FormatShellAssignments(assignments)
+
+
 def _DumpLayout(options, config, image_type):
   """Prints out a human readable disk layout in on-disk order.
 
@@ -1373,7 +2832,7 @@ def DoDebugOutput(options, layout_filename, image_type):
     print(GetImageTypes(options, layout_filename))
     return
 
-  config = LoadPartitionConfig(layout_filename)
+  config = LoadPartitionConfig(layout_filename, cache_dir=options.cache_dir)
 
   # Print out non-layout options first.
   print('Config Data')
@@ -1435,6 +2894,102 @@ def Combinations(n, k):
   return math.factorial(n) // (math.factorial(k) * math.factorial(n - k))
 
 
+def _LogCombinations(n, k):
+  """Returns the natural logarithm of Combinations(n, k), for 0 <= k <= n."""
+  return math.lgamma(n + 1) - math.lgamma(k + 1) - math.lgamma(n - k + 1)
+
+
+@functools.lru_cache(maxsize=None)
+def BadBlockFailureProbability(device_blocks, device_bad_blocks,
+                               partition_blocks, reserved):
+  """Calculates the probability of too many bad blocks in a partition.
+
+  Assuming device_bad_blocks bad blocks are uniformly randomly distributed
+  over the device, the number of them inside the partition follows a
+  hypergeometric distribution, and this sums its tail above |reserved|.
+
+  Rather than summing ratios of huge binomial coefficients, the term nearest
+  to the mode is computed in log space and the others from it with the ratio
+  of consecutive terms, stopping once they no longer change the sum.  The
+  tail on the far side of the mode is summed directly, the other one through
+  its complement, so the summed terms always shrink.
+
+  Results are memoized: partitions of the same size on a device share them.
+
+  Args:
+    device_blocks: Number of erase blocks of the device
+    device_bad_blocks: Maximum number of bad erase blocks of the device
+    partition_blocks: Number of erase blocks of the partition
+    reserved: Number of erase blocks the partition reserves for bad blocks
+
+  Returns:
+    The probability that more than |reserved| bad blocks are in the partition.
+  """
+  n, bad = partition_blocks, device_bad_blocks
+  good = device_blocks - partition_blocks - device_bad_blocks
+  lowest = max(0, -good)
+  highest = min(n, bad)
+  if reserved >= highest:
+    return 0.0
+  if reserved < lowest:
+    return 1.0
+
+  def _Term(k):
+    return math.exp(_LogCombinations(n, k) +
+                    _LogCombinations(device_blocks - n, bad - k) -
+                    _LogCombinations(device_blocks, bad))
+
+  total = 0.0
+  mode = (n + 1) * (bad + 1) // (device_blocks + 2)
+  if reserved >= mode:
+    k = reserved + 1
+    term = _Term(k)
+    while k <= highest and total + term != total:
+      total += term
+      term *= (n - k) * (bad - k) / ((k + 1) * (good + k + 1))
+      k += 1
+    return total
+
+  k = reserved
+  term = _Term(k)
+  while k >= lowest and total + term != total:
+    total += term
+    term *= k * (good + k) / ((n - k + 1) * (bad - k + 1))
+    k -= 1
+  return max(0.0, 1.0 - total)
+
+
+def _GetBadBlockCounts(partitions, partition):
+  """Returns the erase block counts the bad blocks of a partition depend on.
+
+  Args:
+    partitions: List of partitions to search in
+    partition: The UBI or NAND partition
+
+  Returns:
+    A (device_blocks, device_bad_blocks, partition_blocks) tuple.
+  """
+  metadata = GetMetadataPartition(partitions)
+  if (not _HasBadEraseBlocks(partitions)
+      or 'bytes' not in metadata
+      or 'erase_block_size' not in metadata
+      or 'page_size' not in metadata):
+    raise MissingEraseBlockField(
+        'unable to check if partition %s will have too many bad blocks due '
+        'to missing metadata field' % partition['label'])
+  erase_block_size = metadata['erase_block_size']
+  return (metadata['bytes'] // erase_block_size,
+          metadata['max_bad_erase_blocks'],
+          partition['bytes'] // erase_block_size)
+
+
+def _HasReservedEraseBlocks(partition):
+  """Returns whether bad blocks must be reserved in |partition|."""
+  return (('reserved_erase_blocks' in partition or
+           partition.get('format') in ('ubi', 'nand')) and
+          partition.get('bytes', 0) != 0)
+
+
 def CheckReservedEraseBlocks(partitions):
   """Checks that the reserved_erase_blocks in each partition is good.
 
@@ -1449,51 +3004,286 @@ def CheckReservedEraseBlocks(partitions):
   rather than just calculating the value so that it can be tweaked
   explicitly along with others in squeezing the image onto flash. But
   we check it so that users have an easy method for determining what's
-  acceptable--just try out a new value and do ./build_image.
+  acceptable--run the solvereserve command, or just try out a new value and
+  do ./build_image.
   """
   for partition in partitions:
-    if ('reserved_erase_blocks' in partition or
-        partition.get('format') in ('ubi', 'nand')):
-      if partition.get('bytes', 0) == 0:
-        continue
-      metadata = GetMetadataPartition(partitions)
-      if (not _HasBadEraseBlocks(partitions)
-          or 'reserved_erase_blocks' not in partition
-          or 'bytes' not in metadata
-          or 'erase_block_size' not in metadata
-          or 'page_size' not in metadata):
+    if _HasReservedEraseBlocks(partition):
+      if 'reserved_erase_blocks' not in partition:
         raise MissingEraseBlockField(
             'unable to check if partition %s will have too many bad blocks due '
             'to missing metadata field' % partition['label'])
-
-      reserved = partition['reserved_erase_blocks']
-      erase_block_size = metadata['erase_block_size']
-      device_erase_blocks = metadata['bytes'] // erase_block_size
-      device_bad_blocks = metadata['max_bad_erase_blocks']
-      distributions = Combinations(device_erase_blocks, device_bad_blocks)
-      partition_erase_blocks = partition['bytes'] // erase_block_size
-      # The idea is to calculate the number of ways that there could be reserved
-      # or more bad blocks inside the partition, assuming that there are
-      # device_bad_blocks in the device in total (the worst case). To get the
-      # probability, we divide this count by the total number of ways that the
-      # bad blocks can be distributed on the whole device. To find the first
-      # number, we sum over increasing values for the count of bad blocks within
-      # the partition the number of ways that those bad blocks can be inside the
-      # partition, multiplied by the number of ways that the remaining blocks
-      # can be distributed outside of the partition.
-      ways_for_failure = sum(
-          Combinations(partition_erase_blocks, partition_bad_blocks) *
-          Combinations(device_erase_blocks - partition_erase_blocks,
-                       device_bad_blocks - partition_bad_blocks)
-          for partition_bad_blocks
-          in range(reserved + 1, device_bad_blocks + 1))
-      probability = ways_for_failure / distributions
-      if probability > 0.00001:
+      counts = _GetBadBlockCounts(partitions, partition)
+      probability = BadBlockFailureProbability(
+          *counts, partition['reserved_erase_blocks'])
+      if probability > MAX_BAD_BLOCK_PROBABILITY:
         raise ExcessFailureProbability('excessive probability %f of too many '
                                        'bad blocks in partition %s'
                                        % (probability, partition['label']))
 
 
+def SolveReservedEraseBlocks(options, image_type, layout_filename):
+  """Finds the fewest erase blocks each UBI or NAND partition must reserve.
+
+  This is the smallest reserved_erase_blocks which CheckReservedEraseBlocks
+  accepts for each partition.
+
+  Args:
+    options: Flags passed to the script
+    image_type: Type of image eg base/test/dev/factory_install
+    layout_filename: Path to partition configuration file
+
+  Returns:
+    Shell-evaluable assignments, or JSON with --output_format=json.
+  """
+  partitions = GetPartitionTableFromConfig(options, layout_filename, image_type)
+  solved = []
+  for partition in partitions:
+    if not _HasReservedEraseBlocks(partition):
+      continue
+    counts = _GetBadBlockCounts(partitions, partition)
+    # The probability only shrinks as more blocks are reserved.
+    low, high = 0, min(counts[1:])
+    while low < high:
+      mid = (low + high) // 2
+      if BadBlockFailureProbability(*counts, mid) > MAX_BAD_BLOCK_PROBABILITY:
+        low = mid + 1
+      else:
+        high = mid
+    solved.append({'num': partition['num'], 'label': partition['label'],
+                   'reserved_erase_blocks': low,
+                   'configured': partition.get('reserved_erase_blocks')})
+
+  if options.output_format == 'json':
+    return json.dumps({'image_type': image_type, 'partitions': solved})
+  prefix = _ShellVarName('CGPT', image_type)
+  return _FormatShellAssignments(
+      [(_ShellVarName(prefix, x['num'], 'RESERVED_ERASE_BLOCKS'),
+        x['reserved_erase_blocks']) for x in solved])
+
+
+def GetContentSize(path, fs_block_size):
+  """Estimates the filesystem space taken by the files under a directory.
+
+  Every regular file is rounded up to whole filesystem blocks and counted
+  once however many hard links it has, and every directory and symlink takes
+  one block.  Filesystem metadata, e.g. inode tables, is left to the headroom
+  of the fit command.  Mount points under |path| are not descended into.
+
+  Args:
+    path: The directory, e.g. a staged rootfs
+    fs_block_size: Filesystem block size in bytes
+
+  Returns:
+    The estimated size in bytes
+  """
+  def _RaiseError(e):
+    raise e
+
+  device = os.lstat(path).st_dev
+  seen = set()
+  blocks = 0
+  for dirpath, dirnames, filenames in os.walk(path, onerror=_RaiseError):
+    blocks += 1
+    for name in filenames + dirnames:
+      st = os.lstat(os.path.join(dirpath, name))
+      if stat.S_ISREG(st.st_mode):
+        if (st.st_dev, st.st_ino) not in seen:
+          seen.add((st.st_dev, st.st_ino))
+          blocks += -(-st.st_size // fs_block_size)
+      elif stat.S_ISLNK(st.st_mode):
+        blocks += 1
+    dirnames[:] = [x for x in dirnames
+                   if not os.path.islink(os.path.join(dirpath, x)) and
+                   os.lstat(os.path.join(dirpath, x)).st_dev == device]
+  return blocks * fs_block_size
+
+
+def _ParseFitContent(content, fs_block_size):
+  """Parses the content sizes of the fit command.
+
+  Args:
+    content: A JSON manifest mapping partition labels to sizes or directories,
+      or LABEL:SIZE and LABEL:DIR entries separated by commas or spaces
+    fs_block_size: Filesystem block size in bytes, to measure directories
+
+  Returns:
+    A list of (label, bytes) tuples, in the order given.
+  """
+  if os.path.isfile(content):
+    dirname = os.path.dirname(content)
+    entries = list(LoadJSONWithComments(content).items())
+  else:
+    dirname = ''
+    entries = []
+    for entry in content.replace(',', ' ').split():
+      if ':' not in entry:
+        raise InvalidAdjustment('Content "%s" is not LABEL:SIZE or LABEL:DIR' %
+                                entry)
+      entries.append(entry.split(':', 1))
+
+  sizes = []
+  for label, value in entries:
+    if isinstance(value, str) and os.path.isdir(os.path.join(dirname, value)):
+      sizes.append((label, GetContentSize(os.path.join(dirname, value),
+                                          fs_block_size)))
+    else:
+      sizes.append((label, ParseHumanNumber(value)))
+  return sizes
+
+
+def _GetHeadroom(headroom, content_bytes):
+  """Returns the free space --headroom asks for on top of |content_bytes|."""
+  total = 0
+  for term in headroom.replace(' ', '').split('+'):
+    if term.endswith('%'):
+      percent = term[:-1]
+      if not re.match(r'^\d+(\.\d+)?$', percent):
+        raise InvalidAdjustment('Invalid headroom %s' % headroom)
+      total += math.ceil(content_bytes * float(percent) / 100)
+    elif term:
+      total += ParseHumanNumber(term)
+  return total
+
+
+def _FitPartitions(options, config, image_type, content):
+  """Computes the smallest partitions holding their content for fit commands.
+
+  Each filesystem holds its content and --headroom, rounded up to fs_align,
+  and to the UBI erase block size for UBI partitions.  Rootfs partitions add
+  a --hashpad, other partitions keep any room they had after their
+  filesystem, and on raw NAND partitions are rounded up to erase blocks.
+
+  Args:
+    options: Flags passed to the script
+    config: Partition configuration, as returned by LoadPartitionConfig
+    image_type: Type of image eg base/test/dev/factory_install
+    content: Content sizes, see _ParseFitContent
+
+  Returns:
+    A list with a dict for each fitted partition, in the order of the table.
+  """
+  metadata = config['metadata']
+  partitions = GetPartitionTable(options, config, image_type)
+  nand = GetMetadataPartition(partitions)
+  fitted = []
+  for label, content_bytes in _ParseFitContent(content,
+                                               metadata['fs_block_size']):
+    partition = GetPartitionByLabel(partitions, label)
+    align = metadata['fs_align']
+    if partition.get('format') == 'ubi':
+      ubi_eb_size = (ParseHumanNumber(nand['erase_block_size']) -
+                     2 * ParseHumanNumber(nand['page_size']))
+      align = align * ubi_eb_size // math.gcd(align, ubi_eb_size)
+    fs_bytes = content_bytes + _GetHeadroom(options.headroom, content_bytes)
+    fs_bytes = max(1, -(-fs_bytes // align)) * align
+
+    if partition['type'] == 'rootfs':
+      part_bytes = fs_bytes + GetHashpadBytes(fs_bytes, metadata,
+                                              options.hashpad,
+                                              options.verity_hash_alg)
+    else:
+      part_bytes = fs_bytes + (partition['bytes'] -
+                               partition.get('fs_bytes', partition['bytes']))
+    if _HasBadEraseBlocks(partitions):
+      erase_block_size = ParseHumanNumber(nand['erase_block_size'])
+      part_bytes = -(-part_bytes // erase_block_size) * erase_block_size
+
+    fitted.append({'num': partition['num'], 'label': label,
+                   'type': partition['type'],
+                   'fs_separate': 'fs_bytes' in partition,
+                   'content_bytes': content_bytes, 'fs_bytes': fs_bytes,
+                   'bytes': part_bytes, 'previous_bytes': partition['bytes']})
+  # Layouts must list the partitions they override in the original order.
+  labels = [x.get('label') for x in partitions]
+  fitted.sort(key=lambda x: labels.index(x['label']))
+  return fitted
+
+
+def Fit(options, image_type, layout_filename, content):
+  """Sizes partitions to their content, printing an --adjust_part value.
+
+  The adjusted layout is validated.  Only rootfs partitions and partitions
+  whose filesystem fills them can be sized by --adjust_part; use fitlayout
+  for the others.
+
+  Args:
+    options: Flags passed to the script
+    image_type: Type of image eg base/test/dev/factory_install
+    layout_filename: Path to partition configuration file
+    content: Sizes of the content by label: LABEL:SIZE or LABEL:DIR entries,
+      or a JSON file mapping labels to sizes or directories
+
+  Returns:
+    The --adjust_part value, or JSON with --output_format=json.
+  """
+  config = LoadPartitionConfig(layout_filename, cache_dir=options.cache_dir)
+  fitted = _FitPartitions(options, config, image_type, content)
+  adjustments = []
+  for part in fitted:
+    if part['type'] == 'rootfs':
+      # The adjustment sets the filesystem size and adds the hashpad.
+      adjustments.append('%s:=%d' % (part['label'], part['fs_bytes']))
+    elif part['fs_separate']:
+      raise InvalidAdjustment(
+          'Partition %s has a filesystem size, which --adjust_part cannot '
+          'set; use fitlayout' % part['label'])
+    else:
+      adjustments.append('%s:=%d' % (part['label'], part['bytes']))
+  adjust_part = ' '.join([options.adjust_part] + adjustments).strip()
+
+  fit_options = argparse.Namespace(cache_dir=options.cache_dir,
+                                   **_GetAdjustOptions(options))
+  fit_options.adjust_part = adjust_part
+  Validate(fit_options, image_type, layout_filename)
+
+  if options.output_format == 'json':
+    for part in fitted:
+      del part['fs_separate']
+    return json.dumps({'image_type': image_type, 'adjust_part': adjust_part,
+                       'partitions': fitted})
+  return adjust_part
+
+
+def FitLayout(options, image_type, layout_filename, content, output):
+  """Writes a layout sizing partitions to their content.
+
+  The layout inherits from the original one and only overrides the sizes of
+  the fitted partitions of the image type.  It is validated once written.
+
+  Args:
+    options: Flags passed to the script
+    image_type: Type of image eg base/test/dev/factory_install
+    layout_filename: Path to partition configuration file
+    content: Sizes of the content by label: LABEL:SIZE or LABEL:DIR entries,
+      or a JSON file mapping labels to sizes or directories
+    output: Filename to write the derived layout to.  It is removed again
+      if it doesn't validate.
+  """
+  config = LoadPartitionConfig(layout_filename, cache_dir=options.cache_dir)
+  fitted = _FitPartitions(options, config, image_type, content)
+  overrides = []
+  for part in fitted:
+    override = {'num': part['num'], 'size': ProduceHumanNumber(part['bytes'])}
+    if part['type'] == 'rootfs' or part['fs_separate']:
+      override['fs_size'] = ProduceHumanNumber(part['fs_bytes'])
+    overrides.append(override)
+
+  parent = os.path.relpath(os.path.abspath(layout_filename),
+                           os.path.dirname(os.path.abspath(output)))
+  lines = ['# Generated by cgpt.py fitlayout: the partitions of %s sized to'
+           % image_type,
+           '# %s.' % content]
+  _WriteFileAtomically(output, '\n'.join(lines) + '\n' + json.dumps(
+      {'parent': parent, 'layouts': {image_type: overrides}},
+      indent=2) + '\n')
+  try:
+    Validate(options, image_type, output)
+  except Exception:
+    os.remove(output)
+    raise
+
+
 def CheckSimpleNandProperties(partitions):
   """Checks that NAND partitions are erase-block-aligned and not expand"""
   if not _HasBadEraseBlocks(partitions):
@@ -1525,18 +3315,607 @@ def CheckTotalSize(partitions):
 def Validate(options, image_type, layout_filename):
   """Validates a layout file, used before reading sizes to check for errors.
 
+  With ALL, every image type is validated and the failures of all of them
+  are reported together.
+
   Args:
     options: Flags passed to the script
-    image_type: Type of image eg base/test/dev/factory_install
+    image_type: Type of image eg ALL/base/test/dev/factory_install
     layout_filename: Path to partition configuration file
   """
-  partitions = GetPartitionTableFromConfig(options, layout_filename, image_type)
+  if image_type == 'ALL':
+    _ValidateAll(options, layout_filename)
+    return
+
+  _CheckPartitionTable(
+      GetPartitionTableFromConfig(options, layout_filename, image_type))
+
+
+def _CheckPartitionTable(partitions):
+  """Runs every check of Validate on a partition table."""
   CheckRootfsPartitionsMatch(partitions)
   CheckTotalSize(partitions)
   CheckSimpleNandProperties(partitions)
   CheckReservedEraseBlocks(partitions)
 
 
+def _CheckReservedEraseBlocksOf(partitions):
+  """Runs CheckReservedEraseBlocks for _ValidateAll, maybe in a worker process.
+
+  Args:
+    partitions: Partition table already built by _ValidateAll.  Workers are
+      sent it as a list of dicts and never load the layout themselves.
+
+  Returns:
+    The error found, or None.
+  """
+  try:
+    CheckReservedEraseBlocks(partitions)
+  except Exception as e:  # pylint: disable=broad-except
+    return '%s: %s' % (type(e).__name__, e)
+  return None
+
+
+def _ValidateAll(options, layout_filename):
+  """Validates every image type of a layout for Validate.
+
+  The layout is loaded once and the cheap checks run here.  The bad block
+  reserves of raw NAND image types are checked in parallel with --jobs
+  processes, which are sent the partition tables built here.  Exits with
+  status 1, listing every image type which failed and why, when any did.
+
+  Args:
+    options: Flags passed to the script
+    layout_filename: Path to partition configuration file
+  """
+  import concurrent.futures
+
+  config = LoadPartitionConfig(layout_filename, cache_dir=options.cache_dir)
+  image_types = _ListImageTypes(config)
+  errors = {}
+  nand_tables = {}
+  for image_type in image_types:
+    try:
+      partitions = GetPartitionTable(options, config, image_type)
+      CheckRootfsPartitionsMatch(partitions)
+      CheckTotalSize(partitions)
+      CheckSimpleNandProperties(partitions)
+    except Exception as e:  # pylint: disable=broad-except
+      errors[image_type] = '%s: %s' % (type(e).__name__, e)
+      continue
+    if any(_HasReservedEraseBlocks(x) for x in partitions):
+      nand_tables[image_type] = partitions
+
+  jobs = options.jobs or os.cpu_count() or 1
+  if jobs == 1 or len(nand_tables) < 2:
+    results = [_CheckReservedEraseBlocksOf(x) for x in nand_tables.values()]
+  else:
+    args = [[dict(x) for x in partitions]
+            for partitions in nand_tables.values()]
+    with concurrent.futures.ProcessPoolExecutor(
+        max_workers=min(jobs, len(args))) as executor:
+      results = list(executor.map(_CheckReservedEraseBlocksOf, args))
+  for image_type, error in zip(nand_tables, results):
+    if error:
+      errors[image_type] = error
+
+  if errors:
+    sys.exit('\n'.join('%s: %s' % (x, errors[x])
+                       for x in image_types if x in errors))
+
+
+def _ValidateImageTypeOf(args):
+  """Validates one image type for ValidateMany, maybe in a worker process.
+
+  The layout comes resolved, so workers never load or parse a layout file
+  themselves, whatever the multiprocessing start method.
+
+  Args:
+    args: (layout_filename, image_type, adjust_options, config) tuple, with
+      adjust_options from _GetAdjustOptions and config as returned by
+      LoadPartitionConfig.
+
+  Returns:
+    An (error, seconds) tuple, with None for the error of a valid image type.
+  """
+  import time
+
+  _, image_type, adjust_options, config = args
+  options = argparse.Namespace(**adjust_options)
+  start = time.perf_counter()
+  error = None
+  try:
+    _CheckPartitionTable(GetPartitionTable(options, config, image_type))
+  except Exception as e:  # pylint: disable=broad-except
+    error = '%s: %s' % (type(e).__name__, e)
+  return error, time.perf_counter() - start
+
+
+def _GetBoardName(layout_filename):
+  """Returns the board of the layout of an overlay, else the layout's name."""
+  dirname, basename = os.path.split(os.path.abspath(layout_filename))
+  if basename == 'disk_layout.json' and os.path.basename(dirname) == 'scripts':
+    overlay = os.path.basename(os.path.dirname(dirname))
+    if overlay.startswith('overlay-'):
+      overlay = overlay[len('overlay-'):]
+    return overlay
+  return os.path.splitext(basename)[0]
+
+
+def _FormatValidationMatrix(rows):
+  """Formats the results of ValidateMany as a table.
+
+  Args:
+    rows: The layouts in the report of ValidateMany.
+
+  Returns:
+    A line per layout with ok, FAIL or - (no such image type) under each image
+    type and the seconds taken, followed by a line per failure.
+  """
+  image_types = []
+  for row in rows:
+    image_types += [x for x in row['image_types'] if x not in image_types]
+  table = [['board'] + image_types + ['seconds']]
+  failures = []
+  for row in rows:
+    results = row['image_types']
+    line = [row['board']]
+    for image_type in image_types:
+      if row['error'] or image_type in results and results[image_type]['error']:
+        line.append('FAIL')
+      else:
+        line.append('ok' if image_type in results else '-')
+    line.append('%.3f' % row['seconds'])
+    table.append(line)
+    if row['error']:
+      failures.append('%s: %s' % (row['layout'], row['error']))
+    failures += ['%s %s: %s' % (row['layout'], x, results[x]['error'])
+                 for x in results if results[x]['error']]
+
+  widths = [max(len(x[i]) for x in table) for i in range(len(table[0]))]
+  lines = ['  '.join(x.ljust(w) for x, w in zip(line, widths)).rstrip()
+           for line in table]
+  return '\n'.join(lines + failures)
+
+
+def ValidateMany(options, layout_filenames):
+  """Validates every image type of many layouts, e.g. of every board.
+
+  The layouts are resolved here, so parents shared by several layouts are
+  read and parsed once, then their image types are validated in parallel
+  with --jobs processes, which are sent the resolved layouts.  Prints a
+  table of which image type of which board passes and how long each layout
+  took, or the report as JSON with --output_format=json, and exits with
+  status 1 when anything failed.
+
+  Args:
+    options: Flags passed to the script
+    layout_filenames: Layout files or glob patterns, separated by commas or
+      spaces
+  """
+  import concurrent.futures
+  import glob
+  import time
+
+  filenames = []
+  for pattern in layout_filenames.replace(',', ' ').split():
+    # A pattern matching nothing is kept to be reported as missing.
+    for filename in sorted(glob.glob(pattern, recursive=True)) or [pattern]:
+      if filename not in filenames:
+        filenames.append(filename)
+
+  rows = {}
+  args = []
+  for filename in filenames:
+    row = rows[filename] = {'layout': filename,
+                            'board': _GetBoardName(filename),
+                            'error': None, 'image_types': {}}
+    start = time.perf_counter()
+    try:
+      config = LoadPartitionConfig(filename, cache_dir=options.cache_dir)
+    except Exception as e:  # pylint: disable=broad-except
+      row['error'] = '%s: %s' % (type(e).__name__, e)
+    else:
+      args += [(filename, x, _GetAdjustOptions(options), config)
+               for x in _ListImageTypes(config)]
+    row['seconds'] = time.perf_counter() - start
+
+  jobs = options.jobs or os.cpu_count() or 1
+  if jobs == 1 or len(args) < 2:
+    results = [_ValidateImageTypeOf(x) for x in args]
+  else:
+    with concurrent.futures.ProcessPoolExecutor(max_workers=jobs) as executor:
+      results = list(executor.map(
+          _ValidateImageTypeOf, args,
+          chunksize=max(1, len(args) // (jobs * 4))))
+  for (filename, image_type, _, _), (error, seconds) in zip(args, results):
+    rows[filename]['image_types'][image_type] = {'error': error,
+                                                 'seconds': seconds}
+    rows[filename]['seconds'] += seconds
+
+  rows = [rows[x] for x in filenames]
+  failed = sum(1 for x in rows if x['error'] or
+               any(y['error'] for y in x['image_types'].values()))
+  if options.output_format == 'json':
+    output = json.dumps({'checked': len(rows), 'failed': failed,
+                         'layouts': rows}, indent=2, sort_keys=True)
+  else:
+    output = _FormatValidationMatrix(rows)
+  if failed:
+    print(output)
+    sys.exit(1)
+  return output
+
+
+def _CompareWithLayout(config, partitions, gpt, image_size):
+  """Returns how the GPT of an image differs from a layout's placement.
+
+  Args:
+    config: Partition configuration file object
+    partitions: Partition table as returned by GetPartitionTable
+    gpt: gpt_image.Gpt read from the image
+    image_size: Size of the image in bytes
+
+  Returns:
+    A list of strings describing each difference.
+  """
+  import gpt_image
+
+  try:
+    plan = PlanPartitionTable(config, partitions, image_size, gpt.block_size)
+  except (InvalidLayout, InvalidSize) as e:
+    return [str(e)]
+
+  actual = {x.num: x for x in gpt.partitions}
+  diffs = []
+  for part in plan:
+    image_part = actual.pop(part['num'], None)
+    if image_part is None:
+      diffs.append('partition %s is missing' % part['num'])
+      continue
+    expected = (
+        ('label', part['label'], image_part.label),
+        ('type', gpt_image.GetTypeGuid(part['type']),
+         gpt_image.GetTypeGuid(image_part.type)),
+        ('start', part['start'], image_part.start),
+        ('end', part['end'], image_part.end),
+    )
+    for name, layout_value, image_value in expected:
+      if layout_value != image_value:
+        diffs.append('partition %s %s is %s, the layout says %s' %
+                     (part['num'], name, image_value, layout_value))
+  for num in sorted(actual):
+    diffs.append('partition %s is not in the layout' % num)
+  return diffs
+
+
+def _AuditImage(args):
+  """Audits a single image for Audit, possibly in a worker process.
+
+  Args:
+    args: (image, layout_filename, image_types, adjust_options, cache_dir)
+      tuple, with adjust_options from _GetAdjustOptions.
+
+  Returns:
+    A dict with the image, the first of image_types it matches and the
+    problems found.
+  """
+  import gpt_image
+
+  image, layout_filename, image_types, adjust_options, cache_dir = args
+  result = {'image': image, 'image_type': None, 'problems': []}
+  try:
+    gpt, result['problems'] = gpt_image.CheckGpt(image)
+    with open(image, 'rb') as f:
+      image_size = f.seek(0, os.SEEK_END)
+  except (IOError, OSError) as e:
+    result['problems'].append('cannot read image: %s' % e)
+    return result
+  if gpt is None:
+    return result
+
+  config = LoadPartitionConfig(layout_filename, cache_dir=cache_dir)
+  fs_align = config['metadata']['fs_align']
+  fs_types = [gpt_image.GetTypeGuid(x) for x in ('data', 'rootfs')]
+  for part in gpt.partitions:
+    if (gpt_image.GetTypeGuid(part.type) in fs_types and part.end > part.start
+        and part.start * gpt.block_size % fs_align):
+      result['problems'].append('partition %d is not aligned to %d bytes' %
+                                (part.num, fs_align))
+
+  options = argparse.Namespace(**adjust_options)
+  mismatches = []
+  for image_type in image_types:
+    partitions = GetPartitionTable(options, config, image_type)
+    diffs = _CompareWithLayout(config, partitions, gpt, image_size)
+    if not diffs:
+      result['image_type'] = image_type
+      return result
+    mismatches.append(diffs)
+
+  if len(image_types) == 1:
+    result['problems'] += mismatches[0]
+  else:
+    result['problems'].append('matches none of the image types %s' %
+                              ' '.join(image_types))
+  return result
+
+
+def Audit(options, image_type, layout_filename, path):
+  """Checks the GPT of built images, printing a JSON report.
+
+  Every *.bin file under a directory is checked, in parallel with --jobs
+  processes, reading nothing but the GPT copies: their CRCs, that the
+  primary and secondary copies agree, that partitions do not overlap, that
+  filesystem partitions are aligned to fs_align and that the partitions are
+  placed like the layout places them on an image of that size.  Exits with
+  status 1 when any image has problems.
+
+  Args:
+    options: Flags passed to the script
+    image_type: Type of image the images are of, or ALL for any of them
+    layout_filename: Path to partition configuration file
+    path: Image file or directory of images to check
+  """
+  import concurrent.futures
+
+  config = LoadPartitionConfig(layout_filename, cache_dir=options.cache_dir)
+  if image_type == 'ALL':
+    image_types = _ListImageTypes(config)
+  elif image_type in config['layouts']:
+    image_types = [image_type]
+  else:
+    raise InvalidLayout('Unknown layout: %s' % image_type)
+
+  if os.path.isdir(path):
+    images = []
+    for dirpath, dirnames, filenames in os.walk(path):
+      dirnames.sort()
+      images += [os.path.join(dirpath, x) for x in sorted(filenames)
+                 if x.endswith('.bin')]
+  else:
+    images = [path]
+
+  jobs = options.jobs or os.cpu_count() or 1
+  args = [(x, layout_filename, image_types, _GetAdjustOptions(options),
+           options.cache_dir) for x in images]
+  if jobs == 1 or len(images) < 2:
+    results = [_AuditImage(x) for x in args]
+  else:
+    with concurrent.futures.ProcessPoolExecutor(max_workers=jobs) as executor:
+      results = list(executor.map(
+          _AuditImage, args, chunksize=max(1, len(args) // (jobs * 4))))
+
+  failed = sum(1 for x in results if x['problems'])
+  report = json.dumps({'layout': layout_filename, 'checked': len(results),
+                       'failed': failed, 'images': results},
+                      indent=2, sort_keys=True)
+  if failed:
+    print(report)
+    sys.exit(1)
+  return report
+
+
+def _EncodeServerRequest(cwd, environ, argv):
+  """Returns the request running |argv| on the server; see Serve.
+
+  Args:
+    cwd: Directory relative paths are resolved from.
+    environ: Environment of the command.  Only the variables starting with
+      SERVER_ENVIRONMENT_PREFIX are sent.
+    argv: Command line arguments.
+  """
+  words = ['cwd=' + cwd]
+  words += ['env=%s=%s' % (name, value)
+            for name, value in sorted(environ.items())
+            if name.startswith(SERVER_ENVIRONMENT_PREFIX)]
+  words += ['arg=' + x for x in argv]
+  return b''.join(os.fsencode(x) + b'\0' for x in words)
+
+
+def _DecodeServerRequest(request):
+  """Returns the (cwd, environ, argv) of a request; see Serve."""
+  words = request.split(b'\0')
+  if words.pop() != b'':
+    raise ServerError('request does not end with a NUL')
+  cwd = None
+  environ = {}
+  argv = []
+  for word in words:
+    kind, _, value = os.fsdecode(word).partition('=')
+    if kind == 'cwd':
+      cwd = value
+    elif kind == 'env' and '=' in value:
+      name, _, value = value.partition('=')
+      environ[name] = value
+    elif kind == 'arg':
+      argv.append(value)
+    else:
+      raise ServerError('bad request word %r' % word)
+  return cwd, environ, argv
+
+
+def _SplitOutputLines(text):
+  """Splits command output into lines at newlines only."""
+  lines = text.split('\n')
+  if lines[-1] == '':
+    lines.pop()
+  return lines
+
+
+def _RunServerRequest(parsers, request):
+  """Runs the command of one request of the server protocol.
+
+  The command runs with the working directory and the CGPT_* environment
+  variables of the request, so flag defaults read from the environment are
+  the client's and not the server's.
+
+  Args:
+    parsers: Dict of the CLI parsers built so far, keyed on the command and
+      the environment they were built in.  Parsers are added to it.
+    request: The request; see Serve.
+
+  Returns:
+    The response lines, without their newlines.
+  """
+  import traceback
+
+  stdout = io.StringIO()
+  stderr = io.StringIO()
+  cwd = os.getcwd()
+  environ = dict(os.environ)
+  code = 0
+  try:
+    with contextlib.redirect_stdout(stdout), contextlib.redirect_stderr(stderr):
+      try:
+        request_cwd, request_environ, argv = _DecodeServerRequest(request)
+        if request_cwd is not None:
+          os.chdir(request_cwd)
+        for name in list(os.environ):
+          if name.startswith(SERVER_ENVIRONMENT_PREFIX):
+            del os.environ[name]
+        os.environ.update(request_environ)
+
+        command = _PeekCommand(argv)
+        key = (command, tuple(sorted(request_environ.items())))
+        parser = parsers.get(key)
+        if parser is None:
+          parser = parsers[key] = GetParser(command=command)
+        opts = parser.parse_args(argv)
+        if opts.callback is Serve:
+          raise ServerError('cannot start a server from a server')
+        _RunCommand(opts)
+      except SystemExit as e:
+        if isinstance(e.code, int) or e.code is None:
+          code = e.code or 0
+        else:
+          print(e.code, file=sys.stderr)
+          code = 1
+      except Exception:  # pylint: disable=broad-except
+        traceback.print_exc()
+        code = 1
+  finally:
+    os.chdir(cwd)
+    os.environ.clear()
+    os.environ.update(environ)
+
+  response = ['out:' + x for x in _SplitOutputLines(stdout.getvalue())]
+  response += ['err:' + x for x in _SplitOutputLines(stderr.getvalue())]
+  response.append('exit:%d' % code)
+  return response
+
+
+def Serve(options):
+  """Answers commands over the --socket Unix socket until interrupted.
+
+  Keeping a server running saves starting Python and loading the layouts
+  for every command: loaded layouts stay in memory until one of the files
+  they were built from changes, or a parent they took from the cgpt.py
+  directory is created next to its child.
+
+  Each connection carries a single request, which the client ends by
+  shutting down its side of the connection.  The request is a list of
+  NUL-terminated words: arg=ARG for each argument of the command like on
+  the command line, cwd=DIR to resolve relative paths from DIR, and
+  env=NAME=VALUE for each CGPT_* environment variable of the client, which
+  replace the server's while the command runs.  The response has one line
+  per line of output, prefixed with "out:" for stdout and "err:" for
+  stderr, and ends with "exit:<code>".  From a shell:
+
+    printf '%s\0' "cwd=${PWD}" arg=readpartsize arg=base \
+        arg=disk_layout.json arg=3 |
+      socat -t 600 - UNIX-CONNECT:/tmp/cgpt.sock
+
+  cgpt.py itself sends its command to the server when given --socket (or
+  $CGPT_SOCKET), and runs it directly when no server is listening.
+
+  Args:
+    options: Flags passed to the script
+  """
+  import socket
+
+  if not options.socket:
+    raise ServerError('serve needs --socket')
+  if os.path.exists(options.socket):
+    if _ConnectToServer(options.socket) is not None:
+      raise ServerError('a server is already listening on %s' % options.socket)
+    # Left behind by a server that did not exit cleanly.
+    os.unlink(options.socket)
+
+  parsers = {}
+  server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+  try:
+    server.bind(options.socket)
+    server.listen(16)
+    while True:
+      conn, _ = server.accept()
+      with conn:
+        # Do not let a stuck client block everybody else.
+        conn.settimeout(SERVER_TIMEOUT)
+        try:
+          with conn.makefile('rb') as f:
+            request = f.read()
+          if not request:
+            # Somebody checking whether the server is up.
+            continue
+          response = _RunServerRequest(parsers, request)
+          conn.sendall(''.join(x + '\n' for x in response).encode(
+              'utf-8', 'surrogateescape'))
+        except OSError as e:
+          print('cgpt.py server: dropped request: %s' % e, file=sys.stderr)
+  except KeyboardInterrupt:
+    pass
+  finally:
+    server.close()
+    os.unlink(options.socket)
+
+
+def _ConnectToServer(socket_path):
+  """Returns a socket connected to the server at |socket_path|, or None."""
+  import socket
+
+  conn = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+  try:
+    conn.connect(socket_path)
+  except OSError:
+    conn.close()
+    return None
+  return conn
+
+
+def _RunOnServer(socket_path, argv):
+  """Runs a command on the server at |socket_path|; see Serve.
+
+  Args:
+    socket_path: Path of the server socket.
+    argv: Command line arguments.
+
+  Returns:
+    The exit code of the command, or None if no server is listening.
+  """
+  conn = _ConnectToServer(socket_path)
+  if conn is None:
+    return None
+
+  import socket
+
+  with conn:
+    conn.sendall(_EncodeServerRequest(os.getcwd(), os.environ, argv))
+    conn.shutdown(socket.SHUT_WR)
+    with conn.makefile('rb') as f:
+      for line in f:
+        text = line.decode('utf-8', 'replace').rstrip('\n')
+        kind, _, text = text.partition(':')
+        if kind == 'out':
+          print(text)
+        elif kind == 'err':
+          print(text, file=sys.stderr)
+        elif kind == 'exit':
+          return int(text)
+  raise ServerError('server at %s hung up before the command finished' %
+                    socket_path)
+
+
 class ArgsAction(argparse.Action):  # pylint: disable=no-init
   """Helper to add all arguments to an args array.
 
@@ -1569,40 +3948,118 @@ class HelpAllAction(argparse.Action):
     sys.exit(0)
 
 
-def GetParser():
-  """Return a parser for the CLI."""
-  parser = argparse.ArgumentParser(
-      description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+ACTION_MAP = {
+    'write': WritePartitionScript,
+    'writeall': WritePartitionScripts,
+    'writegpt': WriteGptImage,
+    'readblocksize': GetBlockSize,
+    'readfsblocksize': GetFilesystemBlockSize,
+    'readpartsize': GetPartitionSize,
+    'readformat': GetFormat,
+    'readfsformat': GetFilesystemFormat,
+    'readfssize': GetFilesystemSize,
+    'readhashpadsize': GetHashpadSize,
+    'readimage': ReadImage,
+    'readimagetypes': GetImageTypes,
+    'readfsoptions': GetFilesystemOptions,
+    'readlabel': GetLabel,
+    'readnumber': GetNumber,
+    'readreservederaseblocks': GetReservedEraseBlocks,
+    'readtype': GetType,
+    'readpartitionnums': GetPartitions,
+    'readuuid': GetUUID,
+    'query': GetPartitionQuery,
+    'plan': GetPartitionPlan,
+    'vmlayout': GetVmLayout,
+    'serve': Serve,
+    'clearcache': ClearConfigCache,
+    'compile': CompileLayout,
+    'debug': DoDebugOutput,
+    'hashpadreport': ReportHashpadSavings,
+    'validate': Validate,
+    'solvereserve': SolveReservedEraseBlocks,
+    'validatemany': ValidateMany,
+    'fit': Fit,
+    'fitlayout': FitLayout,
+    'audit': Audit,
+}
+
+
+def _AddGlobalOptions(parser):
+  """Adds the options shared by every command to |parser|."""
   parser.add_argument('--adjust_part', metavar='SPEC', default='',
                       help='adjust partition sizes')
+  parser.add_argument('--hashpad', choices=HASHPAD_MODES, default='legacy',
+                      help='room --adjust_part keeps after the filesystem of '
+                           'a rootfs partition: 15%% of it, or exactly its '
+                           'dm-verity hash tree (default: %(default)s)')
+  parser.add_argument('--verity_hash_alg', metavar='ALG',
+                      default=DEFAULT_VERITY_HASH_ALG,
+                      help='dm-verity hash algorithm of --hashpad=exact '
+                           '(default: %(default)s)')
+  parser.add_argument('--headroom', metavar='SPEC', default='10%',
+                      help='free space the fit and fitlayout commands leave '
+                           'in filesystems: a percentage of their content, a '
+                           'size, or both joined by + (default: %(default)s)')
+  parser.add_argument('--if_changed', action='store_true',
+                      help='do not rewrite scripts of the write and writeall '
+                           'commands written from the same inputs')
+  parser.add_argument('--output_format', choices=('shell', 'json'),
+                      default='shell',
+                      help='output format for commands that print many values')
+  parser.add_argument('--disk_size', metavar='SIZE',
+                      help='disk size for the plan command, and of images '
+                           'the writegpt command creates (default: the size '
+                           'of the image the write command creates)')
+  parser.add_argument('--block_size', metavar='SIZE',
+                      default=DEFAULT_SECTOR_SIZE,
+                      help='disk block size for the plan, vmlayout and '
+                           'writegpt commands (default: %(default)s)')
+  parser.add_argument('--jobs', metavar='N', type=int,
+                      help='processes used by the audit, validate ALL and '
+                           'validatemany commands (default: one per CPU)')
+  parser.add_argument('--cache_dir', metavar='DIR',
+                      default=os.environ.get('CGPT_CACHE_DIR') or None,
+                      help='directory caching resolved layouts; the cache '
+                           'is only used when this is set '
+                           '(default: $CGPT_CACHE_DIR)')
+  parser.add_argument('--no_cache', dest='cache_dir', action='store_const',
+                      const=None, help='do not use the resolved layout cache')
+  parser.add_argument('--profile', metavar='FILE',
+                      default=os.environ.get('CGPT_PROFILE'),
+                      help='append the wall time and calls of the phases of '
+                           'the command to FILE as a JSON line '
+                           '(default: $CGPT_PROFILE)')
+  parser.add_argument('--socket', metavar='PATH',
+                      default=os.environ.get('CGPT_SOCKET'),
+                      help='Unix socket of a server started with the serve '
+                           'command; commands are sent to it when it is '
+                           'listening (default: $CGPT_SOCKET)')
+
+
+def GetParser(command=None):
+  """Return a parser for the CLI.
 
-  action_map = {
-      'write': WritePartitionScript,
-      'readblocksize': GetBlockSize,
-      'readfsblocksize': GetFilesystemBlockSize,
-      'readpartsize': GetPartitionSize,
-      'readformat': GetFormat,
-      'readfsformat': GetFilesystemFormat,
-      'readfssize': GetFilesystemSize,
-      'readimagetypes': GetImageTypes,
-      'readfsoptions': GetFilesystemOptions,
-      'readlabel': GetLabel,
-      'readnumber': GetNumber,
-      'readreservederaseblocks': GetReservedEraseBlocks,
-      'readtype': GetType,
-      'readpartitionnums': GetPartitions,
-      'readuuid': GetUUID,
-      'debug': DoDebugOutput,
-      'validate': Validate,
-  }
+  Args:
+    command: If set, only this command is added to the parser.  That is
+      enough to parse a command line running it, and much faster to set up,
+      but help and errors about other commands need the full parser.
+  """
+  parser = argparse.ArgumentParser(
+      description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+  _AddGlobalOptions(parser)
 
   # Subparsers are required by default under Python 2.  Python 3 changed to
   # not required, but didn't include a required option until 3.7.  Setting
   # the required member works in all versions (and setting dest name).
   subparsers = parser.add_subparsers(title='Commands', dest='command')
   subparsers.required = True
+  if command:
+    # Keep listing every command in usage messages, like the full parser.
+    subparsers.metavar = '{%s}' % ','.join(sorted(ACTION_MAP))
 
-  for name, func in sorted(action_map.items()):
+  for name in [command] if command else sorted(ACTION_MAP):
+    func = ACTION_MAP[name]
     # Turn the func's docstring into something we can show the user.
     desc, doc = func.__doc__.split('\n', 1)
     # Extract the help for each argument.
@@ -1612,9 +4069,8 @@ def GetParser():
         arg, text = line.split(':', 1)
         args_help[arg.strip()] = text.strip()
 
-    argspec = inspect.getfullargspec(func)
     # Skip the first argument as that'll be the options field.
-    args = argspec.args[1:]
+    args = func.__code__.co_varnames[1:func.__code__.co_argcount]
 
     subparser = subparsers.add_parser(name, description=desc, help=desc)
     subparser.set_defaults(callback=func,
@@ -1628,14 +4084,165 @@ def GetParser():
   return parser
 
 
-def main(argv):
-  parser = GetParser()
-  opts = parser.parse_args(argv)
+def _PeekCommand(argv):
+  """Finds the command |argv| runs without building the full parser.
+
+  Args:
+    argv: Command line arguments.
+
+  Returns:
+    The name of the command, or None whenever the full parser is needed to
+    handle |argv| the same way: for help before the command, options that are
+    unknown or abbreviated, and unknown commands.
+  """
+  parser = argparse.ArgumentParser(add_help=False)
+  _AddGlobalOptions(parser)
+  takes_value = {}
+  for action in parser._actions:  # pylint: disable=protected-access
+    for option in action.option_strings:
+      takes_value[option] = action.nargs != 0
+
+  args = iter(argv)
+  for arg in args:
+    if arg.startswith('-') and arg != '-':
+      option = arg.split('=', 1)[0]
+      if option not in takes_value:
+        return None
+      if takes_value[option] and '=' not in arg:
+        next(args, None)
+      continue
+    return arg if arg in ACTION_MAP else None
+  return None
+
+
+# Phases timed by --profile, and the functions making them up.  Phases may
+# nest: tables are built while writing scripts, and adjusted while built.
+PROFILED_PHASES = {
+    'json_load': ('_ReadLayoutFile', '_LoadCompiledLayout', '_ReadConfigCache'),
+    'merge': ('_MergeParentConfigs',),
+    'validate': ('_ValidateConfig', 'CheckRootfsPartitionsMatch',
+                 'CheckTotalSize', 'CheckSimpleNandProperties',
+                 'CheckReservedEraseBlocks'),
+    'table': ('GetPartitionTable',),
+    'adjust': ('ApplyPartitionAdjustment',),
+    'script': ('WriteLayoutFunction', 'WritePartitionSizesFunction'),
+}
+
+# Calls and wall time of each phase of the command being profiled, or None
+# when it isn't.
+_PROFILE = None
+
 
-  ret = opts.callback(opts, *opts.args)
+def _ProfiledFunction(phase, func):
+  """Returns a wrapper of |func| recording its calls under |phase|.
+
+  Calls made while another function of the same phase runs are counted but
+  not timed again.
+  """
+  import time
+
+  def _Wrapper(*args, **kwargs):
+    if _PROFILE is None:
+      return func(*args, **kwargs)
+    stats = _PROFILE.setdefault(phase, {'calls': 0, 'seconds': 0.0})
+    stats['calls'] += 1
+    if stats.get('running'):
+      return func(*args, **kwargs)
+    stats['running'] = True
+    start = time.perf_counter()
+    try:
+      return func(*args, **kwargs)
+    finally:
+      stats['seconds'] += time.perf_counter() - start
+      del stats['running']
+
+  _Wrapper.__name__ = func.__name__
+  _Wrapper.__doc__ = func.__doc__
+  _Wrapper.profiled_function = func
+  return _Wrapper
+
+
+def _StartProfiling():
+  """Starts recording the phases of the command about to run.
+
+  The functions of every phase are only replaced with timing wrappers the
+  first time, so the commands of a process not profiling run unchanged.
+  """
+  global _PROFILE  # pylint: disable=global-statement
+  module = globals()
+  for phase, names in PROFILED_PHASES.items():
+    for name in names:
+      if not hasattr(module[name], 'profiled_function'):
+        module[name] = _ProfiledFunction(phase, module[name])
+  _PROFILE = {}
+
+
+def _StopProfiling(opts, seconds):
+  """Stops recording phases and appends them to the --profile file.
+
+  Each command appends one JSON line, so the profiles of every cgpt.py run in
+  a build can be collected in the same file and aggregated.
+
+  Args:
+    opts: The parsed command line of the command.
+    seconds: Wall time of the whole command.
+  """
+  import time
+
+  global _PROFILE  # pylint: disable=global-statement
+  phases, _PROFILE = _PROFILE, None
+  command = [k for k, v in ACTION_MAP.items() if v is opts.callback]
+  record = {
+      'time': time.time(),
+      'pid': os.getpid(),
+      'command': command[0] if command else None,
+      'args': list(getattr(opts, 'args', [])),
+      'adjust_part': opts.adjust_part,
+      'seconds': seconds,
+      'phases': phases,
+  }
+  with open(opts.profile, 'a') as f:
+    f.write(json.dumps(record, sort_keys=True) + '\n')
+
+
+def _RunCommand(opts):
+  """Runs the command selected by the parsed command line |opts|."""
+  if not opts.profile:
+    _RunCallback(opts)
+    return
+
+  import time
+
+  _StartProfiling()
+  start = time.perf_counter()
+  try:
+    _RunCallback(opts)
+  finally:
+    _StopProfiling(opts, time.perf_counter() - start)
+
+
+def _RunCallback(opts):
+  """Runs the callback of the command and prints what it returns."""
+  # Commands without positional arguments never get an args attribute.
+  ret = opts.callback(opts, *getattr(opts, 'args', []))
   if ret is not None:
     print(ret)
 
 
+def main(argv):
+  parser = GetParser(command=_PeekCommand(argv))
+  opts = parser.parse_args(argv)
+
+  if opts.socket and opts.callback is not Serve:
+    if opts.profile:
+      # The server doesn't see our environment, so pass the file on.
+      argv = ['--profile', os.path.abspath(opts.profile)] + argv
+    ret = _RunOnServer(opts.socket, argv)
+    if ret is not None:
+      return ret
+
+  _RunCommand(opts)
+
+
 if __name__ == '__main__':
   sys.exit(main(sys.argv[1:]))
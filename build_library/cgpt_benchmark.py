@@ -0,0 +1,714 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+# Copyright 2021 The Chromium OS Authors. All rights reserved.
+# Use of this source code is governed by a BSD-style license that can be
+# found in the LICENSE file.
+
+"""Performance benchmarks for cgpt.py.
+
+Each benchmark builds synthetic disk layouts, times the cgpt.py code paths
+that handle them and prints one line per case.  The memory benchmark also
+records the peak traced memory and the number of memory blocks allocated,
+and the startup benchmark runs cgpt.py as a command, the way build scripts
+do, to time its per-call latency and imports.
+
+The synthetic layouts vary along several axes: partitions per layout
+(--sizes), parent chain depth (--depths), number of image types
+(--layout_counts), --adjust_part adjustments (--adjust_counts) and NAND
+device size (--nand_sizes).  The real layouts shipped in build_library are
+benchmarked as fixed cases by the real benchmark.  The json benchmark times
+parsing them, and synthetic files of --json_lines lines, against the parser
+cgpt.py used before it supported trailing comments.
+
+Use --json to also save the results in machine readable form, --cgpt to
+benchmark another copy of cgpt.py (e.g. one checked out from an older
+commit) and --compare to print how the results differ from a saved run:
+
+  cgpt_benchmark.py --json /tmp/new.json merge stack memory
+  git show HEAD~1:build_library/cgpt.py > /tmp/cgpt_old.py
+  cgpt_benchmark.py --cgpt /tmp/cgpt_old.py --compare /tmp/new.json \\
+      merge stack memory
+"""
+
+from __future__ import print_function
+
+import argparse
+import glob
+import importlib.util
+import json
+import math
+import os
+import platform
+import re
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+
+
+def LoadCgpt(path):
+  """Imports the cgpt.py at |path| as a fresh module."""
+  spec = importlib.util.spec_from_file_location('cgpt', path)
+  module = importlib.util.module_from_spec(spec)
+  spec.loader.exec_module(module)
+  return module
+
+
+BUILD_LIBRARY = os.path.dirname(os.path.abspath(__file__))
+
+
+class Options(object):
+  """Fake options, with the defaults of the cgpt.py flags."""
+
+  def __init__(self, adjust_part=''):
+    self.adjust_part = adjust_part
+    self.output_format = 'shell'
+    self.disk_size = None
+    self.block_size = 512
+    self.jobs = None
+    self.cache_dir = None
+    self.if_changed = False
+    self.hashpad = 'legacy'
+    self.verity_hash_alg = 'sha256'
+    self.headroom = '10%'
+
+
+def ResetMemos(cgpt):
+  """Drops the per-process layout memos so every run starts cold."""
+  for name in ('_PARSED_LAYOUT_FILES', '_STACKED_CONFIGS', '_LOADED_CONFIGS'):
+    getattr(cgpt, name, {}).clear()
+  probability = getattr(cgpt, 'BadBlockFailureProbability', None)
+  if hasattr(probability, 'cache_clear'):
+    probability.cache_clear()
+
+
+def TimeIt(func, repeat):
+  """Returns the best wall time of |repeat| calls to |func|, in seconds."""
+  best = None
+  for _ in range(repeat):
+    start = time.perf_counter()
+    func()
+    elapsed = time.perf_counter() - start
+    if best is None or elapsed < best:
+      best = elapsed
+  return best
+
+
+def TraceMemory(func):
+  """Runs |func| once while tracing the memory it allocates.
+
+  Returns:
+    A (peak_bytes, blocks) tuple: the peak traced memory while |func| ran and
+    the number of memory blocks still allocated by it when it returned, that
+    is the allocations making up its result.
+  """
+  tracemalloc.start()
+  try:
+    start = sys.getallocatedblocks()
+    result = func()
+    blocks = sys.getallocatedblocks() - start
+    _, peak = tracemalloc.get_traced_memory()
+  finally:
+    tracemalloc.stop()
+  del result
+  return peak, blocks
+
+
+def MakeMergeLayouts(num_partitions):
+  """Returns a (layout_to_override, layout) pair for _ApplyLayoutOverrides.
+
+  The parent has |num_partitions| partitions with a gap every tenth entry.
+  The child overrides every other parent partition and inserts a new one
+  before each override, which is the worst case for list insertion.
+  """
+  parent = []
+  for num in range(1, num_partitions + 1):
+    if num % 10 == 0:
+      parent.append({'type': 'blank', 'size': '1 MiB'})
+    parent.append({'num': num, 'label': 'P%d' % num, 'type': 'data',
+                   'size': '1 MiB'})
+  child = []
+  for num in range(2, num_partitions + 1, 2):
+    child.append({'num': num_partitions + num, 'label': 'N%d' % num,
+                  'type': 'data', 'size': '2 MiB'})
+    child.append({'num': num, 'size': '4 MiB'})
+  return parent, child
+
+
+def WriteStackedLayouts(tempdir, num_partitions, depth, num_layouts=3):
+  """Writes a chain of |depth| layout files and returns the bottom one.
+
+  The root file defines |num_partitions| partitions in its common layout and
+  |num_layouts| image types.  Partitions 1 and 2 are the ROOT-A and ROOT-B
+  rootfs partitions the write and validate commands expect.  Every level below
+  overrides a different subset of the partitions and adds new ones, so each
+  level has real merging to do.
+  """
+  common = [{'num': num, 'label': 'P%d' % num, 'type': 'data',
+             'size': '1 MiB'}
+            for num in range(1, num_partitions + 1)]
+  for partition, label in zip(common, ('ROOT-A', 'ROOT-B')):
+    partition.update(label=label, type='rootfs')
+  layouts = {
+      'common': common,
+      'base': [],
+      'usb': [{'num': 1, 'size': '2 MiB'}],
+      'factory_install': [{'num': 2, 'size': '2 MiB'}],
+  }
+  for i in range(3, num_layouts):
+    layouts['type%d' % i] = [{'num': i % num_partitions + 1, 'size': '2 MiB'}]
+  root = {
+      'metadata': {'block_size': 512, 'fs_block_size': 4096},
+      'layouts': layouts,
+  }
+  filename = os.path.join(tempdir, 'level0.json')
+  with open(filename, 'w') as f:
+    json.dump(root, f)
+
+  next_num = num_partitions + 1
+  for level in range(1, depth):
+    common = []
+    for num in range(level, num_partitions + 1, depth):
+      common.append({'num': num, 'size': '%d MiB' % (level + 1)})
+      common.append({'num': next_num, 'label': 'L%d_%d' % (level, next_num),
+                     'type': 'data', 'size': '1 MiB'})
+      next_num += 1
+    config = {
+        'parent': os.path.basename(filename),
+        'layouts': {'common': common,
+                    'base': [{'num': level, 'size': '3 MiB'}]},
+    }
+    filename = os.path.join(tempdir, 'level%d.json' % level)
+    with open(filename, 'w') as f:
+      json.dump(config, f)
+  return filename
+
+
+def BenchMerge(cgpt, opts, _tempdir):
+  """Times _ApplyLayoutOverrides on ever larger layouts."""
+  results = []
+  for num_partitions in opts.sizes:
+    parent, child = MakeMergeLayouts(num_partitions)
+    def _Run():
+      cgpt._ApplyLayoutOverrides([dict(x) for x in parent], child)
+    results.append({
+        'partitions': num_partitions,
+        'seconds': TimeIt(_Run, opts.repeat),
+    })
+  return results
+
+
+def BenchStack(cgpt, opts, tempdir):
+  """Times _LoadStackedPartitionConfig on deep chains of large layouts."""
+  results = []
+  for num_partitions in opts.sizes:
+    for depth in opts.depths:
+      casedir = os.path.join(tempdir, 'stack_%d_%d' % (num_partitions, depth))
+      os.mkdir(casedir)
+      filename = WriteStackedLayouts(casedir, num_partitions, depth)
+      def _Run():
+        ResetMemos(cgpt)
+        cgpt._LoadStackedPartitionConfig(filename)
+      results.append({
+          'partitions': num_partitions,
+          'depth': depth,
+          'seconds': TimeIt(_Run, opts.repeat),
+      })
+  return results
+
+
+def BenchMemory(cgpt, opts, tempdir):
+  """Traces the memory used to load a layout and query its tables.
+
+  Each case loads the bottom layout of a chain with LoadPartitionConfig and
+  then gets the base table five times, like WritePartitionScript does.
+  """
+  results = []
+  for num_partitions in opts.sizes:
+    for depth in opts.depths:
+      casedir = os.path.join(tempdir, 'memory_%d_%d' % (num_partitions, depth))
+      os.mkdir(casedir)
+      filename = WriteStackedLayouts(casedir, num_partitions, depth)
+      def _Run():
+        ResetMemos(cgpt)
+        config = cgpt.LoadPartitionConfig(filename)
+        tables = [cgpt.GetPartitionTable(Options(), config, 'base')
+                  for _ in range(5)]
+        return config, tables
+      peak, blocks = TraceMemory(_Run)
+      results.append({
+          'partitions': num_partitions,
+          'depth': depth,
+          'seconds': TimeIt(_Run, opts.repeat),
+          'peak_bytes': peak,
+          'blocks': blocks,
+      })
+  return results
+
+
+def BenchLookup(cgpt, opts, _tempdir):
+  """Times looking up every partition of a table by num, label and type.
+
+  This is the access pattern of the validation and script writing loops,
+  which also fetch the metadata partition once per partition.
+  """
+  results = []
+  for num_partitions in opts.sizes:
+    layout = [{'num': 'metadata', 'type': 'blank'}]
+    layout += [{'num': num, 'label': 'P%d' % num, 'type': 'data', 'bytes': 1}
+               for num in range(1, num_partitions + 1)]
+    config = {'metadata': {}, 'layouts': {'base': layout}}
+    partitions = cgpt.GetPartitionTable(Options(), config, 'base')
+    def _Run():
+      for num in range(1, num_partitions + 1):
+        cgpt.GetPartitionByNumber(partitions, num)
+        cgpt.GetPartitionByLabel(partitions, 'P%d' % num)
+        cgpt.GetMetadataPartition(partitions)
+      cgpt.GetPartitionsByType(partitions, 'data')
+    results.append({
+        'partitions': num_partitions,
+        'seconds': TimeIt(_Run, opts.repeat),
+    })
+  return results
+
+
+def _TimeSteps(cgpt, opts, filename, image_types, adjust_part='',
+               script=None):
+  """Times the steps of building an image's partition script from a layout.
+
+  Args:
+    cgpt: The cgpt module.
+    opts: Benchmark options.
+    filename: Layout file.
+    image_types: Image types to get tables of; the first one is validated and
+      has its script written.
+    adjust_part: Value of --adjust_part.
+    script: File to write the partition script to.
+
+  Returns:
+    A dict with the best time of LoadPartitionConfig from a cold start,
+    GetPartitionTable for every image type, Validate and WritePartitionScript.
+    Steps which fail have their error reported instead.
+  """
+  options = Options(adjust_part)
+  def _Load():
+    ResetMemos(cgpt)
+    return cgpt.LoadPartitionConfig(filename)
+  config = _Load()
+  def _Tables():
+    for image_type in image_types:
+      cgpt.GetPartitionTable(options, config, image_type)
+  steps = (
+      ('load', _Load),
+      ('table', _Tables),
+      ('validate', lambda: cgpt.Validate(options, image_types[0], filename)),
+      ('write', lambda: cgpt.WritePartitionScript(options, image_types[0],
+                                                  filename, script)),
+  )
+  results = {}
+  for name, func in steps:
+    try:
+      results[name + '_seconds'] = TimeIt(func, opts.repeat)
+    except Exception as e:  # pylint: disable=broad-except
+      results[name + '_error'] = '%s: %s' % (type(e).__name__, e)
+  return results
+
+
+def BenchLayouts(cgpt, opts, tempdir):
+  """Times loading, validating and writing synthetic layouts.
+
+  Cases cover every combination of partition count, parent chain depth and
+  number of image types.
+  """
+  results = []
+  for num_partitions in opts.sizes:
+    for depth in opts.depths:
+      for num_layouts in opts.layout_counts:
+        casedir = os.path.join(tempdir, 'layouts_%d_%d_%d' %
+                               (num_partitions, depth, num_layouts))
+        os.mkdir(casedir)
+        filename = WriteStackedLayouts(casedir, num_partitions, depth,
+                                       num_layouts)
+        image_types = [x for x in cgpt.LoadPartitionConfig(filename)['layouts']
+                       if x != 'common']
+        case = {
+            'partitions': num_partitions,
+            'depth': depth,
+            'layouts': num_layouts,
+        }
+        case.update(_TimeSteps(cgpt, opts, filename, image_types,
+                               script=os.path.join(casedir, 'write_gpt.sh')))
+        results.append(case)
+  return results
+
+
+def BenchAdjust(cgpt, opts, tempdir):
+  """Times layouts with ever more --adjust_part adjustments.
+
+  Each adjustment grows a different partition, wrapping around once every
+  partition was adjusted.
+  """
+  results = []
+  for num_partitions in opts.sizes:
+    casedir = os.path.join(tempdir, 'adjust_%d' % num_partitions)
+    os.mkdir(casedir)
+    filename = WriteStackedLayouts(casedir, num_partitions, 1)
+    labels = ['P%d' % num for num in range(3, num_partitions + 1)]
+    for count in opts.adjust_counts:
+      adjust_part = ' '.join('%s:+1MiB' % labels[i % len(labels)]
+                             for i in range(count))
+      case = {'partitions': num_partitions, 'adjustments': count}
+      case.update(_TimeSteps(cgpt, opts, filename, ['base'], adjust_part,
+                             script=os.path.join(casedir, 'write_gpt.sh')))
+      results.append(case)
+  return results
+
+
+def WriteNandLayout(tempdir, size_gib):
+  """Writes a raw NAND layout for a device of |size_gib| GiB.
+
+  The device has 128 KiB erase blocks, 2% of which may be bad.  Each UBI or
+  NAND partition reserves about six standard deviations above the expected
+  number of bad blocks it gets: enough to pass validation, without making the
+  probability trivially zero.
+  """
+  erase_block_size = 128 * 1024
+  device_blocks = size_gib * 2**30 // erase_block_size
+  bad_blocks = device_blocks // 50
+
+  def _Partition(num, label, part_type, part_format, blocks):
+    fraction = bad_blocks / device_blocks
+    variance = (blocks * fraction * (1 - fraction) *
+                (device_blocks - blocks) / (device_blocks - 1))
+    reserved = int(blocks * fraction + 6 * math.sqrt(variance)) + 1
+    return {'num': num, 'label': label, 'type': part_type,
+            'format': part_format, 'size': blocks * erase_block_size,
+            'reserved_erase_blocks': reserved}
+
+  rootfs_blocks = device_blocks // 4
+  config = {
+      'metadata': {'block_size': 512, 'fs_block_size': 4096},
+      'layouts': {
+          'common': [
+              {'num': 'metadata', 'erase_block_size': erase_block_size,
+               'page_size': 4096, 'max_bad_erase_blocks': bad_blocks,
+               'size': '%d GiB' % size_gib, 'external_gpt': True},
+              _Partition(2, 'KERN-A', 'kernel', 'nand', 128),
+              _Partition(4, 'KERN-B', 'kernel', 'nand', 128),
+              _Partition(3, 'ROOT-A', 'rootfs', 'ubi', rootfs_blocks),
+              _Partition(5, 'ROOT-B', 'rootfs', 'ubi', rootfs_blocks),
+              _Partition(1, 'STATE', 'data', 'ubi', rootfs_blocks),
+          ],
+          'base': [],
+      },
+  }
+  filename = os.path.join(tempdir, 'nand_%d.json' % size_gib)
+  with open(filename, 'w') as f:
+    json.dump(config, f)
+  return filename
+
+
+def BenchNand(cgpt, opts, tempdir):
+  """Times validating raw NAND layouts of ever larger devices.
+
+  This is dominated by checking the odds of too many bad blocks falling in
+  each partition.
+  """
+  results = []
+  for size_gib in opts.nand_sizes:
+    filename = WriteNandLayout(tempdir, size_gib)
+    def _Run():
+      ResetMemos(cgpt)
+      cgpt.Validate(Options(), 'base', filename)
+    results.append({
+        'gib': size_gib,
+        'seconds': TimeIt(_Run, opts.repeat),
+    })
+  return results
+
+
+def BenchReal(cgpt, opts, tempdir):
+  """Times every image type of the layouts shipped in build_library.
+
+  common_disk_layout.json is only a parent of the others, so it is loaded as
+  part of them.  Steps a layout can't do, e.g. validating a NAND layout
+  missing the device geometry, are reported as errors rather than timed.
+  """
+  results = []
+  for filename in sorted(glob.glob(os.path.join(BUILD_LIBRARY,
+                                                '*disk_layout*.json'))):
+    try:
+      image_types = [x for x in cgpt.LoadPartitionConfig(filename)['layouts']
+                     if x != 'common']
+    except Exception:  # pylint: disable=broad-except
+      continue
+    for image_type in image_types:
+      case = {'layout': os.path.basename(filename), 'image_type': image_type}
+      case.update(_TimeSteps(cgpt, opts, filename, [image_type],
+                             script=os.path.join(tempdir, 'write_gpt.sh')))
+      results.append(case)
+  return results
+
+
+def ParseJSONWithLineComments(source):
+  """The JSON parser of cgpt.py before it supported trailing comments.
+
+  It is kept as the baseline of the json benchmark.
+  """
+  regex = re.compile(r'^\s*#.*')
+  return json.loads(''.join(regex.sub('', line)
+                            for line in source.splitlines(True)))
+
+
+def MakeCommentedLayout(num_lines):
+  """Returns a layout file of about |num_lines| lines with comments.
+
+  Like the shipped layouts, every partition is a multi-line object preceded by
+  a whole line comment.  There are no trailing comments, so the file can be
+  parsed by ParseJSONWithLineComments too.
+  """
+  lines = ['{', '  # The partitions of every image type.', '  "layouts": {',
+           '    "common": [']
+  num = 0
+  while len(lines) < num_lines - 3:
+    num += 1
+    lines += [
+        '      # Partition %d, with a # in its label.' % num,
+        '      {',
+        '        "num": %d,' % num,
+        '        "label": "PART-%d #%d",' % (num, num),
+        '        "type": "data",',
+        '        "size": "%d MiB"' % num,
+        '      },',
+    ]
+  lines[-1] = '      }'
+  lines += ['    ]', '  }', '}']
+  return '\n'.join(lines) + '\n'
+
+
+def BenchJSON(cgpt, opts, _tempdir):
+  """Times parsing layout files with comments.
+
+  The shipped layouts and synthetic ones of --json_lines lines are parsed by
+  cgpt.py and by ParseJSONWithLineComments, the baseline.
+  """
+  sources = []
+  for filename in sorted(glob.glob(os.path.join(BUILD_LIBRARY,
+                                                '*disk_layout*.json'))):
+    with open(filename) as f:
+      sources.append((os.path.basename(filename), f.read()))
+  for num_lines in opts.json_lines:
+    sources.append(('synthetic', MakeCommentedLayout(num_lines)))
+
+  results = []
+  for name, source in sources:
+    results.append({
+        'layout': name,
+        'lines': source.count('\n'),
+        'seconds': TimeIt(lambda: cgpt._ParseJSONWithComments(source),
+                          opts.repeat),
+        'baseline_seconds': TimeIt(lambda: ParseJSONWithLineComments(source),
+                                   opts.repeat),
+    })
+  return results
+
+
+# Command lines timed by the startup benchmark; LAYOUT is replaced with the
+# path of legacy_disk_layout.json and OUTPUT with a temporary file.
+STARTUP_COMMANDS = (
+    ('readblocksize', 'LAYOUT'),
+    ('readpartsize', 'usb', 'LAYOUT', '3'),
+    ('validate', 'usb', 'LAYOUT'),
+    ('write', 'usb', 'LAYOUT', 'OUTPUT'),
+    ('--help',),
+)
+
+
+def _GetImportMicroseconds(stderr):
+  """Returns the total import time in the output of python -X importtime."""
+  total = 0
+  for line in stderr.splitlines():
+    if not line.startswith('import time:'):
+      continue
+    _, cumulative, name = line.split('|')
+    # Only count top-level imports; nested ones are part of their cumulative.
+    if cumulative.strip().isdigit() and not name.startswith('  '):
+      total += int(cumulative)
+  return total
+
+
+def BenchStartup(_cgpt, opts, tempdir):
+  """Times running cgpt.py as a new process, as the build scripts do.
+
+  Each command is run --invocations times and the mean and best wall times
+  are reported, along with the total import time reported by one run under
+  python -X importtime.
+  """
+  replacements = {
+      'LAYOUT': os.path.join(BUILD_LIBRARY, 'legacy_disk_layout.json'),
+      'OUTPUT': os.path.join(tempdir, 'startup_output'),
+  }
+  # Time the runs without the user's resolved layout cache or server.
+  env = dict(os.environ)
+  env.pop('CGPT_CACHE_DIR', None)
+  env.pop('CGPT_SOCKET', None)
+
+  results = []
+  for command in STARTUP_COMMANDS:
+    argv = [sys.executable, opts.cgpt] + [replacements.get(x, x)
+                                          for x in command]
+    times = []
+    for _ in range(opts.invocations):
+      start = time.perf_counter()
+      subprocess.run(argv, env=env, stdout=subprocess.DEVNULL, check=True)
+      times.append(time.perf_counter() - start)
+    imports = subprocess.run(
+        [sys.executable, '-X', 'importtime'] + argv[1:], env=env,
+        stdout=subprocess.DEVNULL, stderr=subprocess.PIPE, check=True,
+        universal_newlines=True)
+    results.append({
+        'command': ' '.join(command),
+        'seconds': min(times),
+        'mean_seconds': sum(times) / len(times),
+        'import_seconds': _GetImportMicroseconds(imports.stderr) / 1e6,
+    })
+  return results
+
+
+BENCHMARKS = {
+    'adjust': BenchAdjust,
+    'json': BenchJSON,
+    'layouts': BenchLayouts,
+    'lookup': BenchLookup,
+    'memory': BenchMemory,
+    'merge': BenchMerge,
+    'nand': BenchNand,
+    'real': BenchReal,
+    'stack': BenchStack,
+    'startup': BenchStartup,
+}
+
+
+def _GetRevision(path):
+  """Returns the git commit |path| is checked out at, or None."""
+  try:
+    return subprocess.run(
+        ['git', 'rev-parse', 'HEAD'],
+        cwd=os.path.dirname(os.path.abspath(path)), stdout=subprocess.PIPE,
+        stderr=subprocess.DEVNULL, check=True,
+        universal_newlines=True).stdout.strip()
+  except (OSError, subprocess.CalledProcessError):
+    return None
+
+
+def _FormatCase(case):
+  """Formats the values of a benchmark case on one line."""
+  return ' '.join(
+      '%s=%.6f' % (k, v) if isinstance(v, float) else '%s=%s' % (k, v)
+      for k, v in sorted(case.items()))
+
+
+def Compare(old, new):
+  """Prints how much slower or faster each case of |new| is than in |old|.
+
+  Cases are matched on their parameters, i.e. the values which are not
+  floats.  Each measurement is printed as the ratio new / old.
+  """
+  for name, cases in sorted(new['benchmarks'].items()):
+    old_cases = {}
+    for case in old['benchmarks'].get(name, []):
+      params = _FormatCase({k: v for k, v in case.items()
+                            if not isinstance(v, float)})
+      old_cases[params] = case
+    for case in cases:
+      params = _FormatCase({k: v for k, v in case.items()
+                            if not isinstance(v, float)})
+      old_case = old_cases.get(params)
+      if old_case is None:
+        continue
+      ratios = ['%s=%.2fx' % (k, v / old_case[k])
+                for k, v in sorted(case.items())
+                if isinstance(v, float) and old_case.get(k)]
+      print('%-8s %s %s' % (name, params, ' '.join(ratios)))
+
+
+def _IntList(value):
+  """Parses a comma separated list of integers."""
+  return [int(x) for x in value.split(',')]
+
+
+def GetParser():
+  """Return a parser for the CLI."""
+  parser = argparse.ArgumentParser(
+      description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+  parser.add_argument('--cgpt', metavar='PATH',
+                      default=os.path.join(os.path.dirname(
+                          os.path.abspath(__file__)), 'cgpt.py'),
+                      help='cgpt.py to benchmark (default: %(default)s)')
+  parser.add_argument('--json', metavar='FILE',
+                      help='also write the results to FILE as JSON')
+  parser.add_argument('--repeat', type=int, default=5,
+                      help='runs per case; the best time is reported')
+  parser.add_argument('--sizes', type=_IntList,
+                      default=[50, 100, 200, 400, 800],
+                      help='comma separated partition counts')
+  parser.add_argument('--depths', type=_IntList, default=[1, 4, 16],
+                      help='comma separated parent chain depths')
+  parser.add_argument('--layout_counts', type=_IntList, default=[3, 12],
+                      help='comma separated numbers of image types')
+  parser.add_argument('--adjust_counts', type=_IntList, default=[0, 10, 100],
+                      help='comma separated numbers of --adjust_part '
+                           'adjustments')
+  parser.add_argument('--nand_sizes', type=_IntList, default=[1, 2, 4],
+                      help='comma separated NAND device sizes in GiB')
+  parser.add_argument('--json_lines', type=_IntList, default=[10000],
+                      help='comma separated line counts of the synthetic '
+                           'layouts parsed by the json benchmark')
+  parser.add_argument('--invocations', type=int, default=20,
+                      help='processes started per command by the startup '
+                           'benchmark')
+  parser.add_argument('--compare', metavar='FILE',
+                      help='print the ratios of the results to those saved '
+                           'with --json in FILE')
+  parser.add_argument('benchmarks', nargs='*', metavar='BENCHMARK',
+                      help='benchmarks to run (default: all); one of %s' %
+                      ', '.join(sorted(BENCHMARKS)))
+  return parser
+
+
+def main(argv):
+  parser = GetParser()
+  opts = parser.parse_args(argv)
+  unknown = set(opts.benchmarks) - set(BENCHMARKS)
+  if unknown:
+    parser.error('unknown benchmarks: %s' % ', '.join(sorted(unknown)))
+  cgpt = LoadCgpt(opts.cgpt)
+
+  results = {
+      'cgpt': os.path.abspath(opts.cgpt),
+      'revision': _GetRevision(opts.cgpt),
+      'python': platform.python_version(),
+      'benchmarks': {},
+  }
+  tempdir = tempfile.mkdtemp(prefix='cgpt-benchmark_')
+  try:
+    for name in opts.benchmarks or sorted(BENCHMARKS):
+      cases = BENCHMARKS[name](cgpt, opts, tempdir)
+      results['benchmarks'][name] = cases
+      for case in cases:
+        print('%-8s %s' % (name, _FormatCase(case)))
+  finally:
+    shutil.rmtree(tempdir)
+
+  if opts.compare:
+    with open(opts.compare) as f:
+      Compare(json.load(f), results)
+  if opts.json:
+    with open(opts.json, 'w') as f:
+      json.dump(results, f, indent=2, sort_keys=True)
+
+
+if __name__ == '__main__':
+  sys.exit(main(sys.argv[1:]))
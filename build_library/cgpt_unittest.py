@@ -10,12 +10,23 @@
 
 from __future__ import print_function
 
+import contextlib
+import io
+import json
 import os
+import re
+import shlex
 import shutil
+import signal
+import struct
+import subprocess
+import sys
 import tempfile
+import time
 import unittest
 
 import cgpt
+import gpt_image
 
 
 class JSONLoadingTest(unittest.TestCase):
@@ -51,18 +62,28 @@ class JSONLoadingTest(unittest.TestCase):
     self.assertEqual(cgpt._LoadStackedPartitionConfig(self.layout_json),
                      {'layouts': {'common': []}})
 
-  def testJSONCommentsLimitations(self):
-    """Test that we can't parse inline comments in JSON.
+  def testJSONInlineComments(self):
+    """Test that comments can follow a value, but not be in a string."""
+    with open(self.layout_json, 'w') as f:
+      f.write("""{
+    "layouts": { # This is an inline comment.
+        "common": [{"label": "#1 \\"#2\\" \\\\", # Not a \\" string.
+                    "type": "data"}]}}  # The end.""")
+    self.assertEqual(cgpt._LoadStackedPartitionConfig(self.layout_json),
+                     {'layouts': {'common': [{'label': '#1 "#2" \\',
+                                              'type': 'data'}]}})
 
-    If we ever enable this, we need to change the README.disk_layout
-    documentation to mention it.
-    """
+  def testJSONErrorPosition(self):
+    """Test that errors are reported at their position in the file."""
     with open(self.layout_json, 'w') as f:
       f.write("""{
-    "layouts": { # This is an inline comment, but is not supported.
-        "common": []}}""")
-    self.assertRaises(ValueError,
-                      cgpt._LoadStackedPartitionConfig, self.layout_json)
+  # A comment.
+  "layouts": {  # Another comment.
+    "common": [],}}""")
+    with self.assertRaises(ValueError) as e:
+      cgpt.LoadJSONWithComments(self.layout_json)
+    self.assertEqual((e.exception.lineno, e.exception.colno), (4, 18))
+    self.assertEqual(e.exception.pos, 69)
 
   def testPartitionOrderPreserved(self):
     """Test that the order of the partitions is the same as in the parent."""
@@ -113,6 +134,46 @@ class JSONLoadingTest(unittest.TestCase):
     layout = cgpt._LoadStackedPartitionConfig(self.layout_json)
     self.assertEqual(parent_layout, layout)
 
+  def testSharedParentLoadedOnce(self):
+    """Test that a parent reached through several paths is parsed once."""
+    files = {
+        'child.json': '{"parent": "a.json b.json", "layouts": {"base": []}}',
+        'a.json': """{"parent": "root.json",
+                      "layouts": {"common": [{"num": 1, "name": "A"}]}}""",
+        'b.json': """{"parent": "root.json",
+                      "layouts": {"common": [{"num": 2, "name": "B"}]}}""",
+        'root.json': """{"layouts": {"common": [{"num": 1}, {"num": 2}],
+                                     "base": []}}""",
+    }
+    for name, data in files.items():
+      with open(os.path.join(self.tempdir, name), 'w') as f:
+        f.write(data)
+
+    parsed = []
+    original = cgpt._ParseJSONWithComments
+    def _Parse(source):
+      parsed.append(source)
+      return original(source)
+    cgpt._ParseJSONWithComments = _Parse
+    try:
+      config = cgpt._LoadStackedPartitionConfig(
+          os.path.join(self.tempdir, 'child.json'))
+    finally:
+      cgpt._ParseJSONWithComments = original
+
+    self.assertEqual(len(parsed), len(files))
+    self.assertEqual(config['layouts']['base'],
+                     [{'num': 1, 'name': 'A'}, {'num': 2, 'name': 'B'}])
+
+  def testCyclicParents(self):
+    """Test that layouts inheriting from each other in a loop are rejected."""
+    with open(self.layout_json, 'w') as f:
+      f.write('{"parent": "test_layout_parent.json", "layouts": {}}')
+    with open(self.parent_layout_json, 'w') as f:
+      f.write('{"parent": "test_layout.json", "layouts": {}}')
+    self.assertRaises(cgpt.CyclicLayoutParents,
+                      cgpt._LoadStackedPartitionConfig, self.layout_json)
+
   def testGetStartByteOffsetIsAccurate(self):
     """Test that padding_bytes results in a valid start sector."""
 
@@ -283,6 +344,36 @@ class JSONLoadingTest(unittest.TestCase):
                 ]
             }})
 
+  def testOverridesMergedInOrder(self):
+    """Test that new partitions and gaps land where the child puts them."""
+    layout_to_override = [
+        {'num': 1},
+        {'type': 'blank', 'size': '1 MiB'},
+        {'num': 2},
+        {'num': 3},
+        {'num': 4},
+    ]
+    layout = [
+        {'num': 1},
+        {'size': '2 MiB'},
+        {'num': 10},
+        {'num': 3, 'label': 'three'},
+        {'num': 11},
+        {'num': 4},
+        {'num': 12},
+    ]
+    cgpt._ApplyLayoutOverrides(layout_to_override, layout)
+    self.assertEqual(layout_to_override, [
+        {'num': 1},
+        {'type': 'blank', 'size': '2 MiB'},
+        {'num': 10},
+        {'num': 2},
+        {'num': 3, 'label': 'three'},
+        {'num': 11},
+        {'num': 4},
+        {'num': 12},
+    ])
+
   def testFileSystemSizeMustBePositive(self):
     """Test that zero or negative file system size will raise exception."""
     with open(self.layout_json, 'w') as f:
@@ -516,6 +607,341 @@ class JSONLoadingTest(unittest.TestCase):
         })
 
 
+class ConfigCacheTest(unittest.TestCase):
+  """Test the persistent cache of resolved layouts."""
+
+  def setUp(self):
+    self.tempdir = tempfile.mkdtemp(prefix='cgpt-test_')
+    self.cache_dir = os.path.join(self.tempdir, 'cache')
+    self.layout_json = os.path.join(self.tempdir, 'test_layout.json')
+    self.parent_layout_json = os.path.join(self.tempdir, 'parent.json')
+    with open(self.parent_layout_json, 'w') as f:
+      f.write("""{
+  "metadata": {"block_size": 512, "fs_block_size": 4096},
+  "layouts": {"common": [{"num": 1, "label": "STATE", "type": "data",
+                          "size": "4 MiB"}],
+              "base": []}
+}""")
+    with open(self.layout_json, 'w') as f:
+      f.write('{"parent": "parent.json", "layouts": {"base": []}}')
+
+  def tearDown(self):
+    shutil.rmtree(self.tempdir)
+
+  def testCacheHitSkipsLoading(self):
+    """Test that a cache hit does not parse or merge the layouts again."""
+    config = cgpt.LoadPartitionConfig(self.layout_json,
+                                      cache_dir=self.cache_dir)
+    # Forget the configs loaded by this process, like a new process would.
+    cgpt._LOADED_CONFIGS.clear()
+    original = cgpt._LoadStackedPartitionConfig
+    def _Fail(*_args, **_kwargs):
+      raise AssertionError('layout was loaded despite a cache hit')
+    cgpt._LoadStackedPartitionConfig = _Fail
+    try:
+      cached = cgpt.LoadPartitionConfig(self.layout_json,
+                                        cache_dir=self.cache_dir)
+    finally:
+      cgpt._LoadStackedPartitionConfig = original
+    self.assertEqual(config, cached)
+
+  def testParentChangeInvalidates(self):
+    """Test that editing a parent file invalidates the cached config."""
+    config = cgpt.LoadPartitionConfig(self.layout_json,
+                                      cache_dir=self.cache_dir)
+    self.assertEqual(config['layouts']['base'][0]['bytes'], 4 * 2**20)
+    with open(self.parent_layout_json) as f:
+      data = f.read()
+    with open(self.parent_layout_json, 'w') as f:
+      f.write(data.replace('4 MiB', '8 MiB'))
+    config = cgpt.LoadPartitionConfig(self.layout_json,
+                                      cache_dir=self.cache_dir)
+    self.assertEqual(config['layouts']['base'][0]['bytes'], 8 * 2**20)
+
+    # The cache on disk must be invalidated as well as the one in memory.
+    cgpt._LOADED_CONFIGS.clear()
+    with open(self.parent_layout_json, 'w') as f:
+      f.write(data)
+    config = cgpt.LoadPartitionConfig(self.layout_json,
+                                      cache_dir=self.cache_dir)
+    self.assertEqual(config['layouts']['base'][0]['bytes'], 4 * 2**20)
+
+  def testNewSiblingParentInvalidates(self):
+    """Test that a parent created next to its child replaces the global one."""
+    with open(self.layout_json, 'w') as f:
+      f.write('{"parent": "legacy_disk_layout.json", "layouts": {"base": []}}')
+    config = cgpt.LoadPartitionConfig(self.layout_json,
+                                      cache_dir=self.cache_dir)
+    self.assertNotEqual(len(config['layouts']['base']), 1)
+
+    shutil.copy(self.parent_layout_json,
+                os.path.join(self.tempdir, 'legacy_disk_layout.json'))
+    config = cgpt.LoadPartitionConfig(self.layout_json,
+                                      cache_dir=self.cache_dir)
+    self.assertEqual([x['label'] for x in config['layouts']['base']],
+                     ['STATE'])
+    cgpt._LOADED_CONFIGS.clear()
+    config = cgpt.LoadPartitionConfig(self.layout_json,
+                                      cache_dir=self.cache_dir)
+    self.assertEqual([x['label'] for x in config['layouts']['base']],
+                     ['STATE'])
+
+  def testClearCache(self):
+    """Test that clearcache empties the cache directory."""
+    cgpt.LoadPartitionConfig(self.layout_json, cache_dir=self.cache_dir)
+    self.assertTrue(os.listdir(self.cache_dir))
+    class Options(object):
+      """Fake options"""
+      cache_dir = self.cache_dir
+    cgpt.ClearConfigCache(Options())
+    self.assertEqual(os.listdir(self.cache_dir), [])
+
+  def testCacheIsOptIn(self):
+    """Test that only $CGPT_CACHE_DIR or --cache_dir enable the cache."""
+    environ = os.environ.copy()
+    try:
+      os.environ.pop('CGPT_CACHE_DIR', None)
+      self.assertIsNone(cgpt.GetParser().parse_args(['clearcache']).cache_dir)
+      os.environ['CGPT_CACHE_DIR'] = self.cache_dir
+      self.assertEqual(
+          cgpt.GetParser().parse_args(['clearcache']).cache_dir, self.cache_dir)
+    finally:
+      os.environ.clear()
+      os.environ.update(environ)
+
+
+class PartitionTableTest(unittest.TestCase):
+  """Test the partition table object model."""
+
+  LAYOUT = [
+      {'num': 'metadata', 'type': 'blank', 'erase_block_size': 4096},
+      {'type': 'blank', 'size': '1 MiB'},
+      {'num': 4, 'label': 'KERN-B', 'type': 'kernel'},
+      {'num': 2, 'label': 'KERN-A', 'type': 'kernel'},
+      {'num': 3, 'label': 'ROOT-A', 'type': 'rootfs'},
+      {'num': 5, 'label': 'ROOT-A', 'type': 'rootfs'},
+  ]
+
+  def testLookupsMatchListHelpers(self):
+    """Test that the indexes answer like a scan of a plain list."""
+    table = cgpt.PartitionTable(self.LAYOUT)
+    for partitions in (self.LAYOUT, table):
+      self.assertIs(cgpt.GetPartitionByNumber(partitions, '3'), self.LAYOUT[4])
+      self.assertIs(cgpt.GetPartitionByLabel(partitions, 'ROOT-A'),
+                    self.LAYOUT[4])
+      self.assertEqual(cgpt.GetPartitionsByType(partitions, 'kernel'),
+                       [self.LAYOUT[3], self.LAYOUT[2]])
+      self.assertIs(cgpt.GetMetadataPartition(partitions), self.LAYOUT[0])
+      self.assertRaises(cgpt.PartitionNotFound,
+                        cgpt.GetPartitionByNumber, partitions, 7)
+      self.assertRaises(cgpt.PartitionNotFound,
+                        cgpt.GetPartitionByLabel, partitions, 'STATE')
+    self.assertEqual(cgpt.GetMetadataPartition(self.LAYOUT[1:]), {})
+
+  def testPartitionCopiesOnWrite(self):
+    """Test that writes to a Partition never reach the layout."""
+    base = {'num': 3, 'label': 'ROOT-A', 'bytes': 1}
+    partition = cgpt.Partition(base)
+    self.assertEqual(partition, base)
+    partition['bytes'] += 1
+    partition['fs_bytes'] = 1
+    del partition['label']
+    self.assertEqual(partition, {'num': 3, 'bytes': 2, 'fs_bytes': 1})
+    self.assertEqual(len(partition), 3)
+    self.assertEqual(base, {'num': 3, 'label': 'ROOT-A', 'bytes': 1})
+    self.assertRaises(AttributeError, setattr, partition, 'extra', 1)
+
+  def testTablesShareUnchangedPartitions(self):
+    """Test that only partitions GetPartitionTable changes are copied."""
+    class Options(object):
+      """Fake options"""
+      adjust_part = ''
+      hashpad = 'legacy'
+      verity_hash_alg = 'sha256'
+    config = {'metadata': {'fs_block_size': 4096}, 'layouts': {'base': [
+        {'num': 1, 'label': 'STATE', 'type': 'data'},
+        {'num': 3, 'label': 'ROOT-A', 'type': 'rootfs', 'fs_format': 'ext2',
+         'fs_options': {'ext2': '-i 65536'}},
+    ]}}
+    table = cgpt.GetPartitionTable(Options(), config, 'base')
+    self.assertEqual([x._changes for x in table],
+                     [None, {'fs_options': '-i 65536'}])
+    self.assertEqual(table[0].get('fs_options', ''), '')
+
+
+class ParserTest(unittest.TestCase):
+  """Test the command line parsers."""
+
+  def testPeekCommand(self):
+    """Test that only unambiguous command lines skip the full parser."""
+    self.assertEqual(cgpt._PeekCommand(['readblocksize', 'x']), 'readblocksize')
+    self.assertEqual(cgpt._PeekCommand(
+        ['--adjust_part', 'ROOT-A:+1M', '--no_cache', 'readlabel', 'usb']),
+                     'readlabel')
+    self.assertEqual(cgpt._PeekCommand(['--output_format=json', 'query']),
+                     'query')
+    self.assertIsNone(cgpt._PeekCommand([]))
+    self.assertIsNone(cgpt._PeekCommand(['--help', 'readblocksize']))
+    self.assertIsNone(cgpt._PeekCommand(['--adj', 'X', 'readblocksize']))
+    self.assertIsNone(cgpt._PeekCommand(['--adjust_part', 'write', 'base']))
+    self.assertIsNone(cgpt._PeekCommand(['nosuchcommand']))
+
+  def testSingleCommandParser(self):
+    """Test that a single command parser parses and helps like the full one."""
+    for argv in (['readblocksize', 'layout.json'],
+                 ['--adjust_part', 'ROOT-A:+1M', 'readpartsize', 'usb',
+                  'layout.json', '3'],
+                 ['--no_cache', 'clearcache']):
+      command = cgpt._PeekCommand(argv)
+      self.assertIsNotNone(command)
+      full = vars(cgpt.GetParser().parse_args(argv))
+      single = vars(cgpt.GetParser(command).parse_args(argv))
+      del full['help_all'], single['help_all']
+      self.assertEqual(full, single)
+
+    for argv in (['readpartsize', '--help'], ['readpartsize'],
+                 ['--output_format', 'xml', 'readpartsize', 'usb',
+                  'layout.json', '3']):
+      outputs = []
+      for parser in (cgpt.GetParser(), cgpt.GetParser('readpartsize')):
+        output = io.StringIO()
+        with contextlib.redirect_stdout(output), \
+             contextlib.redirect_stderr(output):
+          self.assertRaises(SystemExit, parser.parse_args, argv)
+        outputs.append(output.getvalue())
+      self.assertEqual(outputs[0], outputs[1])
+
+
+class ServerTest(unittest.TestCase):
+  """Test the layout server and its client."""
+
+  LAYOUT_DIR = os.path.dirname(os.path.abspath(__file__))
+
+  def setUp(self):
+    self.tempdir = tempfile.mkdtemp(prefix='cgpt-test_')
+    self.socket = os.path.join(self.tempdir, 'cgpt.sock')
+
+  def tearDown(self):
+    shutil.rmtree(self.tempdir)
+
+  def _Request(self, parsers, argv, cwd=None, environ=None):
+    """Runs |argv| like a server request and returns the response lines."""
+    return cgpt._RunServerRequest(parsers, cgpt._EncodeServerRequest(
+        cwd or os.getcwd(), environ or {}, argv))
+
+  def testRequest(self):
+    """Test that requests answer like the command line does."""
+    parsers = {}
+    self.assertEqual(
+        self._Request(parsers, ['--no_cache', 'readpartsize', 'usb',
+                                'legacy_disk_layout.json', '3'],
+                      cwd=self.LAYOUT_DIR),
+        ['out:%d' % (2 * 2**30), 'exit:0'])
+
+    response = self._Request(parsers, [
+        '--no_cache', 'readpartsize', 'usb',
+        os.path.join(self.LAYOUT_DIR, 'legacy_disk_layout.json'), '42'])
+    self.assertEqual(response[-2:],
+                     ['err:cgpt.PartitionNotFound: Partition 42 not found',
+                      'exit:1'])
+
+    self.assertEqual(self._Request(parsers, ['nosuchcommand'])[-1], 'exit:2')
+    self.assertEqual(self._Request(parsers, ['serve'])[-1], 'exit:1')
+    self.assertEqual(cgpt._RunServerRequest(parsers, b'cwd=/')[-1], 'exit:1')
+
+  def testRequestArguments(self):
+    """Test that arguments reach the server as they are."""
+    layout = os.path.join(self.tempdir, "it's a\nlayout \x01$(x).json")
+    shutil.copy(os.path.join(self.LAYOUT_DIR, 'legacy_disk_layout.json'),
+                layout)
+    argv = ['--no_cache', 'readpartsize', 'usb', layout, '3']
+    self.assertEqual(self._Request({}, argv),
+                     ['out:%d' % (2 * 2**30), 'exit:0'])
+
+    # The shell client encodes requests the same way.
+    with open(os.path.join(self.LAYOUT_DIR, 'disk_layout_util.sh')) as f:
+      function = re.search(r'^cgpt_py_request\(\) {.*?^}$', f.read(),
+                           re.M | re.S).group(0)
+    request = subprocess.check_output(
+        ['bash', '-c', function + '\ncgpt_py_request "$@"', 'bash'] + argv,
+        cwd=self.tempdir, env={'PATH': os.environ['PATH'],
+                               'CGPT_CACHE_DIR': '/cache'})
+    self.assertEqual(cgpt._DecodeServerRequest(request),
+                     (os.path.realpath(self.tempdir),
+                      {'CGPT_CACHE_DIR': '/cache'}, argv))
+
+  def testRequestEnvironment(self):
+    """Test that commands see the environment of the client."""
+    parsers = {}
+    # A layout this process has not loaded yet, for it to reach the cache.
+    layout = os.path.join(self.tempdir, 'legacy_disk_layout.json')
+    shutil.copy(os.path.join(self.LAYOUT_DIR, 'legacy_disk_layout.json'),
+                layout)
+    cache_dir = os.path.join(self.tempdir, 'cache')
+    environ = os.environ.copy()
+    os.environ['CGPT_CACHE_DIR'] = os.path.join(self.tempdir, 'server')
+    try:
+      for _ in range(2):
+        self.assertEqual(
+            self._Request(parsers, ['readpartsize', 'usb', layout, '3'],
+                          environ={'CGPT_CACHE_DIR': cache_dir})[-1],
+            'exit:0')
+        self.assertEqual(
+            self._Request(parsers, ['readpartsize', 'usb', layout, '3'])[-1],
+            'exit:0')
+      self.assertEqual(os.environ['CGPT_CACHE_DIR'],
+                       os.path.join(self.tempdir, 'server'))
+    finally:
+      os.environ.clear()
+      os.environ.update(environ)
+    self.assertTrue(os.listdir(cache_dir))
+    self.assertFalse(os.path.exists(os.path.join(self.tempdir, 'server')))
+
+  def testRequestSeesNewParent(self):
+    """Test that loaded layouts are dropped when a closer parent appears."""
+    parsers = {}
+    layout = os.path.join(self.tempdir, 'legacy_disk_layout.json')
+    shutil.copy(os.path.join(self.LAYOUT_DIR, 'legacy_disk_layout.json'),
+                layout)
+    argv = ['--no_cache', 'readpartitionnums', 'base', layout]
+    response = self._Request(parsers, argv)
+    self.assertNotIn('99', response[0].split())
+
+    with open(os.path.join(self.tempdir, 'common_disk_layout.json'), 'w') as f:
+      f.write('{"layouts": {"common": [{"num": 99, "label": "EXTRA", '
+              '"type": "data", "size": "1 MiB"}]}}')
+    response = self._Request(parsers, argv)
+    self.assertIn('99', response[0].split())
+
+  def testClientWithoutServer(self):
+    """Test that the client reports when there is no server to talk to."""
+    self.assertIsNone(cgpt._RunOnServer(self.socket, ['readimagetypes']))
+
+  def testServe(self):
+    """Test a real server end to end."""
+    env = dict(os.environ)
+    env.pop('CGPT_CACHE_DIR', None)
+    server = subprocess.Popen(
+        [sys.executable, os.path.join(self.LAYOUT_DIR, 'cgpt.py'),
+         '--socket', self.socket, 'serve'], env=env)
+    try:
+      for _ in range(100):
+        if os.path.exists(self.socket):
+          break
+        time.sleep(0.1)
+      stdout = io.StringIO()
+      with contextlib.redirect_stdout(stdout):
+        ret = cgpt._RunOnServer(
+            self.socket, ['--no_cache', 'readpartsize', 'usb', os.path.join(
+                self.LAYOUT_DIR, 'legacy_disk_layout.json'), '3'])
+      self.assertEqual(ret, 0)
+      self.assertEqual(stdout.getvalue(), '%d\n' % (2 * 2**30))
+    finally:
+      server.send_signal(signal.SIGINT)
+      server.wait()
+    self.assertFalse(os.path.exists(self.socket))
+
+
 class UtilityTest(unittest.TestCase):
   """Test various utility functions in cgpt.py."""
 
@@ -572,6 +998,794 @@ class UtilityTest(unittest.TestCase):
     for n in test_cases:
       self.assertEqual(cgpt.ParseHumanNumber(cgpt.ProduceHumanNumber(n)), n)
 
+  def testBadBlockFailureProbability(self):
+    """Test the bad block probability against the exact binomial sums."""
+    for device_blocks, bad, partition_blocks in ((100, 10, 30), (1024, 20, 1),
+                                                 (1024, 20, 1020),
+                                                 (1024, 40, 256), (50, 50, 7)):
+      distributions = cgpt.Combinations(device_blocks, bad)
+      for reserved in range(bad + 2):
+        expected = sum(
+            cgpt.Combinations(partition_blocks, k) *
+            cgpt.Combinations(device_blocks - partition_blocks, bad - k)
+            for k in range(reserved + 1, bad + 1)) / distributions
+        self.assertAlmostEqual(
+            cgpt.BadBlockFailureProbability(device_blocks, bad,
+                                            partition_blocks, reserved),
+            expected, delta=max(expected, 1e-300) * 1e-9)
+
+  def testVerityHashTreeSize(self):
+    """Test the hash tree size against building the tree level by level."""
+    for hash_alg, digests in (('sha256', 128), ('sha1', 128),
+                              ('sha512', 64)):
+      for fs_bytes in (4096, 128 * 4096, 128 * 4096 + 1, 1991 * 2**20,
+                       2**34, 2**34 + 4096):
+        blocks = -(-fs_bytes // 4096)
+        hash_blocks = 0
+        while True:
+          blocks = -(-blocks // digests)
+          hash_blocks += blocks
+          if blocks == 1:
+            break
+        self.assertEqual(cgpt.GetVerityHashTreeSize(fs_bytes, hash_alg),
+                         hash_blocks * 4096)
+    self.assertEqual(cgpt.GetVerityHashTreeSize(1991 * 2**20),
+                     (3982 + 32 + 1) * 4096)
+    self.assertRaises(cgpt.InvalidHashAlgorithm,
+                      cgpt.GetVerityHashTreeSize, 2**20, 'bogus')
+
+
+class CommandTest(unittest.TestCase):
+  """Test the CLI commands against the shipped layouts."""
+
+  LAYOUT = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                        'legacy_disk_layout.json')
+
+  class Options(object):
+    """Fake options"""
+    adjust_part = ''
+    output_format = 'shell'
+    cache_dir = None
+    disk_size = None
+    block_size = cgpt.DEFAULT_SECTOR_SIZE
+    jobs = None
+    if_changed = False
+    hashpad = 'legacy'
+    verity_hash_alg = 'sha256'
+    headroom = '10%'
+
+  def setUp(self):
+    self.tempdir = tempfile.mkdtemp(prefix='cgpt-test_')
+
+  def tearDown(self):
+    shutil.rmtree(self.tempdir)
+
+  def _RunWriteScript(self, image_type, disk_size, block_size,
+                      layout=LAYOUT):
+    """Runs the write command's script with a fake cgpt, returning its calls."""
+    script = os.path.join(self.tempdir, 'write_gpt.sh')
+    cgpt.WritePartitionScript(self.Options(), image_type, layout, script)
+    target = os.path.join(self.tempdir, 'disk.bin')
+    open(target, 'w').close()
+    stubs = '\n'.join((
+        'numsectors() { echo %d; }' % (disk_size // block_size),
+        'blocksize() { echo %d; }' % block_size,
+        'locate_gpt() { GPT=fake_cgpt; }',
+        'fake_cgpt() { echo "$@"; }',
+        '. "%s"' % script,
+        'write_partition_table "%s" pmbr' % target,
+    ))
+    output = subprocess.check_output(['sh', '-c', stubs],
+                                     universal_newlines=True)
+    return [line.split()[:-1] for line in output.splitlines()]
+
+  @staticmethod
+  def _GetTable(calls):
+    """Returns the settings of every partition after the cgpt |calls|."""
+    table = {}
+    for call in calls:
+      if call[0] == 'create':
+        table = {}
+      elif call[0] in ('add', 'boot'):
+        flags = dict(zip(call[1::2], call[2::2]))
+        table.setdefault((call[0], flags.pop('-i', None)), {}).update(flags)
+    return table
+
+  def testPlanMatchesWriteScript(self):
+    """Test that the plan places partitions like the write command's script."""
+    self.addCleanup(setattr, cgpt, 'SPECIALIZED_BLOCK_SIZES',
+                    cgpt.SPECIALIZED_BLOCK_SIZES)
+    cgpt.SPECIALIZED_BLOCK_SIZES = ()
+    for image_type in ('base', 'usb'):
+      for disk_size, block_size in ((16 * 2**30, 512), (16 * 2**30, 4096)):
+        options = self.Options()
+        options.output_format = 'json'
+        options.disk_size = str(disk_size)
+        options.block_size = str(block_size)
+        plan = json.loads(cgpt.GetPartitionPlan(options, image_type,
+                                                self.LAYOUT))
+        calls = self._RunWriteScript(image_type, disk_size, block_size)
+        self.assertEqual(
+            [(x['num'], x['start'], x['size']) for x in plan['partitions']],
+            [(int(x[2]), int(x[4]), int(x[6])) for x in calls
+             if x[0] == 'add' and x[3] == '-b'])
+
+  def testSpecializedWriteScript(self):
+    """Test that the branches for known block sizes write the same table."""
+    self.addCleanup(setattr, cgpt, 'SPECIALIZED_BLOCK_SIZES',
+                    cgpt.SPECIALIZED_BLOCK_SIZES)
+    layout_v3 = os.path.join(os.path.dirname(self.LAYOUT),
+                             'disk_layout_v3.json')
+    for layout, image_type in ((self.LAYOUT, 'usb'), (self.LAYOUT, 'base'),
+                               (layout_v3, 'base')):
+      for block_size in (512, 4096):
+        cgpt.SPECIALIZED_BLOCK_SIZES = (512, 4096)
+        calls = self._RunWriteScript(image_type, 32 * 2**30, block_size,
+                                     layout=layout)
+        # One call per partition, plus create and boot.
+        adds = [x for x in calls if x[0] == 'add']
+        self.assertEqual(len(adds), len({x[2] for x in adds}))
+        cgpt.SPECIALIZED_BLOCK_SIZES = ()
+        generic = self._RunWriteScript(image_type, 32 * 2**30, block_size,
+                                       layout=layout)
+        self.assertGreater(len(generic), len(calls))
+        self.assertEqual(self._GetTable(calls), self._GetTable(generic))
+
+  def testPlanDefaultDiskSize(self):
+    """Test that the expanding partition fits the image the script creates."""
+    options = self.Options()
+    values = {}
+    for line in cgpt.GetPartitionPlan(options, 'usb', self.LAYOUT).split('\n'):
+      name, value = line.split('=', 1)
+      values[name] = shlex.split(value)[0]
+    stateful = cgpt.GetPartitionSize(options, 'usb', self.LAYOUT, 1)
+    self.assertGreaterEqual(int(values['CGPT_USB_1_BLOCKS']) * 512, stateful)
+    self.assertLess(int(values['CGPT_USB_1_END']) * 512 +
+                    cgpt.SECONDARY_GPT_BYTES,
+                    int(values['CGPT_USB_DISK_SIZE']))
+
+  def testVmLayout(self):
+    """Test that the VM disk is the smallest holding the stateful partition."""
+    self.addCleanup(setattr, cgpt, 'SPECIALIZED_BLOCK_SIZES',
+                    cgpt.SPECIALIZED_BLOCK_SIZES)
+    cgpt.SPECIALIZED_BLOCK_SIZES = ()
+    options = self.Options()
+    options.output_format = 'json'
+    for block_size, stateful_size in ((512, 4 * 2**30), (512, 2**30 + 1),
+                                      (4096, 4 * 2**30)):
+      options.block_size = str(block_size)
+      vm = json.loads(cgpt.GetVmLayout(options, 'usb', self.LAYOUT,
+                                       str(stateful_size)))
+      blocks = -(-stateful_size // block_size)
+      stateful = [x for x in vm['partitions'] if x['num'] == 1][0]
+      self.assertEqual(stateful['size'], blocks)
+      self.assertEqual(vm['disk_size'] % block_size, 0)
+      options.disk_size = str(vm['disk_size'])
+      self.assertEqual(json.loads(cgpt.GetPartitionPlan(options, 'usb',
+                                                        self.LAYOUT)), vm)
+      options.disk_size = None
+
+      calls = self._RunWriteScript('usb', vm['disk_size'], block_size)
+      self.assertIn(['add', '-i', '1', '-b', str(stateful['start']),
+                     '-s', str(blocks)], [x[:7] for x in calls])
+      calls = self._RunWriteScript('usb', vm['disk_size'] - block_size,
+                                   block_size)
+      self.assertIn(['add', '-i', '1', '-b', str(stateful['start']),
+                     '-s', str(blocks - 1)], [x[:7] for x in calls])
+
+    options.block_size = '512'
+    layout = self._WriteNandLayout()
+    self.assertRaises(cgpt.InvalidLayout, cgpt.GetVmLayout, options, 'base',
+                      layout, '1GiB')
+    self.assertRaises(cgpt.InvalidSize, cgpt.GetVmLayout, options, 'usb',
+                      self.LAYOUT, '0')
+
+  def testWriteGpt(self):
+    """Test that writegpt writes the table the write command's script does."""
+    pmbr = os.path.join(self.tempdir, 'pmbr.bin')
+    with open(pmbr, 'wb') as f:
+      f.write(b'\xeb' * 512)
+    script = os.path.join(self.tempdir, 'write_gpt.sh')
+    cgpt.WritePartitionScript(self.Options(), 'usb', self.LAYOUT, script)
+    with open(script) as f:
+      script = f.read()
+
+    for func in ('partition', 'base'):
+      image = os.path.join(self.tempdir, '%s.bin' % func)
+      options = self.Options()
+      cgpt.WriteGptImage(options, func, 'usb', self.LAYOUT, image, pmbr)
+
+      # The attributes the script's write_<func>_table sets with cgpt add.
+      function = script[script.index('write_%s_table() {' % func):]
+      function = function[:function.index('\n}\n')]
+      expected = dict(
+          (int(num), int(tries) << 52 | int(prio) << 48)
+          for num, tries, prio in re.findall(
+              r'add -i (\d+) -S 0 -T (\d+) -P (\d+)', function))
+      self.assertEqual(sorted(expected), [2, 4, 6])
+
+      options.output_format = 'json'
+      options.disk_size = str(os.path.getsize(image))
+      plan = json.loads(cgpt.GetPartitionPlan(options, 'usb', self.LAYOUT))
+      with open(image, 'rb') as f:
+        f.seek(2 * 512)
+        entries = f.read(128 * 128)
+      for part in plan['partitions']:
+        start, end, attrs = struct.unpack_from(
+            '<QQQ', entries, (part['num'] - 1) * 128 + 32)
+        self.assertEqual((start, end), (part['start'], part['end']))
+        if part['type'] == 'efi':
+          self.assertEqual(attrs,
+                           1 << gpt_image.ATTRIBUTE_LEGACY_BOOT_OFFSET)
+        else:
+          self.assertEqual(attrs, expected.get(part['num'], 0))
+
+    self.assertRaises(cgpt.InvalidLayout, cgpt.WriteGptImage, self.Options(),
+                      'bogus', 'usb', self.LAYOUT, image, pmbr)
+
+  def testReadImage(self):
+    """Test that readimage reports the partitions writegpt wrote."""
+    image = os.path.join(self.tempdir, 'image.bin')
+    cgpt.WriteGptImage(self.Options(), 'partition', 'base', self.LAYOUT, image,
+                       os.devnull)
+    values = {}
+    output = cgpt.ReadImage(self.Options(), image)
+    for line in output.split('\n'):
+      name, value = line.split('=', 1)
+      values[name] = shlex.split(value)[0]
+
+    partitions = cgpt.GetPartitionTableFromConfig(self.Options(), self.LAYOUT,
+                                                  'base')
+    nums = sorted(x['num'] for x in partitions if x.get('type') != 'blank')
+    self.assertEqual(values['CGPT_IMAGE_PARTITIONS'],
+                     ' '.join(str(x) for x in nums))
+    self.assertEqual(values['CGPT_IMAGE_NUM_ROOT_A'], '3')
+    self.assertEqual(values['CGPT_IMAGE_3_TYPE'],
+                     gpt_image.TYPE_GUIDS['rootfs'])
+    self.assertEqual(int(values['CGPT_IMAGE_3_SIZE']) * 512,
+                     cgpt.GetPartitionSize(self.Options(), 'base',
+                                           self.LAYOUT, 3))
+    self.assertEqual(int(values['CGPT_IMAGE_2_ATTR'], 16),
+                     15 << 52 | 15 << 48)
+
+  def testAudit(self):
+    """Test that audit reports the problems of every image."""
+    for name, image_type in (('usb.bin', 'usb'), ('base.bin', 'base'),
+                             ('bad.bin', 'usb')):
+      cgpt.WriteGptImage(self.Options(), 'partition', image_type, self.LAYOUT,
+                         os.path.join(self.tempdir, name), os.devnull)
+    with open(os.path.join(self.tempdir, 'bad.bin'), 'r+b') as f:
+      f.seek(2 * 512)
+      f.write(b'\xff')
+
+    options = self.Options()
+    options.jobs = 2
+    output = io.StringIO()
+    with contextlib.redirect_stdout(output):
+      self.assertRaises(SystemExit, cgpt.Audit, options, 'usb', self.LAYOUT,
+                        self.tempdir)
+    report = json.loads(output.getvalue())
+    self.assertEqual((report['checked'], report['failed']), (3, 2))
+    problems = {os.path.basename(x['image']): x['problems']
+                for x in report['images']}
+    self.assertEqual(problems['usb.bin'], [])
+    self.assertEqual(problems['bad.bin'][0],
+                     'primary GPT entries do not match their CRC')
+    self.assertIn('partition 1 start is 8704000, the layout says 4513792',
+                  problems['base.bin'])
+
+    report = json.loads(cgpt.Audit(options, 'ALL', self.LAYOUT,
+                                   os.path.join(self.tempdir, 'base.bin')))
+    self.assertEqual(report['failed'], 0)
+    # Any layout placing partitions like base does is a match.
+    self.assertIsNotNone(report['images'][0]['image_type'])
+
+    report = json.loads(cgpt.Audit(options, 'ALL', self._WriteCommentedLayout(),
+                                   os.path.join(self.tempdir, 'base.bin')))
+    self.assertEqual(report['failed'], 0)
+
+  def _WriteCommentedLayout(self):
+    """Copies the layout next to a parent with a _comment under layouts."""
+    layout = os.path.join(self.tempdir, 'legacy_disk_layout.json')
+    shutil.copy(self.LAYOUT, layout)
+    with open(os.path.join(self.tempdir, 'common_disk_layout.json'), 'w') as f:
+      f.write('{"layouts": {"_comment": "Not an image type"}}')
+    return layout
+
+  def testListImageTypes(self):
+    """Test that image types leave out common and _comment."""
+    config = cgpt.LoadPartitionConfig(self._WriteCommentedLayout())
+    self.assertIn('_comment', config['layouts'])
+    self.assertEqual(
+        sorted(cgpt._ListImageTypes(config)),
+        sorted(x for x in cgpt.LoadPartitionConfig(self.LAYOUT)['layouts']
+               if x != 'common'))
+
+  def testWriteAllScripts(self):
+    """Test that writeall writes the scripts write does."""
+    output_dir = os.path.join(self.tempdir, 'scripts')
+    cgpt.WritePartitionScripts(self.Options(), 'base, usb', self.LAYOUT,
+                               output_dir)
+    self.assertEqual(sorted(os.listdir(output_dir)),
+                     ['write_gpt_base.sh', 'write_gpt_usb.sh'])
+    for image_type in ('base', 'usb'):
+      expected = os.path.join(self.tempdir, 'expected.sh')
+      cgpt.WritePartitionScript(self.Options(), image_type, self.LAYOUT,
+                                expected)
+      with open(expected) as f, open(os.path.join(
+          output_dir, 'write_gpt_%s.sh' % image_type)) as g:
+        self.assertEqual(g.read(), f.read())
+
+    output_dir = os.path.join(self.tempdir, 'all')
+    layout = self._WriteCommentedLayout()
+    cgpt.WritePartitionScripts(self.Options(), 'ALL', layout, output_dir)
+    self.assertEqual(
+        sorted(os.listdir(output_dir)),
+        sorted('write_gpt_%s.sh' % x for x in cgpt.GetImageTypes(
+            self.Options(), self.LAYOUT).split() if x != 'common'))
+
+    output_dir = os.path.join(self.tempdir, 'invalid')
+    self.assertRaises(cgpt.InvalidLayout, cgpt.WritePartitionScripts,
+                      self.Options(), 'base,bogus', self.LAYOUT, output_dir)
+    self.assertFalse(os.path.exists(output_dir))
+
+  def testWriteIfChanged(self):
+    """Test that --if_changed only rewrites scripts when an input changed."""
+    layout = os.path.join(self.tempdir, 'layout.json')
+    shutil.copy(self.LAYOUT, layout)
+    script = os.path.join(self.tempdir, 'write_gpt.sh')
+    options = self.Options()
+    options.if_changed = True
+
+    def _WriteMarked():
+      with open(script, 'a') as f:
+        f.write('# marker\n')
+      cgpt.WritePartitionScript(options, 'usb', layout, script)
+      with open(script) as f:
+        return f.read().endswith('# marker\n')
+
+    cgpt.WritePartitionScript(options, 'usb', layout, script)
+    self.assertTrue(_WriteMarked())
+    options.adjust_part = 'STATE:+1M'
+    self.assertFalse(_WriteMarked())
+    self.assertTrue(_WriteMarked())
+    with open(layout, 'a') as f:
+      f.write('\n')
+    self.assertFalse(_WriteMarked())
+
+    # A parent created next to the layout takes over from the global one.
+    with open(os.path.join(self.tempdir, 'common_disk_layout.json'), 'w') as f:
+      json.dump({'layouts': {'common': [
+          {'num': 99, 'label': 'EXTRA', 'type': 'data', 'size': '1 MiB'}]}},
+                f)
+    self.assertFalse(_WriteMarked())
+    with open(script) as f:
+      self.assertIn('EXTRA', f.read())
+
+    output_dir = os.path.join(self.tempdir, 'scripts')
+    cgpt.WritePartitionScripts(options, 'base,usb', layout, output_dir)
+    base_script = os.path.join(output_dir, 'write_gpt_base.sh')
+    os.utime(base_script, ns=(0, 0))
+    cgpt.WritePartitionScripts(options, 'base,usb', layout, output_dir)
+    self.assertEqual(os.stat(base_script).st_mtime_ns, 0)
+
+  def _WriteNandLayout(self, **layouts):
+    """Writes a raw NAND layout with |layouts| on top of a base one."""
+    layout = os.path.join(self.tempdir, 'nand.json')
+    layouts.setdefault('base', [])
+    layouts['common'] = [
+        {'num': 'metadata', 'erase_block_size': '128 KiB',
+         'page_size': '4 KiB', 'max_bad_erase_blocks': 80,
+         'size': '1 GiB', 'external_gpt': True},
+        {'num': 1, 'label': 'STATE', 'type': 'data', 'format': 'ubi',
+         'size': '512 MiB', 'reserved_erase_blocks': 1},
+        {'num': 2, 'label': 'KERN-A', 'type': 'kernel', 'format': 'nand',
+         'size': '8 MiB', 'reserved_erase_blocks': 1},
+        {'num': 4, 'label': 'KERN-B', 'type': 'kernel', 'format': 'nand',
+         'size': '8 MiB', 'reserved_erase_blocks': 1},
+    ]
+    with open(layout, 'w') as f:
+      json.dump({'metadata': {'block_size': 512, 'fs_block_size': 4096},
+                 'layouts': layouts}, f)
+    return layout
+
+  def testSolveReservedEraseBlocks(self):
+    """Test that solvereserve finds the fewest blocks validate accepts."""
+    layout = self._WriteNandLayout()
+    options = self.Options()
+    options.output_format = 'json'
+    solved = json.loads(cgpt.SolveReservedEraseBlocks(options, 'base', layout))
+    reserved = dict((x['label'], x['reserved_erase_blocks'])
+                    for x in solved['partitions'])
+    self.assertEqual(sorted(reserved), ['KERN-A', 'KERN-B', 'STATE'])
+    self.assertEqual(reserved['KERN-A'], reserved['KERN-B'])
+    self.assertGreater(reserved['STATE'], reserved['KERN-A'])
+
+    partitions = cgpt.GetPartitionTableFromConfig(options, layout, 'base')
+    for partition in partitions:
+      if partition.get('label') in reserved:
+        partition['reserved_erase_blocks'] = reserved[partition['label']]
+    cgpt.CheckReservedEraseBlocks(partitions)
+    for partition in partitions:
+      if partition.get('label') in reserved:
+        partition['reserved_erase_blocks'] -= 1
+        self.assertRaises(cgpt.ExcessFailureProbability,
+                          cgpt.CheckReservedEraseBlocks, partitions)
+        partition['reserved_erase_blocks'] += 1
+
+  def testFit(self):
+    """Test sizing partitions to their content."""
+    options = self.Options()
+    adjust_part = cgpt.Fit(options, 'base', self.LAYOUT,
+                           'ROOT-A:1000MiB, STATE:1')
+    self.assertEqual(adjust_part, 'ROOT-A:=%d STATE:=4096' % (1100 * 2**20))
+    options.adjust_part = adjust_part
+    self.assertEqual(cgpt.GetFilesystemSize(options, 'base', self.LAYOUT, 3),
+                     1100 * 2**20)
+    self.assertEqual(cgpt.GetPartitionSize(options, 'base', self.LAYOUT, 3),
+                     int(1100 * 2**20 * 1.15))
+
+    options = self.Options()
+    options.hashpad = 'exact'
+    options.headroom = '0%+1MiB'
+    options.output_format = 'json'
+    manifest = os.path.join(self.tempdir, 'manifest.json')
+    with open(manifest, 'w') as f:
+      f.write('{"ROOT-A": "1000 MiB",  # The rootfs.\n "ROOT-B": 1}')
+    fitted = json.loads(cgpt.Fit(options, 'base', self.LAYOUT, manifest))
+    self.assertEqual(fitted['adjust_part'],
+                     'ROOT-B:=%d ROOT-A:=%d' % (2**20 + 4096, 1001 * 2**20))
+    root_a = fitted['partitions'][1]
+    self.assertEqual(root_a['bytes'], 1001 * 2**20 +
+                     cgpt.GetVerityHashTreeSize(1001 * 2**20))
+    self.assertEqual(root_a['previous_bytes'], 2 * 2**30)
+
+    self.assertRaises(cgpt.InvalidAdjustment, cgpt.Fit, options, 'usb',
+                      self.LAYOUT, 'ROOT-A:1MiB STATE')
+    self.assertRaises(cgpt.PartitionNotFound, cgpt.Fit, options, 'base',
+                      self.LAYOUT, 'ROOT-Z:1MiB')
+
+    # A filesystem smaller than its partition can't be set by --adjust_part,
+    # but fitlayout keeps the room after it.
+    layout = os.path.join(self.tempdir, 'layout.json')
+    with open(layout, 'w') as f:
+      json.dump({'parent': self.LAYOUT, 'layouts': {'base': [
+          {'num': 1, 'size': '140 MiB', 'fs_size': '100 MiB'}]}}, f)
+    self.assertRaises(cgpt.InvalidAdjustment, cgpt.Fit, options, 'base',
+                      layout, 'STATE:10MiB')
+    fitted = os.path.join(self.tempdir, 'fitted.json')
+    cgpt.FitLayout(options, 'base', layout, 'STATE:10MiB', fitted)
+    self.assertEqual(cgpt.GetPartitionSize(options, 'base', fitted, 1),
+                     51 * 2**20)
+    self.assertEqual(cgpt.GetFilesystemSize(options, 'base', fitted, 1),
+                     11 * 2**20)
+
+  def testFitLayout(self):
+    """Test writing a layout sizing partitions to their content."""
+    options = self.Options()
+    options.hashpad = 'exact'
+    fitted = os.path.join(self.tempdir, 'fitted.json')
+    cgpt.FitLayout(options, 'base', self.LAYOUT,
+                   'ROOT-A:1000MiB ROOT-B:1000MiB STATE:100MiB', fitted)
+    fs_bytes = 1100 * 2**20
+    part_bytes = fs_bytes + cgpt.GetVerityHashTreeSize(fs_bytes)
+    for num in (3, 5):
+      self.assertEqual(cgpt.GetPartitionSize(options, 'base', fitted, num),
+                       part_bytes)
+      self.assertEqual(cgpt.GetFilesystemSize(options, 'base', fitted, num),
+                       fs_bytes)
+    self.assertEqual(cgpt.GetPartitionSize(options, 'base', fitted, 1),
+                     110 * 2**20)
+    # Other image types and partitions are inherited unchanged.
+    self.assertEqual(cgpt.GetPartitionSize(options, 'usb', fitted, 3),
+                     2 * 2**30)
+    self.assertEqual(cgpt.GetPartitionSize(options, 'base', fitted, 2),
+                     cgpt.GetPartitionSize(options, 'base', self.LAYOUT, 2))
+
+    self.assertRaises(cgpt.ExcessPartitionSize, cgpt.FitLayout, options,
+                      'base', self._WriteNandLayout(), 'KERN-A:2GiB', fitted)
+    self.assertFalse(os.path.exists(fitted))
+
+  def testFitNand(self):
+    """Test that fitted NAND partitions are rounded up to erase blocks."""
+    layout = self._WriteNandLayout()
+    options = self.Options()
+    options.headroom = '0%'
+    config = cgpt.LoadPartitionConfig(layout)
+    state, kern_a = cgpt._FitPartitions(options, config, 'base',
+                                        'KERN-A:1MiB STATE:1MiB')
+    # UBI filesystems are made of 120 KiB UBI erase blocks.
+    self.assertEqual(state['fs_bytes'], 9 * 120 * 1024)
+    self.assertEqual(state['bytes'], 9 * 128 * 1024)
+    self.assertEqual(kern_a['bytes'], 2**20)
+
+  def testContentSize(self):
+    """Test estimating the space taken by the files of a directory."""
+    root = os.path.join(self.tempdir, 'root')
+    os.makedirs(os.path.join(root, 'usr', 'bin'))
+    with open(os.path.join(root, 'usr', 'bin', 'tool'), 'wb') as f:
+      f.write(b'x' * 5000)
+    with open(os.path.join(root, 'empty'), 'wb') as f:
+      pass
+    os.link(os.path.join(root, 'usr', 'bin', 'tool'),
+            os.path.join(root, 'tool'))
+    os.symlink('usr/bin', os.path.join(root, 'bin'))
+    # Three directories, one symlink and the two blocks of the file.
+    self.assertEqual(cgpt.GetContentSize(root, 4096), 6 * 4096)
+    self.assertEqual(cgpt.Fit(self.Options(), 'base', self.LAYOUT,
+                              'STATE:%s' % root),
+                     'STATE:=%d' % (7 * 4096))
+
+  def testValidateAll(self):
+    """Test that validate ALL reports the failures of every image type."""
+    self.assertIsNone(cgpt.Validate(self.Options(), 'ALL', self.LAYOUT))
+    self.assertIsNone(cgpt.Validate(self.Options(), 'ALL',
+                                    self._WriteCommentedLayout()))
+
+    reserves = [{'num': 1, 'reserved_erase_blocks': 60},
+                {'num': 2, 'reserved_erase_blocks': 8},
+                {'num': 4, 'reserved_erase_blocks': 8}]
+    layout = self._WriteNandLayout(
+        base=reserves,
+        usb=reserves[:2],
+        recovery=[dict(reserves[0], size='2 GiB')] + reserves[1:],
+        factory_install=reserves[1:])
+    options = self.Options()
+    options.jobs = 2
+    with self.assertRaises(SystemExit) as e:
+      cgpt.Validate(options, 'ALL', layout)
+    self.assertEqual(str(e.exception).splitlines(), [
+        'usb: ExcessFailureProbability: excessive probability 0.129070 of too '
+        'many bad blocks in partition KERN-B',
+        'recovery: ExcessPartitionSize: capacity = 1073741824, '
+        'total=2318008320',
+        'factory_install: ExcessFailureProbability: excessive probability '
+        '1.000000 of too many bad blocks in partition STATE',
+    ])
+
+    # Every table is built once, on the serial path too.
+    loads = []
+    original = cgpt.GetPartitionTable
+    def _Count(*args):
+      loads.append(args[2])
+      return original(*args)
+    cgpt.GetPartitionTable = _Count
+    try:
+      options.jobs = 1
+      self.assertRaises(SystemExit, cgpt.Validate, options, 'ALL', layout)
+    finally:
+      cgpt.GetPartitionTable = original
+    self.assertEqual(sorted(loads), sorted(set(loads)))
+
+  def testValidateMany(self):
+    """Test that validatemany reports every image type of every board."""
+    nand = self._WriteNandLayout(
+        usb=[{'num': 1, 'reserved_erase_blocks': 60},
+             {'num': 2, 'reserved_erase_blocks': 8},
+             {'num': 4, 'reserved_erase_blocks': 8}])
+    with open(nand) as f:
+      nand = f.read()
+    for board, layout in (('foo', '{"parent": "legacy_disk_layout.json", '
+                                  '"layouts": {"common": []}}'),
+                          ('bar', nand)):
+      os.makedirs(os.path.join(self.tempdir, 'overlay-' + board, 'scripts'))
+      with open(os.path.join(self.tempdir, 'overlay-' + board, 'scripts',
+                             'disk_layout.json'), 'w') as f:
+        f.write(layout)
+    missing = os.path.join(self.tempdir, 'missing.json')
+
+    options = self.Options()
+    options.output_format = 'json'
+    options.jobs = 2
+    output = io.StringIO()
+    with contextlib.redirect_stdout(output):
+      self.assertRaises(SystemExit, cgpt.ValidateMany, options,
+                        '%s,%s' % (os.path.join(self.tempdir, 'overlay-*',
+                                                'scripts', 'disk_layout.json'),
+                                   missing))
+    report = json.loads(output.getvalue())
+    self.assertEqual((report['checked'], report['failed']), (3, 2))
+    rows = dict((x['board'], x) for x in report['layouts'])
+    self.assertEqual(sorted(rows), ['bar', 'foo', 'missing'])
+    self.assertTrue(rows['missing']['error'].startswith('ConfigNotFound'))
+    self.assertEqual(
+        sorted(x for x, y in rows['bar']['image_types'].items()
+               if y['error']), ['base'])
+    self.assertEqual(
+        sorted(rows['foo']['image_types']),
+        sorted(set(cgpt.GetImageTypes(options, self.LAYOUT).split()) -
+               set(['common'])))
+    self.assertFalse(any(x['error']
+                         for x in rows['foo']['image_types'].values()))
+
+    options.output_format = 'shell'
+    matrix = cgpt.ValidateMany(
+        options, os.path.join(self.tempdir, 'overlay-foo', '*', '*.json'))
+    header, row = matrix.splitlines()
+    self.assertEqual(header.split()[0], 'board')
+    self.assertEqual(row.split()[:-1], ['foo'] + ['ok'] * (
+        len(header.split()) - 2))
+
+    options.output_format = 'json'
+    report = json.loads(cgpt.ValidateMany(options,
+                                          self._WriteCommentedLayout()))
+    self.assertEqual(report['failed'], 0)
+    self.assertNotIn('_comment', report['layouts'][0]['image_types'])
+
+    # Workers are sent resolved layouts and never read layout files.
+    config = cgpt.LoadPartitionConfig(self.LAYOUT)
+    error, _ = cgpt._ValidateImageTypeOf(
+        (missing, 'usb', cgpt._GetAdjustOptions(options), config))
+    self.assertIsNone(error)
+
+  def testProfile(self):
+    """Test that --profile appends the phases of each command."""
+    def _Unwrap():
+      for names in cgpt.PROFILED_PHASES.values():
+        for name in names:
+          func = getattr(cgpt, name)
+          setattr(cgpt, name, getattr(func, 'profiled_function', func))
+    self.addCleanup(_Unwrap)
+    for memo in (cgpt._LOADED_CONFIGS, cgpt._STACKED_CONFIGS,
+                 cgpt._PARSED_LAYOUT_FILES):
+      memo.clear()
+
+    profile = os.path.join(self.tempdir, 'profile.jsonl')
+    script = os.path.join(self.tempdir, 'write_gpt.sh')
+    for argv in (['--adjust_part', 'ROOT-A:+1MiB', 'validate', 'usb'],
+                 ['write', 'usb'], ['readblocksize']):
+      argv = (['--profile', profile, '--no_cache'] + argv + [self.LAYOUT] +
+              ([script] if 'write' in argv else []))
+      with contextlib.redirect_stdout(io.StringIO()):
+        cgpt.main(argv)
+    cgpt.main(['--no_cache', 'write', 'usb', self.LAYOUT, script])
+
+    with open(profile) as f:
+      records = [json.loads(x) for x in f]
+    self.assertEqual([x['command'] for x in records],
+                     ['validate', 'write', 'readblocksize'])
+    self.assertEqual(sorted(records[0]['phases']),
+                     ['adjust', 'json_load', 'merge', 'table', 'validate'])
+    self.assertEqual(records[0]['phases']['adjust']['calls'], 1)
+    self.assertIn('script', records[1]['phases'])
+    for record in records:
+      self.assertGreater(record['seconds'], 0)
+      for stats in record['phases'].values():
+        self.assertLessEqual(stats['seconds'], record['seconds'])
+    self.assertIsNone(cgpt._PROFILE)
+
+  def testCompiledLayout(self):
+    """Test that a compiled layout loads like its source and skips loading."""
+    compiled = os.path.join(self.tempdir, 'compiled.json')
+    cgpt.CompileLayout(self.Options(), self.LAYOUT, compiled)
+
+    original = cgpt._LoadStackedPartitionConfig
+    def _Fail(*_args, **_kwargs):
+      raise AssertionError('compiled layout was resolved again')
+    cgpt._LoadStackedPartitionConfig = _Fail
+    try:
+      config = cgpt.LoadPartitionConfig(compiled)
+      options = self.Options()
+      options.adjust_part = 'ROOT-A:+1MiB'
+      self.assertEqual(cgpt.GetPartitionSize(options, 'usb', compiled, 3),
+                       int((2 * 2**30 + 2**20) * 1.15))
+    finally:
+      cgpt._LoadStackedPartitionConfig = original
+    self.assertEqual(config, cgpt.LoadPartitionConfig(self.LAYOUT))
+
+  def testCompiledLayoutVersion(self):
+    """Test that layouts compiled in another format are rejected."""
+    compiled = os.path.join(self.tempdir, 'compiled.json')
+    with open(compiled, 'w') as f:
+      json.dump({cgpt.COMPILED_LAYOUT_KEY: cgpt.COMPILED_LAYOUT_VERSION + 1,
+                 'config': {}}, f)
+    self.assertRaises(cgpt.InvalidLayout, cgpt.LoadPartitionConfig, compiled)
+
+  def testAdjustmentsDoNotPersist(self):
+    """Test that changes to one partition table do not leak into others."""
+    config = cgpt.LoadPartitionConfig(self.LAYOUT)
+    options = self.Options()
+    options.adjust_part = 'ROOT-A:+1MiB'
+    adjusted = cgpt.GetPartitionTable(options, config, 'base')
+    tables = [cgpt.GetPartitionTable(self.Options(), config, image_type)
+              for image_type in ('base', 'usb')]
+    for partitions in tables:
+      root_a = cgpt.GetPartitionByLabel(partitions, 'ROOT-A')
+      self.assertEqual(root_a['bytes'], 2 * 2**30)
+      root_a['bytes'] = 0
+
+    self.assertEqual(cgpt.GetPartitionByLabel(adjusted, 'ROOT-A')['bytes'],
+                     int((2 * 2**30 + 2**20) * 1.15))
+    partitions = cgpt.GetPartitionTable(self.Options(), config, 'base')
+    self.assertEqual(cgpt.GetPartitionByLabel(partitions, 'ROOT-A')['bytes'],
+                     2 * 2**30)
+    root_a = cgpt.GetPartitionByLabel(config['layouts']['base'], 'ROOT-A')
+    self.assertEqual(root_a['bytes'], 2 * 2**30)
+    self.assertNotIn('fs_blocks', root_a)
+
+  def testHashpad(self):
+    """Test sizing the hashpad of an adjusted rootfs by its hash tree."""
+    options = self.Options()
+    options.adjust_part = 'ROOT-A:=2GiB'
+    options.hashpad = 'exact'
+    tree_bytes = cgpt.GetVerityHashTreeSize(2**31)
+    self.assertEqual(tree_bytes, (4096 + 32 + 1) * 4096)
+    self.assertEqual(cgpt.GetPartitionSize(options, 'base', self.LAYOUT, 3),
+                     2**31 + tree_bytes)
+    self.assertEqual(cgpt.GetFilesystemSize(options, 'base', self.LAYOUT, 3),
+                     2**31)
+    self.assertEqual(cgpt.GetHashpadSize(options, 'base', self.LAYOUT, 3),
+                     tree_bytes)
+    options.hashpad = 'legacy'
+    self.assertEqual(cgpt.GetPartitionSize(options, 'base', self.LAYOUT, 3),
+                     int(2**31 * 1.15))
+    self.assertEqual(cgpt.GetHashpadSize(options, 'base', self.LAYOUT, 3),
+                     int(2**31 * 1.15) - 2**31)
+    self.assertRaises(cgpt.InvalidLayout, cgpt.GetHashpadSize, options,
+                      'base', self.LAYOUT, 1)
+
+    options = self.Options()
+    options.output_format = 'json'
+    report = json.loads(cgpt.ReportHashpadSavings(options, self.LAYOUT))
+    base = [x for x in report['image_types'] if x['image_type'] == 'base'][0]
+    root_a = [x for x in base['partitions'] if x['label'] == 'ROOT-A'][0]
+    fs_bytes = 1991 * 2**20
+    self.assertEqual(root_a, {
+        'num': 3, 'label': 'ROOT-A', 'fs_bytes': fs_bytes,
+        'legacy': int(fs_bytes * 1.15) - fs_bytes,
+        'exact': cgpt.GetVerityHashTreeSize(fs_bytes),
+        'saved': int(fs_bytes * 1.15) - fs_bytes -
+                 cgpt.GetVerityHashTreeSize(fs_bytes)})
+    self.assertEqual(base['saved'], sum(x['saved'] for x in base['partitions']))
+    options.output_format = 'shell'
+    output = cgpt.ReportHashpadSavings(options, self.LAYOUT)
+    self.assertIn('CGPT_BASE_3_EXACT_HASHPAD=%d' % root_a['exact'],
+                  output.splitlines())
+    self.assertIn('CGPT_BASE_HASHPAD_SAVED=%d' % base['saved'],
+                  output.splitlines())
+
+    options.output_format = 'json'
+    report = json.loads(cgpt.ReportHashpadSavings(
+        options, self._WriteCommentedLayout()))
+    self.assertNotIn('_comment', [x['image_type'] for x in
+                                  report['image_types']])
+
+  def testQueryMatchesReadCommands(self):
+    """Test that query answers the same as the individual read* commands."""
+    options = self.Options()
+    values = {}
+    for line in cgpt.GetPartitionQuery(options, 'usb', self.LAYOUT).split('\n'):
+      name, value = line.split('=', 1)
+      values[name] = shlex.split(value)[0]
+
+    nums = cgpt.GetPartitions(options, 'usb', self.LAYOUT)
+    self.assertEqual(values['CGPT_USB_PARTITIONS'], nums)
+    for num in nums.split():
+      prefix = 'CGPT_USB_%s_' % num
+      self.assertEqual(int(values[prefix + 'SIZE']),
+                       cgpt.GetPartitionSize(options, 'usb', self.LAYOUT, num))
+      self.assertEqual(int(values[prefix + 'FS_SIZE']),
+                       cgpt.GetFilesystemSize(options, 'usb', self.LAYOUT, num))
+      self.assertEqual(values[prefix + 'LABEL'],
+                       cgpt.GetLabel(options, 'usb', self.LAYOUT, num))
+      self.assertEqual(values[prefix + 'UUID'],
+                       cgpt.GetUUID(options, 'usb', self.LAYOUT, num))
+      self.assertEqual(values[prefix + 'FS_FORMAT'],
+                       cgpt.GetFilesystemFormat(options, 'usb', self.LAYOUT,
+                                                num) or '')
+    self.assertEqual(int(values['CGPT_USB_NUM_ROOT_A']),
+                     cgpt.GetNumber(options, 'usb', self.LAYOUT, 'ROOT-A'))
+
+  def testQueryJSON(self):
+    """Test that query can produce JSON."""
+    options = self.Options()
+    options.output_format = 'json'
+    data = json.loads(cgpt.GetPartitionQuery(options, 'base', self.LAYOUT))
+    self.assertEqual(data['image_type'], 'base')
+    root_a = [x for x in data['partitions'] if x['label'] == 'ROOT-A'][0]
+    self.assertEqual(root_a['num'], 3)
+    self.assertEqual(root_a['fs_size'], 1991 * 2**20)
+
 
 if __name__ == '__main__':
   unittest.main()
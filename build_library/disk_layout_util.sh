@@ -9,6 +9,46 @@
 CGPT_PY="${BUILD_LIBRARY_DIR}/cgpt.py"
 PARTITION_SCRIPT_PATH="usr/sbin/write_gpt.sh"
 DISK_LAYOUT_PATH=
+DISK_LAYOUT_SOURCE_PATH=
+
+# Usage: cgpt_py_request <cgpt.py arguments>
+# Prints the request running cgpt.py with the given arguments, the current
+# directory and the CGPT_* environment variables on the server (see
+# "cgpt.py serve --help").  Every word is NUL-terminated, so arguments are
+# passed as they are, whatever characters they hold.
+cgpt_py_request() {
+  local name
+  local words=( "cwd=${PWD}" )
+  for name in $(compgen -e CGPT_); do
+    words+=( "env=${name}=${!name}" )
+  done
+  words+=( "${@/#/arg=}" )
+  printf '%s\0' "${words[@]}"
+}
+
+# Usage: cgpt_py_server <cgpt.py arguments>
+# Runs cgpt.py through the server listening on ${CGPT_SOCKET}, which saves
+# starting Python for every call.
+# Returns 255 without running anything when there is no server to talk to.
+cgpt_py_server() {
+  if [[ -z ${CGPT_SOCKET-} || ! -S ${CGPT_SOCKET} ]] || \
+     ! type -P socat >/dev/null; then
+    return 255
+  fi
+
+  # Once the request is sent, socat only waits half a second for the
+  # response by default; give the command time to finish.
+  local line status=255
+  while IFS= read -r line; do
+    case ${line} in
+    out:*) printf '%s\n' "${line#out:}" ;;
+    err:*) printf '%s\n' "${line#err:}" >&2 ;;
+    exit:*) status=${line#exit:} ;;
+    esac
+  done < <(cgpt_py_request "$@" |
+           socat -t 600 - "UNIX-CONNECT:${CGPT_SOCKET}" 2>/dev/null)
+  return "${status}"
+}
 
 cgpt_py() {
   if [[ -n "${FLAGS_adjust_part-}" ]]; then
@@ -20,6 +60,11 @@ cgpt_py() {
            "doing it wrong and should be using a disk layout type."
     fi
   fi
+  local status=0
+  cgpt_py_server "$@" || status=$?
+  if [[ ${status} -ne 255 ]]; then
+    return "${status}"
+  fi
   "${CGPT_PY}" "$@"
 }
 
@@ -37,6 +82,34 @@ get_disk_layout_path() {
   done
 }
 
+# Usage: compile_disk_layout <output>
+# Resolves and validates the disk layout once, writing the result to <output>,
+# and points DISK_LAYOUT_PATH at it so later cgpt.py calls skip that work.
+# The original layout stays available in DISK_LAYOUT_SOURCE_PATH.
+compile_disk_layout() {
+  local output=$1
+  get_disk_layout_path
+  if [[ -n ${DISK_LAYOUT_SOURCE_PATH-} ]]; then
+    return 0
+  fi
+
+  cgpt_py compile "${DISK_LAYOUT_PATH}" "${output}" || return
+  DISK_LAYOUT_SOURCE_PATH=${DISK_LAYOUT_PATH}
+  DISK_LAYOUT_PATH=${output}
+}
+
+# Usage: discard_compiled_disk_layout
+# Deletes the layout written by compile_disk_layout and goes back to the
+# original one.
+discard_compiled_disk_layout() {
+  if [[ -z ${DISK_LAYOUT_SOURCE_PATH-} ]]; then
+    return 0
+  fi
+  rm -f "${DISK_LAYOUT_PATH}"
+  DISK_LAYOUT_PATH=${DISK_LAYOUT_SOURCE_PATH}
+  DISK_LAYOUT_SOURCE_PATH=
+}
+
 write_partition_script() {
   local image_type="$1"
   local partition_script_path="$2"
@@ -45,10 +118,19 @@ write_partition_script() {
 
   local temp_script_file=$(mktemp)
 
-  sudo mkdir -p "$(dirname "${partition_script_path}")"
-  cgpt_py ${adjust_part:+--adjust_part "${adjust_part}"} \
+  # Start from the existing script so cgpt.py can leave it alone when it was
+  # written from the same inputs, and skip replacing it in that case.
+  if [[ -f "${partition_script_path}" ]]; then
+    cp "${partition_script_path}" "${temp_script_file}"
+  fi
+  cgpt_py ${adjust_part:+--adjust_part "${adjust_part}"} --if_changed \
           write "${image_type}" "${DISK_LAYOUT_PATH}" \
           "${temp_script_file}"
+  if cmp -s "${temp_script_file}" "${partition_script_path}"; then
+    rm -f "${temp_script_file}"
+    return 0
+  fi
+  sudo mkdir -p "$(dirname "${partition_script_path}")"
   sudo mv "${temp_script_file}" "${partition_script_path}"
   sudo chmod a+r "${partition_script_path}"
 }
@@ -89,9 +171,41 @@ get_image_types() {
   cgpt_py readimagetypes "${DISK_LAYOUT_PATH}"
 }
 
+# Usage: load_disk_layout <image_type>
+# Resolves every partition attribute of <image_type> with a single cgpt.py
+# call and keeps the answers in shell variables.  The per-partition get_*
+# helpers below use those variables when they are set instead of starting
+# cgpt.py again.  Call this from the parent shell: the helpers are usually run
+# in $(...) subshells, which inherit the variables but cannot set them.
+load_disk_layout() {
+  local image_type=$1
+  get_disk_layout_path
+
+  local query
+  query=$(cgpt_py query "${image_type}" "${DISK_LAYOUT_PATH}") || return
+  eval "${query}"
+}
+
+# Usage: get_loaded_layout_value <image_type> <key>
+# Prints the value load_disk_layout stored for <image_type> and <key> (for
+# example "3_SIZE" or "NUM_ROOT-A").  Returns non-zero when <image_type> has
+# not been loaded or the key is unknown, so callers can fall back to cgpt.py.
+get_loaded_layout_value() {
+  local prefix="CGPT_$1"
+  local var="${prefix}_$2"
+  prefix=${prefix//[^A-Za-z0-9_]/_}
+  var=${var//[^A-Za-z0-9_]/_}
+  local loaded="${prefix^^}_LOADED"
+  var=${var^^}
+
+  [[ -n ${!loaded-} && -n ${!var+set} ]] || return 1
+  echo "${!var}"
+}
+
 get_partition_size() {
   local image_type=$1
   local part_id=$2
+  get_loaded_layout_value "${image_type}" "${part_id}_SIZE" && return
   get_disk_layout_path
 
   cgpt_py readpartsize "${image_type}" "${DISK_LAYOUT_PATH}" "${part_id}"
@@ -100,6 +214,7 @@ get_partition_size() {
 get_filesystem_format() {
   local image_type=$1
   local part_id=$2
+  get_loaded_layout_value "${image_type}" "${part_id}_FS_FORMAT" && return
   get_disk_layout_path
 
   cgpt_py readfsformat "${image_type}" "${DISK_LAYOUT_PATH}" "${part_id}"
@@ -108,6 +223,7 @@ get_filesystem_format() {
 get_filesystem_options() {
   local image_type=$1
   local part_id=$2
+  get_loaded_layout_value "${image_type}" "${part_id}_FS_OPTIONS" && return
   get_disk_layout_path
 
   cgpt_py readfsoptions "${image_type}" "${DISK_LAYOUT_PATH}" "${part_id}"
@@ -116,6 +232,7 @@ get_filesystem_options() {
 get_format() {
   local image_type=$1
   local part_id=$2
+  get_loaded_layout_value "${image_type}" "${part_id}_FORMAT" && return
   get_disk_layout_path
 
   cgpt_py readformat "${image_type}" "${DISK_LAYOUT_PATH}" "${part_id}"
@@ -123,6 +240,7 @@ get_format() {
 
 get_partitions() {
   local image_type=$1
+  get_loaded_layout_value "${image_type}" PARTITIONS && return
   get_disk_layout_path
 
   cgpt_py readpartitionnums "${image_type}" "${DISK_LAYOUT_PATH}"
@@ -131,6 +249,7 @@ get_partitions() {
 get_uuid() {
   local image_type=$1
   local part_id=$2
+  get_loaded_layout_value "${image_type}" "${part_id}_UUID" && return
   get_disk_layout_path
 
   cgpt_py readuuid "${image_type}" "${DISK_LAYOUT_PATH}" "${part_id}"
@@ -139,6 +258,7 @@ get_uuid() {
 get_type() {
   local image_type=$1
   local part_id=$2
+  get_loaded_layout_value "${image_type}" "${part_id}_TYPE" && return
   get_disk_layout_path
 
   cgpt_py readtype "${image_type}" "${DISK_LAYOUT_PATH}" "${part_id}"
@@ -147,14 +267,34 @@ get_type() {
 get_filesystem_size() {
   local image_type=$1
   local part_id=$2
+  get_loaded_layout_value "${image_type}" "${part_id}_FS_SIZE" && return
   get_disk_layout_path
 
   cgpt_py readfssize "${image_type}" "${DISK_LAYOUT_PATH}" "${part_id}"
 }
 
+# Usage: get_vm_disk_size <image_type> <stateful_size>
+# Prints the size of the smallest disk on which the partition script gives the
+# stateful partition of <image_type> <stateful_size> bytes.
+get_vm_disk_size() {
+  local image_type=$1
+  local stateful_size=$2
+  get_disk_layout_path
+
+  local layout
+  layout=$(cgpt_py vmlayout "${image_type}" "${DISK_LAYOUT_PATH}" \
+           "${stateful_size}") || return
+  local var="CGPT_${image_type}_DISK_SIZE"
+  var=${var//[^A-Za-z0-9_]/_}
+  var=${var^^}
+  eval "${layout}"
+  echo "${!var}"
+}
+
 get_label() {
   local image_type=$1
   local part_id=$2
+  get_loaded_layout_value "${image_type}" "${part_id}_LABEL" && return
   get_disk_layout_path
 
   cgpt_py readlabel "${image_type}" "${DISK_LAYOUT_PATH}" "${part_id}"
@@ -170,6 +310,7 @@ get_image_partition_number() {
 get_layout_partition_number() {
   local image_type=$1
   local part_label=$2
+  get_loaded_layout_value "${image_type}" "NUM_${part_label}" && return
   get_disk_layout_path
 
   cgpt_py readnumber "${image_type}" "${DISK_LAYOUT_PATH}" "${part_label}"
@@ -178,6 +319,7 @@ get_layout_partition_number() {
 get_reserved_erase_blocks() {
   local image_type=$1
   local part_id=$2
+  get_loaded_layout_value "${image_type}" "${part_id}_RESERVED_EBS" && return
   get_disk_layout_path
 
   cgpt_py readreservederaseblocks "${image_type}" "${DISK_LAYOUT_PATH}" \
@@ -301,6 +443,12 @@ EOF
     echo "${gpt_layout}" >> "${x}"
   done
 
+  # Read the partition labels once instead of running cgpt per partition.
+  local gpt var
+  gpt=$(cgpt_py readimage "${image}") || return
+  unset "${!CGPT_IMAGE_@}"
+  eval "${gpt}"
+
   # Read each partition and generate code for it.
   while read start size part x; do
     local file="part_${part}"
@@ -309,7 +457,8 @@ EOF
     local dd_args="bs=512 count=${size}"
     local start_b=$(( start * 512 ))
     local size_b=$(( size * 512 ))
-    local label=$(${GPT} show "${image}" -i ${part} -l)
+    var="CGPT_IMAGE_${part}_LABEL"
+    local label=${!var-}
 
     for x in "${unpack}" "${pack}" "${mount}" "${umount}"; do
       cat <<EOF >> "${x}"
@@ -473,6 +622,8 @@ build_gpt_image() {
   emit_gpt_scripts "${outdev}" "$(dirname "${outdev}")"
 
   # Create the filesystem on each partition defined in the layout file.
+  # Resolve the whole layout once so mk_fs does not run cgpt.py per field.
+  load_disk_layout "${disk_layout}"
   local p
   for p in $(get_partitions "${disk_layout}"); do
     mk_fs "${outdev}" "${disk_layout}" "${p}"
@@ -508,13 +659,21 @@ update_partition_table() {
 
   rm -f "${dst_img}"
 
+  # Read the source partition table once instead of running cgpt per field.
+  local gpt var
+  gpt=$(cgpt_py readimage "${src_img}") || return
+  unset "${!CGPT_IMAGE_@}"
+  eval "${gpt}"
+
   # Find partition number of STATE.
   local part=0
   local label=""
   while [ "${label}" != "STATE" ]; do
     part=$(( part + 1 ))
-    local label=$(cgpt show -i ${part} -l ${src_img})
-    local src_start=$(cgpt show -i ${part} -b ${src_img})
+    var="CGPT_IMAGE_${part}_LABEL"
+    local label=${!var-}
+    var="CGPT_IMAGE_${part}_START"
+    local src_start=${!var:-0}
     if [ ${src_start} -eq 0 ]; then
       echo "Could not find 'STATE' partition" >&2
       return 1
@@ -525,7 +684,8 @@ update_partition_table() {
   # relocated partitions following it are not misaligned.
   dst_stateful_blocks=$(round_up_4096 $dst_stateful_blocks)
   # Calculate change in image size.
-  local src_stateful_blocks=$(cgpt show -i ${part} -s ${src_img})
+  var="CGPT_IMAGE_${part}_SIZE"
+  local src_stateful_blocks=${!var}
   local delta_blocks=$(( dst_stateful_blocks - src_stateful_blocks ))
   local dst_stateful_bytes=$(( dst_stateful_blocks * 512 ))
   local src_stateful_bytes=$(( src_stateful_blocks * 512 ))
@@ -537,24 +697,31 @@ update_partition_table() {
   dd if="${src_img}" of="${dst_img}" conv=notrunc bs=512 count=1 status=none
   cgpt create ${dst_img}
 
-  local src_state_start=$(cgpt show -i ${part} -b ${src_img})
+  local src_state_start=${src_start}
 
   # Duplicate each partition entry.
   part=0
   while :; do
     part=$(( part + 1 ))
-    local src_start=$(cgpt show -i ${part} -b ${src_img})
+    var="CGPT_IMAGE_${part}_START"
+    local src_start=${!var:-0}
     if [ ${src_start} -eq 0 ]; then
       # No more partitions to copy.
       break
     fi
     local dst_start=${src_start}
     # Load source partition details.
-    local size=$(cgpt show -i ${part} -s ${src_img})
-    local label=$(cgpt show -i ${part} -l ${src_img})
-    local attr=$(cgpt show -i ${part} -A ${src_img})
-    local tguid=$(cgpt show -i ${part} -t ${src_img})
-    local uguid=$(cgpt show -i ${part} -u ${src_img})
+    var="CGPT_IMAGE_${part}_SIZE"
+    local size=${!var}
+    var="CGPT_IMAGE_${part}_LABEL"
+    local label=${!var}
+    # cgpt add -A only takes the upper 16 bits of the attributes.
+    var="CGPT_IMAGE_${part}_ATTR"
+    local attr=$(( (${!var} >> 48) & 0xffff ))
+    var="CGPT_IMAGE_${part}_TYPE"
+    local tguid=${!var}
+    var="CGPT_IMAGE_${part}_UUID"
+    local uguid=${!var}
     if [[ ${size} -eq 0 ]]; then
       continue
     fi
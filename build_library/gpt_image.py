@@ -0,0 +1,451 @@
+# -*- coding: utf-8 -*-
+# Copyright 2021 The Chromium OS Authors. All rights reserved.
+# Use of this source code is governed by a BSD-style license that can be
+# found in the LICENSE file.
+
+"""Write GUID Partition Tables without running cgpt.
+
+The tables are built in memory and written in one pass, laid out the way
+`cgpt create`, `cgpt add` and `cgpt boot -p` leave them: a protective MBR in
+the first 512 bytes, the primary header in block 1 followed (after optional
+padding) by the primary entry array, and the secondary entry array and
+header in the last blocks of the GPT.
+
+For an external GPT (kept apart from the drive it describes, like on NAND
+with the table in SPI flash), the GPT is a blob of its own size and only the
+usable range comes from the drive.
+"""
+
+from __future__ import division
+from __future__ import print_function
+
+import collections
+import os
+import struct
+import uuid
+import zlib
+
+
+class GptError(Exception):
+  """Raised when a GPT can't be built"""
+
+
+# Partition type GUIDs for the type names used in layouts, as known by cgpt.
+TYPE_GUIDS = {
+    'unused': '00000000-0000-0000-0000-000000000000',
+    'kernel': 'FE3A2A5D-4F32-41A7-B725-ACCC3285A309',
+    'rootfs': '3CB8E202-3B7E-47DD-8A3C-7FF2A13CFCEC',
+    'firmware': 'CAB6E88E-ABF3-4102-A07A-D4BB9BE3C1D3',
+    'reserved': '2E0A753D-9E48-43B0-8337-B15192CB1B5E',
+    'minios': '09845860-705F-4BB5-B16C-8A8A099CAF52',
+    'efi': 'C12A7328-F81F-11D2-BA4B-00A0C93EC93B',
+    'data': '0FC63DAF-8483-4772-8E79-3D69D8477DE4',
+    'basicdata': 'EBD0A0A2-B9E5-4433-87C0-68B6B72699C7',
+}
+
+# Bit offsets of the partition attributes set by `cgpt add`.
+ATTRIBUTE_LEGACY_BOOT_OFFSET = 2
+ATTRIBUTE_PRIORITY_OFFSET = 48
+ATTRIBUTE_TRIES_OFFSET = 52
+ATTRIBUTE_SUCCESSFUL_OFFSET = 56
+
+MBR_SIZE = 512
+MBR_BOOTCODE_SIZE = 424
+GPT_SIGNATURE = b'EFI PART'
+GPT_REVISION = 0x00010000
+GPT_HEADER_SIZE = 92
+NUMBER_OF_ENTRIES = 128
+SIZE_OF_ENTRY = 128
+ENTRY_NAME_CHARS = 36
+
+_HEADER_FORMAT = '<8sIIIIQQQQ16sQIII'
+_ENTRY_FORMAT = '<16s16sQQQ72s'
+
+# One partition to add to the GPT, with its first and last LBA (inclusive)
+# and the attribute values of `cgpt add -S -T -P -B`.
+Partition = collections.namedtuple('Partition', (
+    'num', 'type', 'label', 'start', 'end', 'unique_guid',
+    'priority', 'tries', 'successful', 'legacy_boot'))
+Partition.__new__.__defaults__ = (None, 0, 0, 0, False)
+
+
+def GetTypeGuid(typename):
+  """Returns the GUID of a partition type name or literal GUID."""
+  try:
+    return uuid.UUID(TYPE_GUIDS.get(typename, typename))
+  except ValueError:
+    raise GptError('Unknown partition type %s' % typename)
+
+
+def GetAttributes(partition):
+  """Returns the 64-bit attribute field of |partition|."""
+  for name, limit in (('priority', 15), ('tries', 15), ('successful', 1)):
+    if not 0 <= getattr(partition, name) <= limit:
+      raise GptError('Partition %s %s must be 0..%d' %
+                     (partition.num, name, limit))
+  return ((partition.successful << ATTRIBUTE_SUCCESSFUL_OFFSET) |
+          (partition.tries << ATTRIBUTE_TRIES_OFFSET) |
+          (partition.priority << ATTRIBUTE_PRIORITY_OFFSET) |
+          (int(partition.legacy_boot) << ATTRIBUTE_LEGACY_BOOT_OFFSET))
+
+
+def EncodeEntries(partitions):
+  """Returns the partition entry array holding |partitions|.
+
+  Args:
+    partitions: List of Partition tuples.  Each goes in entry num - 1, and
+      partitions without a unique_guid get a random one.
+
+  Returns:
+    The NUMBER_OF_ENTRIES * SIZE_OF_ENTRY bytes of the entry array.
+  """
+  entries = bytearray(NUMBER_OF_ENTRIES * SIZE_OF_ENTRY)
+  used = set()
+  for partition in partitions:
+    if not 1 <= partition.num <= NUMBER_OF_ENTRIES:
+      raise GptError('Partition number %s out of range' % partition.num)
+    if partition.num in used:
+      raise GptError('Partition %s added twice' % partition.num)
+    used.add(partition.num)
+    if partition.end < partition.start:
+      raise GptError('Partition %s ends before it starts' % partition.num)
+
+    name = partition.label.encode('utf-16-le')
+    if len(name) > ENTRY_NAME_CHARS * 2:
+      raise GptError('Partition label %s is too long' % partition.label)
+    unique_guid = uuid.UUID(str(partition.unique_guid or uuid.uuid4()))
+    offset = (partition.num - 1) * SIZE_OF_ENTRY
+    entries[offset:offset + SIZE_OF_ENTRY] = struct.pack(
+        _ENTRY_FORMAT, GetTypeGuid(partition.type).bytes_le,
+        unique_guid.bytes_le, partition.start, partition.end,
+        GetAttributes(partition), name)
+  return bytes(entries)
+
+
+def EncodeHeader(block_size, my_lba, alternate_lba, first_usable_lba,
+                 last_usable_lba, disk_guid, entries_lba, entries):
+  """Returns the block holding a GPT header, with both CRCs filled in."""
+  fields = [GPT_SIGNATURE, GPT_REVISION, GPT_HEADER_SIZE, 0, 0, my_lba,
+            alternate_lba, first_usable_lba, last_usable_lba,
+            disk_guid.bytes_le, entries_lba, NUMBER_OF_ENTRIES, SIZE_OF_ENTRY,
+            zlib.crc32(entries) & 0xffffffff]
+  fields[3] = zlib.crc32(struct.pack(_HEADER_FORMAT, *fields)) & 0xffffffff
+  return struct.pack(_HEADER_FORMAT, *fields).ljust(block_size, b'\0')
+
+
+def EncodeProtectiveMbr(drive_blocks, mbr=None, bootcode=None, boot_guid=None):
+  """Returns the protective MBR `cgpt boot -p` writes.
+
+  Args:
+    drive_blocks: Number of blocks of the drive.
+    mbr: The current MBR.  Bytes cgpt leaves alone, like the disk id, are
+      kept from it.
+    bootcode: If set, its first MBR_BOOTCODE_SIZE bytes become the boot code,
+      like with `cgpt boot -b`.
+    boot_guid: If set, the unique GUID of the partition to boot, like with
+      `cgpt boot -i`.
+
+  Returns:
+    The MBR_SIZE bytes of the MBR.
+  """
+  mbr = bytearray((mbr or b'').ljust(MBR_SIZE, b'\0')[:MBR_SIZE])
+  if bootcode is not None:
+    mbr[:MBR_BOOTCODE_SIZE] = bootcode[:MBR_BOOTCODE_SIZE].ljust(
+        MBR_BOOTCODE_SIZE, b'\0')
+  if boot_guid is not None:
+    # cgpt keeps the GUID right after the boot code, for the boot code to use.
+    mbr[424:440] = uuid.UUID(str(boot_guid)).bytes_le
+  mbr[444:446] = b'\x1d\x9a'
+  # Only the first entry is used: a 0xEE partition covering the drive.
+  mbr[446:510] = struct.pack(
+      '<BBBBBBBBII', 0, 0x00, 0x02, 0x00, 0xee, 0xff, 0xff, 0xff, 1,
+      min(drive_blocks - 1, 0xffffffff)).ljust(64, b'\0')
+  mbr[510:512] = b'\x55\xaa'
+  return bytes(mbr)
+
+
+def BuildGpt(block_size, drive_blocks, partitions, padding_blocks=0,
+             gpt_blocks=None, disk_guid=None):
+  """Builds the blocks of a GPT.
+
+  Args:
+    block_size: Logical block size in bytes.
+    drive_blocks: Number of blocks of the drive the partitions are on.
+    partitions: List of Partition tuples.
+    padding_blocks: Blocks between the primary header and its entry array,
+      like `cgpt create -p`.  For an external GPT, the first usable block.
+    gpt_blocks: Number of blocks of an external GPT, like with `cgpt -D`.
+      By default the GPT is on the drive.
+    disk_guid: GUID of the disk.  Random by default.
+
+  Returns:
+    A list of (offset, data) pairs to write, in order of offset.  The
+    protective MBR is left out, see EncodeProtectiveMbr.
+  """
+  entries = EncodeEntries(partitions)
+  entries_blocks = (len(entries) + block_size - 1) // block_size
+  disk_guid = uuid.UUID(str(disk_guid or uuid.uuid4()))
+
+  if gpt_blocks is None:
+    gpt_blocks = drive_blocks
+    primary_entries_lba = 2 + padding_blocks
+    first_usable_lba = primary_entries_lba + entries_blocks
+    last_usable_lba = drive_blocks - 1 - entries_blocks - 1
+  else:
+    primary_entries_lba = 2
+    first_usable_lba = padding_blocks
+    last_usable_lba = drive_blocks - 1
+  secondary_lba = gpt_blocks - 1
+  secondary_entries_lba = secondary_lba - entries_blocks
+  if secondary_entries_lba < primary_entries_lba + entries_blocks:
+    raise GptError('%d blocks are too few for a GPT' % gpt_blocks)
+
+  for partition in partitions:
+    if partition.start < first_usable_lba or partition.end > last_usable_lba:
+      raise GptError('Partition %s (blocks %d-%d) is outside the usable '
+                     'blocks %d-%d' % (partition.num, partition.start,
+                                       partition.end, first_usable_lba,
+                                       last_usable_lba))
+
+  def _Header(my_lba, alternate_lba, entries_lba):
+    return EncodeHeader(block_size, my_lba, alternate_lba, first_usable_lba,
+                        last_usable_lba, disk_guid, entries_lba, entries)
+
+  return [
+      (block_size, _Header(1, secondary_lba, primary_entries_lba)),
+      (primary_entries_lba * block_size, entries),
+      (secondary_entries_lba * block_size, entries),
+      (secondary_lba * block_size,
+       _Header(secondary_lba, 1, secondary_entries_lba)),
+  ]
+
+
+def WriteGpt(path, block_size, drive_blocks, partitions, padding_blocks=0,
+             gpt_blocks=None, disk_guid=None, bootcode=None, boot_num=None):
+  """Writes a GPT and its protective MBR to |path| in one pass.
+
+  Args:
+    path: Image file, block device or external GPT blob to write to.  It
+      must already have its final size.
+    block_size: Logical block size in bytes.
+    drive_blocks: Number of blocks of the drive the partitions are on.
+    partitions: List of Partition tuples.
+    padding_blocks: See BuildGpt.
+    gpt_blocks: See BuildGpt.
+    disk_guid: See BuildGpt.
+    bootcode: Boot code for the protective MBR, see EncodeProtectiveMbr.
+    boot_num: Number of the partition the protective MBR boots.
+  """
+  boot_guid = None
+  if boot_num is not None:
+    partitions = [x._replace(unique_guid=x.unique_guid or uuid.uuid4())
+                  for x in partitions]
+    boot_guid = [x.unique_guid for x in partitions if x.num == boot_num][0]
+
+  writes = BuildGpt(block_size, drive_blocks, partitions,
+                    padding_blocks=padding_blocks, gpt_blocks=gpt_blocks,
+                    disk_guid=disk_guid)
+  with open(path, 'r+b') as f:
+    mbr = f.read(MBR_SIZE)
+    f.seek(0)
+    f.write(EncodeProtectiveMbr(drive_blocks, mbr=mbr, bootcode=bootcode,
+                                boot_guid=boot_guid))
+    for offset, data in writes:
+      f.seek(offset)
+      f.write(data)
+
+
+# A GPT read from an image, with its partitions in order of number.
+Gpt = collections.namedtuple('Gpt', (
+    'block_size', 'disk_guid', 'first_usable_lba', 'last_usable_lba',
+    'partitions'))
+
+# Block sizes a GPT is looked for with, like cgpt does.
+BLOCK_SIZES = (512, 1024, 2048, 4096, 8192)
+
+# Bytes read at once from the start of an image: the protective MBR, primary
+# header and entry array of an unpadded GPT with the largest block size.
+_HEADER_AREA_SIZE = 2 * BLOCK_SIZES[-1] + NUMBER_OF_ENTRIES * SIZE_OF_ENTRY
+
+
+def DecodeHeader(block):
+  """Returns the fields of a GPT header as a dict, or None if it is invalid."""
+  if len(block) < GPT_HEADER_SIZE or not block.startswith(GPT_SIGNATURE):
+    return None
+  fields = list(struct.unpack_from(_HEADER_FORMAT, block))
+  crc = fields[3]
+  fields[3] = 0
+  if zlib.crc32(struct.pack(_HEADER_FORMAT, *fields)) & 0xffffffff != crc:
+    return None
+  names = ('my_lba', 'alternate_lba', 'first_usable_lba', 'last_usable_lba',
+           'disk_guid', 'entries_lba', 'number_of_entries', 'size_of_entry',
+           'entries_crc32')
+  header = dict(zip(names, fields[5:]))
+  header['disk_guid'] = uuid.UUID(bytes_le=header['disk_guid'])
+  if header['size_of_entry'] < SIZE_OF_ENTRY:
+    return None
+  return header
+
+
+def DecodeEntries(entries, size_of_entry=SIZE_OF_ENTRY):
+  """Returns the used entries of a partition entry array as Partitions.
+
+  Only the attribute bits `cgpt add` sets are decoded.
+  """
+  partitions = []
+  for offset in range(0, len(entries) - SIZE_OF_ENTRY + 1, size_of_entry):
+    type_guid, unique_guid, start, end, attrs, name = struct.unpack_from(
+        _ENTRY_FORMAT, entries, offset)
+    type_guid = uuid.UUID(bytes_le=type_guid)
+    if type_guid.int == 0:
+      continue
+    partitions.append(Partition(
+        num=offset // size_of_entry + 1,
+        type=str(type_guid).upper(),
+        label=name.decode('utf-16-le', 'replace').split('\0', 1)[0],
+        start=start, end=end,
+        unique_guid=str(uuid.UUID(bytes_le=unique_guid)).upper(),
+        priority=(attrs >> ATTRIBUTE_PRIORITY_OFFSET) & 15,
+        tries=(attrs >> ATTRIBUTE_TRIES_OFFSET) & 15,
+        successful=(attrs >> ATTRIBUTE_SUCCESSFUL_OFFSET) & 1,
+        legacy_boot=bool((attrs >> ATTRIBUTE_LEGACY_BOOT_OFFSET) & 1)))
+  return partitions
+
+
+class _HeaderAreaReader(object):
+  """Reads GPT copies from an image, the primary one from a single read."""
+
+  def __init__(self, f):
+    self._file = f
+    self._head = f.read(_HEADER_AREA_SIZE)
+    self.size = f.seek(0, os.SEEK_END)
+
+  def Read(self, offset, size):
+    if offset + size <= len(self._head):
+      return self._head[offset:offset + size]
+    self._file.seek(offset)
+    return self._file.read(size)
+
+  def ReadCopy(self, block_size, lba):
+    """Returns the (header, entries) of the GPT copy with its header at |lba|.
+
+    The header is None when it is missing or damaged, and the entries are
+    None when they don't match the CRC in the header.
+    """
+    if lba < 1 or (lba + 1) * block_size > self.size:
+      return None, None
+    header = DecodeHeader(self.Read(lba * block_size, block_size))
+    if header is None:
+      return None, None
+    entries = self.Read(header['entries_lba'] * block_size,
+                        header['number_of_entries'] * header['size_of_entry'])
+    if zlib.crc32(entries) & 0xffffffff != header['entries_crc32']:
+      return header, None
+    return header, entries
+
+
+def _MakeGpt(block_size, header, entries):
+  return Gpt(block_size=block_size, disk_guid=header['disk_guid'],
+             first_usable_lba=header['first_usable_lba'],
+             last_usable_lba=header['last_usable_lba'],
+             partitions=DecodeEntries(entries, header['size_of_entry']))
+
+
+def ReadGpt(path):
+  """Reads the GPT of an image file or block device.
+
+  The header area is read at once, and the primary GPT used unless it is
+  damaged, in which case the secondary one at the end of the image is.
+
+  Args:
+    path: Image file or block device to read.
+
+  Returns:
+    A Gpt tuple.
+  """
+  with open(path, 'rb') as f:
+    reader = _HeaderAreaReader(f)
+    for block_size in BLOCK_SIZES:
+      for lba in (1, reader.size // block_size - 1):
+        header, entries = reader.ReadCopy(block_size, lba)
+        if entries is not None:
+          return _MakeGpt(block_size, header, entries)
+  raise GptError('No valid GPT found in %s' % path)
+
+
+def CheckGpt(path):
+  """Checks the integrity of the GPT of an image file or block device.
+
+  Both copies of the GPT are read, and checked against their CRCs, against
+  each other and for partitions that overlap or are outside the usable
+  blocks.  Nothing but the GPT copies is read.
+
+  Args:
+    path: Image file or block device to check.
+
+  Returns:
+    A (gpt, problems) tuple: the Gpt tuple read (None if no copy is valid)
+    and a list of strings describing each problem found.
+  """
+  with open(path, 'rb') as f:
+    reader = _HeaderAreaReader(f)
+    for block_size in BLOCK_SIZES:
+      last_lba = reader.size // block_size - 1
+      primary = reader.ReadCopy(block_size, 1)
+      alternate_lba = last_lba
+      if primary[0] is not None:
+        alternate_lba = primary[0]['alternate_lba']
+      secondary = reader.ReadCopy(block_size, alternate_lba)
+      if primary[0] is not None or secondary[0] is not None:
+        break
+    else:
+      return None, ['no GPT found']
+
+  problems = []
+  for name, (header, entries) in (('primary', primary),
+                                  ('secondary', secondary)):
+    if header is None:
+      problems.append('%s GPT header is missing or damaged' % name)
+    elif entries is None:
+      problems.append('%s GPT entries do not match their CRC' % name)
+
+  if primary[0] is not None and secondary[0] is not None:
+    if primary[0]['my_lba'] != 1 or secondary[0]['alternate_lba'] != 1:
+      problems.append('GPT headers do not point at each other')
+    if alternate_lba != last_lba:
+      problems.append('secondary GPT is at block %d instead of the last '
+                      'block %d' % (alternate_lba, last_lba))
+    keys = ('first_usable_lba', 'last_usable_lba', 'disk_guid',
+            'number_of_entries', 'size_of_entry', 'entries_crc32')
+    differ = [x for x in keys if primary[0][x] != secondary[0][x]]
+    if differ:
+      problems.append('primary and secondary GPT headers differ in %s' %
+                      ', '.join(differ))
+    elif primary[1] != secondary[1]:
+      problems.append('primary and secondary GPT entries differ')
+
+  header, entries = primary if primary[1] is not None else secondary
+  if entries is None:
+    return None, problems
+  gpt = _MakeGpt(block_size, header, entries)
+
+  placed = []
+  for partition in gpt.partitions:
+    if partition.end < partition.start:
+      problems.append('partition %d ends before it starts' % partition.num)
+      continue
+    if (partition.start < gpt.first_usable_lba or
+        partition.end > gpt.last_usable_lba):
+      problems.append('partition %d is outside the usable blocks' %
+                      partition.num)
+    placed.append(partition)
+  placed.sort(key=lambda x: x.start)
+  # The partition reaching furthest so far is the one later ones can overlap.
+  furthest = None
+  for partition in placed:
+    if furthest is not None and partition.start <= furthest.end:
+      problems.append('partitions %d and %d overlap' %
+                      (furthest.num, partition.num))
+    if furthest is None or partition.end > furthest.end:
+      furthest = partition
+  return gpt, problems
@@ -0,0 +1,280 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+# Copyright 2021 The Chromium OS Authors. All rights reserved.
+# Use of this source code is governed by a BSD-style license that can be
+# found in the LICENSE file.
+
+"""Unit tests for gpt_image."""
+
+# pylint: disable=W0212
+
+from __future__ import print_function
+
+import os
+import shutil
+import struct
+import subprocess
+import tempfile
+import unittest
+import uuid
+import zlib
+
+import gpt_image
+
+
+DISK_GUID = uuid.UUID('12345678-1234-5678-9abc-123456789abc')
+PARTITIONS = [
+    gpt_image.Partition(num=2, type='kernel', label='KERN-A', start=64,
+                        end=127, priority=15, tries=15,
+                        unique_guid='b1e7c0de-0000-4000-8000-000000000002'),
+    gpt_image.Partition(num=12, type='efi', label='EFI-SYSTEM', start=128,
+                        end=255, legacy_boot=True,
+                        unique_guid='b1e7c0de-0000-4000-8000-00000000000c'),
+    gpt_image.Partition(num=1, type='data', label='STATE', start=256,
+                        end=1000,
+                        unique_guid='b1e7c0de-0000-4000-8000-000000000001'),
+]
+
+
+def _ParseHeader(block):
+  """Returns the fields of the GPT header in |block|, checking its CRC."""
+  fields = list(struct.unpack_from(gpt_image._HEADER_FORMAT, block))
+  crc = fields[3]
+  fields[3] = 0
+  assert zlib.crc32(struct.pack(gpt_image._HEADER_FORMAT, *fields)) == crc
+  return fields
+
+
+class GptImageTest(unittest.TestCase):
+  """Test building GPTs."""
+
+  def setUp(self):
+    self.tempdir = tempfile.mkdtemp(prefix='gpt_image-test_')
+
+  def tearDown(self):
+    shutil.rmtree(self.tempdir)
+
+  def testHeaders(self):
+    """Test the headers and entry arrays of a GPT on a drive."""
+    writes = dict(gpt_image.BuildGpt(512, 2048, PARTITIONS, padding_blocks=4,
+                                     disk_guid=DISK_GUID))
+    self.assertEqual(sorted(writes), [512, 6 * 512, 2015 * 512, 2047 * 512])
+    primary = _ParseHeader(writes[512])
+    secondary = _ParseHeader(writes[2047 * 512])
+    entries = writes[6 * 512]
+    self.assertEqual(entries, writes[2015 * 512])
+    self.assertEqual(primary[:3], [b'EFI PART', 0x10000, 92])
+    # my_lba, alternate_lba, first and last usable LBA, disk GUID, entries
+    # LBA, number of entries, entry size and entries CRC.
+    self.assertEqual(primary[5:], [1, 2047, 38, 2014, DISK_GUID.bytes_le, 6,
+                                   128, 128, zlib.crc32(entries)])
+    self.assertEqual(secondary[5:7], [2047, 1])
+    self.assertEqual(secondary[10], 2015)
+    self.assertEqual(secondary[7:10] + secondary[11:],
+                     primary[7:10] + primary[11:])
+
+  def testEntries(self):
+    """Test that entries hold the partitions with their attributes."""
+    entries = gpt_image.EncodeEntries(PARTITIONS)
+    self.assertEqual(len(entries), 128 * 128)
+    type_guid, unique_guid, start, end, attrs, name = struct.unpack_from(
+        gpt_image._ENTRY_FORMAT, entries, 128)
+    self.assertEqual(uuid.UUID(bytes_le=type_guid),
+                     uuid.UUID(gpt_image.TYPE_GUIDS['kernel']))
+    self.assertEqual(uuid.UUID(bytes_le=unique_guid),
+                     uuid.UUID(PARTITIONS[0].unique_guid))
+    self.assertEqual((start, end), (64, 127))
+    self.assertEqual(attrs, 15 << 52 | 15 << 48)
+    self.assertEqual(name.decode('utf-16-le').rstrip('\0'), 'KERN-A')
+    attrs = struct.unpack_from('<Q', entries, 11 * 128 + 48)[0]
+    self.assertEqual(attrs, 1 << 2)
+    self.assertEqual(entries[2 * 128:11 * 128], b'\0' * 9 * 128)
+
+  def testGolden(self):
+    """Test the GPT against bytes decoded by hand from a known good one."""
+    writes = dict(gpt_image.BuildGpt(512, 2048, PARTITIONS, padding_blocks=4,
+                                     disk_guid=DISK_GUID))
+    self.assertEqual(writes[512], bytes.fromhex(
+        '4546492050415254'                  # "EFI PART"
+        '00000100' '5c000000' '2de7bba2'    # revision, size, header CRC
+        '00000000'
+        '0100000000000000' 'ff07000000000000'  # my LBA, alternate LBA
+        '2600000000000000' 'de07000000000000'  # first and last usable LBA
+        '78563412341278569abc123456789abc'  # disk GUID
+        '0600000000000000'                  # entries LBA
+        '80000000' '80000000' '2cc0d92a'   # entries, entry size, CRC
+    ).ljust(512, b'\0'))
+    self.assertEqual(writes[2047 * 512][:92], bytes.fromhex(
+        '4546492050415254' '00000100' '5c000000' '7f22245f' '00000000'
+        'ff07000000000000' '0100000000000000'
+        '2600000000000000' 'de07000000000000'
+        '78563412341278569abc123456789abc'
+        'df07000000000000'
+        '80000000' '80000000' '2cc0d92a'))
+
+    entries = writes[6 * 512]
+    name = lambda x: x.encode('utf-16-le').ljust(72, b'\0')
+    self.assertEqual(entries[128:256], bytes.fromhex(
+        '5d2a3afe324fa741b725accc3285a309'  # ChromeOS kernel
+        'dec0e7b1000000408000000000000002'
+        '4000000000000000' '7f00000000000000'
+        '000000000000ff00'                  # priority 15, tries 15
+    ) + name('KERN-A'))
+    self.assertEqual(entries[11 * 128:12 * 128], bytes.fromhex(
+        '28732ac11ff8d211ba4b00a0c93ec93b'  # EFI system partition
+        'dec0e7b100000040800000000000000c'
+        '8000000000000000' 'ff00000000000000'
+        '0400000000000000'                  # legacy BIOS bootable
+    ) + name('EFI-SYSTEM'))
+    self.assertEqual(entries[:128], bytes.fromhex(
+        'af3dc60f838472478e793d69d8477de4'  # Linux data
+        'dec0e7b1000000408000000000000001'
+        '0001000000000000' 'e803000000000000'
+        '0000000000000000'
+    ) + name('STATE'))
+    self.assertEqual(entries[256:11 * 128] + entries[12 * 128:],
+                     b'\0' * 125 * 128)
+
+  def testBadPartitions(self):
+    """Test that partitions which don't fit are rejected."""
+    for partition in (PARTITIONS[0]._replace(start=10),
+                      PARTITIONS[2]._replace(end=2047),
+                      PARTITIONS[0]._replace(num=129),
+                      PARTITIONS[0]._replace(tries=16),
+                      PARTITIONS[0]._replace(type='floppy')):
+      self.assertRaises(gpt_image.GptError, gpt_image.BuildGpt, 512, 2048,
+                        [partition])
+    self.assertRaises(gpt_image.GptError, gpt_image.BuildGpt, 512, 2048,
+                      PARTITIONS + PARTITIONS[:1])
+
+  def testExternalGpt(self):
+    """Test a GPT kept apart from its drive."""
+    writes = dict(gpt_image.BuildGpt(512, 2**20, PARTITIONS, gpt_blocks=128,
+                                     disk_guid=DISK_GUID))
+    self.assertEqual(sorted(writes), [512, 1024, 95 * 512, 127 * 512])
+    primary = _ParseHeader(writes[512])
+    self.assertEqual(primary[5:9], [1, 127, 0, 2**20 - 1])
+
+  def testWriteGpt(self):
+    """Test writing the protective MBR and GPT to an image."""
+    image = os.path.join(self.tempdir, 'image.bin')
+    with open(image, 'wb') as f:
+      f.write(b'\xff' * 512)
+      f.truncate(2048 * 512)
+    gpt_image.WriteGpt(image, 512, 2048, PARTITIONS, disk_guid=DISK_GUID,
+                       bootcode=b'\xeb' * 512, boot_num=12)
+    with open(image, 'rb') as f:
+      data = f.read()
+
+    mbr = data[:512]
+    self.assertEqual(mbr[:424], b'\xeb' * 424)
+    self.assertEqual(mbr[424:440],
+                     uuid.UUID(PARTITIONS[1].unique_guid).bytes_le)
+    self.assertEqual(mbr[440:444], b'\xff' * 4)
+    self.assertEqual(mbr[450], 0xee)
+    self.assertEqual(struct.unpack_from('<II', mbr, 454), (1, 2047))
+    self.assertEqual(mbr[462:], b'\0' * 48 + b'\x55\xaa')
+    for offset, block in gpt_image.BuildGpt(512, 2048, PARTITIONS,
+                                            disk_guid=DISK_GUID):
+      self.assertEqual(data[offset:offset + len(block)], block)
+
+  def testReadGpt(self):
+    """Test that a written GPT reads back the same."""
+    for block_size in (512, 4096):
+      image = os.path.join(self.tempdir, 'image.bin')
+      with open(image, 'wb') as f:
+        f.truncate(2048 * block_size)
+      gpt_image.WriteGpt(image, block_size, 2048, PARTITIONS,
+                         disk_guid=DISK_GUID)
+      gpt = gpt_image.ReadGpt(image)
+      self.assertEqual(gpt.block_size, block_size)
+      self.assertEqual(gpt.disk_guid, DISK_GUID)
+      self.assertEqual(len(gpt.partitions), len(PARTITIONS))
+      for read, written in zip(gpt.partitions,
+                               sorted(PARTITIONS, key=lambda x: x.num)):
+        self.assertEqual(gpt_image.GetTypeGuid(read.type),
+                         gpt_image.GetTypeGuid(written.type))
+        self.assertEqual(uuid.UUID(read.unique_guid),
+                         uuid.UUID(written.unique_guid))
+        self.assertEqual(read._replace(type=written.type,
+                                       unique_guid=written.unique_guid),
+                         written)
+
+  def testReadBackupGpt(self):
+    """Test that the secondary GPT is used when the primary is damaged."""
+    image = os.path.join(self.tempdir, 'image.bin')
+    with open(image, 'wb') as f:
+      f.truncate(2048 * 512)
+    gpt_image.WriteGpt(image, 512, 2048, PARTITIONS, disk_guid=DISK_GUID)
+    with open(image, 'r+b') as f:
+      f.seek(2 * 512)
+      f.write(b'\xff')
+    self.assertEqual(len(gpt_image.ReadGpt(image).partitions), 3)
+    with open(image, 'r+b') as f:
+      f.seek(2047 * 512)
+      f.write(b'\xff')
+    self.assertRaises(gpt_image.GptError, gpt_image.ReadGpt, image)
+
+  def testCheckGpt(self):
+    """Test the problems found in GPTs."""
+    image = os.path.join(self.tempdir, 'image.bin')
+    with open(image, 'wb') as f:
+      f.truncate(2048 * 512)
+    gpt_image.WriteGpt(image, 512, 2048, PARTITIONS, disk_guid=DISK_GUID)
+    gpt, problems = gpt_image.CheckGpt(image)
+    self.assertEqual(problems, [])
+    self.assertEqual(len(gpt.partitions), 3)
+
+    overlapping = PARTITIONS + [PARTITIONS[2]._replace(num=3, start=300,
+                                                       end=400)]
+    for offset, block in gpt_image.BuildGpt(512, 2048, overlapping,
+                                            disk_guid=DISK_GUID)[:2]:
+      with open(image, 'r+b') as f:
+        f.seek(offset)
+        f.write(block)
+    gpt, problems = gpt_image.CheckGpt(image)
+    self.assertEqual(len(gpt.partitions), 4)
+    self.assertEqual(problems, [
+        'primary and secondary GPT headers differ in entries_crc32',
+        'partitions 1 and 3 overlap'])
+
+    with open(image, 'wb') as f:
+      f.truncate(4096)
+    self.assertEqual(gpt_image.CheckGpt(image), (None, ['no GPT found']))
+
+  @unittest.skipUnless(shutil.which('cgpt'), 'needs cgpt')
+  def testMatchesCgpt(self):
+    """Test that the GPT is byte for byte the one cgpt writes."""
+    image = os.path.join(self.tempdir, 'image.bin')
+    with open(image, 'wb') as f:
+      f.truncate(2048 * 512)
+    bootcode = os.path.join(self.tempdir, 'pmbr.bin')
+    with open(bootcode, 'wb') as f:
+      f.write(b'\xeb' * 512)
+    commands = [['create', '-p', '4']]
+    for part in PARTITIONS:
+      commands.append(['add', '-i', str(part.num), '-b', str(part.start),
+                       '-s', str(part.end - part.start + 1), '-t', part.type,
+                       '-l', part.label, '-u', part.unique_guid])
+    commands += [
+        ['add', '-i', '2', '-S', '0', '-T', '15', '-P', '15'],
+        ['boot', '-p', '-b', bootcode, '-i', '12'],
+        ['add', '-i', '12', '-B', '1'],
+    ]
+    for command in commands:
+      subprocess.check_call(['cgpt'] + command + [image])
+    with open(image, 'rb') as f:
+      expected = f.read()
+
+    disk_guid = uuid.UUID(bytes_le=expected[512 + 56:512 + 72])
+    with open(image, 'wb') as f:
+      f.truncate(2048 * 512)
+    gpt_image.WriteGpt(image, 512, 2048, PARTITIONS, padding_blocks=4,
+                       disk_guid=disk_guid, bootcode=b'\xeb' * 512,
+                       boot_num=12)
+    with open(image, 'rb') as f:
+      self.assertEqual(f.read(), expected)
+
+
+if __name__ == '__main__':
+  unittest.main()
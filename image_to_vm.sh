@@ -168,9 +168,20 @@ else
   sudo e2fsck -pf "${TEMP_STATE}"
   sudo resize2fs "${TEMP_STATE}" ${STATEFUL_SIZE_MEGABYTES}M
 fi
+# The stateful partition of the VM image is sized to hold all of it.
+STATEFUL_TARGET_BYTES=$(bd_safe_size "${TEMP_STATE}")
 TEMP_PMBR="${TEMP_DIR}"/pmbr
 dd if="${SRC_IMAGE}" of="${TEMP_PMBR}" bs=512 count=1
 
+# Create the image at its final size: the smallest one on which the partition
+# script gives the stateful partition exactly what it needs, rather than one
+# with room for alignment losses.
+VM_DISK_SIZE=$(get_vm_disk_size "${FLAGS_disk_layout}" \
+               "${STATEFUL_TARGET_BYTES}") ||
+  die "Unable to size the VM disk for disk layout ${FLAGS_disk_layout}."
+rm -f "${TEMP_IMG}"
+truncate -s "${VM_DISK_SIZE}" "${TEMP_IMG}"
+
 # Set up a new partition table.
 PARTITION_SCRIPT_PATH=$(mktemp)
 write_partition_script "${FLAGS_disk_layout}" "${PARTITION_SCRIPT_PATH}"